@@ -0,0 +1,73 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+from __future__ import print_function
+import argparse
+import os
+import subprocess
+import sys
+import time
+
+
+ENTRY_POINTS = ['svg_style_updater.py', 'svg_to_png.py', 'compose_bitmap.py', 'svg_pipeline.py']
+# Commands measured besides entry points: the interpreter alone, and the first color name lookup
+REFERENCE_COMMANDS = [
+    ('python', ['-c', 'pass']),
+    ('color name lookup', ['-c', 'from code.color_string import ColorString; ColorString("red")']),
+]
+
+
+def measure_command(command_args, runs_count, working_dir):
+    """ Runs the command runs_count times, after a first run warming up file system caches and writing .pyc files.
+    Returns the list of wall clock durations, in seconds. """
+    durations = []
+    with open(os.devnull, 'w') as devnull:
+        for index in range(runs_count + 1):
+            start = time.time()
+            subprocess.call(command_args, stdout=devnull, stderr=devnull, cwd=working_dir)
+            if index:
+                durations.append(time.time() - start)
+    return durations
+
+
+def get_median(values):
+    sorted_values = sorted(values)
+    middle = len(sorted_values) // 2
+    if len(sorted_values) % 2:
+        return sorted_values[middle]
+    return (sorted_values[middle - 1] + sorted_values[middle]) / 2.0
+
+
+def parse_command_line(argv):
+    parser = argparse.ArgumentParser(description='Measures start-up time of each entry point: the time to import its \
+modules and parse its command line (run with --help), compared to the Python interpreter alone.')
+    parser.add_argument('--runs', dest='RUNS', type=int, default=10, help='Number of measured runs of each command \
+(default: 10)')
+    parser.add_argument('--python', dest='PYTHON', default=sys.executable, help='Python interpreter to run entry \
+points with (default: the current one)')
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    if argv is None:
+        argv = sys.argv[1:]
+    args = parse_command_line(argv)
+    if args.RUNS < 1:
+        raise Exception('Invalid number of runs ' + str(args.RUNS) + '. Should be at least 1.')
+    working_dir = os.path.dirname(os.path.abspath(__file__))
+    commands = [(name, [args.PYTHON] + command_args) for name, command_args in REFERENCE_COMMANDS]
+    commands += [(entry_point, [args.PYTHON, entry_point, '--help']) for entry_point in ENTRY_POINTS]
+    print('Start-up time over ' + str(args.RUNS) + ' runs, in milliseconds (' + args.PYTHON + ')\n')
+    print('{:<24}{:>10}{:>10}{:>16}'.format('', 'min', 'median', 'over python'))
+    python_median = None
+    for name, command_args in commands:
+        durations = measure_command(command_args, args.RUNS, working_dir)
+        median = get_median(durations)
+        if python_median is None:
+            python_median = median
+        print('{:<24}{:>10.1f}{:>10.1f}{:>16.1f}'.format(name, min(durations) * 1000, median * 1000,
+                                                         (median - python_median) * 1000))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,688 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+from __future__ import print_function
+import io
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import unittest
+
+import file_utils as utils
+from pipeline import Pipeline, PipelineStage
+from resize_cache import ResizeCache
+
+
+# ImageMagick gravity names, lowercase (see http://www.imagemagick.org/script/command-line-options.php#gravity)
+GRAVITIES = ['northwest', 'north', 'northeast', 'west', 'center', 'east', 'southwest', 'south', 'southeast']
+# Count of overlays composed at once by batching compositors: bounds the memory used by a batch.
+DEFAULT_BATCH_SIZE = 256
+# zlib compression strategies of PNG encoders, by name (see zlib deflateInit2)
+PNG_STRATEGIES = {'default': 0, 'filtered': 1, 'huffman': 2, 'rle': 3, 'fixed': 4}
+
+
+def exec_command(command_args, log_filename, input_data=None, echo=True):
+    """ Runs the command, with input_data piped to its standard input if any. Returns its exit status. """
+    with open(log_filename, 'a+') as log_file:
+        log_file.seek(0, os.SEEK_END)
+        command_line = ' '.join(command_args)
+        if echo:
+            # Single write, so that lines of commands run in parallel do not interleave
+            sys.stdout.write(command_line + '\n')
+        else:
+            log_file.write(command_line + '\n')
+            log_file.flush()
+        if input_data is None:
+            return subprocess.call(command_args, stdout=log_file, stderr=subprocess.STDOUT)
+        process = subprocess.Popen(command_args, stdin=subprocess.PIPE, stdout=log_file, stderr=subprocess.STDOUT)
+        process.communicate(input_data)
+        return process.returncode
+
+
+def get_resize_geometry(width=None, height=None):
+    resize_geometry = str(width) if width else ''
+    resize_geometry += ('x' + str(height)) if height else ''
+    return resize_geometry
+
+
+def get_offset_geometry(offset_x=None, offset_y=None):
+    """ Returns an ImageMagick offset geometry, with explicit signs: '+5-3'. """
+    return '{:+d}{:+d}'.format(offset_x or 0, offset_y or 0)
+
+
+def get_resize_size(original_width, original_height, width=None, height=None):
+    """ Returns the size of an image resized like ImageMagick '-resize WIDTHxHEIGHT': to fit in the given size, keeping
+    its aspect ratio. A missing dimension is computed from the other one. """
+    if width and height:
+        scale = min(width / float(original_width), height / float(original_height))
+    elif width:
+        scale = width / float(original_width)
+    elif height:
+        scale = height / float(original_height)
+    else:
+        return original_width, original_height
+    return max(1, int(round(original_width * scale))), max(1, int(round(original_height * scale)))
+
+
+def get_gravity_position(background_size, overlay_size, gravity='center', offset_x=None, offset_y=None, exact=False):
+    """ Returns the position of the overlay top left corner, like ImageMagick '-gravity' and '-geometry' offset: offsets
+    move the overlay away from the gravity edges (to the left for east gravities, upwards for south gravities).
+    Centered positions are rounded down to whole pixels, unless exact. """
+    round_position = float if exact else int
+    background_width, background_height = background_size
+    overlay_width, overlay_height = overlay_size
+    offset_x = offset_x or 0
+    offset_y = offset_y or 0
+    if gravity.endswith('west'):
+        x = offset_x
+    elif gravity.endswith('east'):
+        x = background_width - overlay_width - offset_x
+    else:
+        x = round_position((background_width - overlay_width) / 2.0) + offset_x
+    if gravity.startswith('north'):
+        y = offset_y
+    elif gravity.startswith('south'):
+        y = background_height - overlay_height - offset_y
+    else:
+        y = round_position((background_height - overlay_height) / 2.0) + offset_y
+    return x, y
+
+
+class OverlayBatch:
+    """ Overlays of a same background composed together, with their state along decoding, composing and encoding:
+images (decoded overlays, then composed outputs) and error messages, at the index of their files.
+"""
+
+    def __init__(self, background_file, overlay_files, output_files, width=None, height=None, offset_x=None,
+                 offset_y=None, gravity='center'):
+        self.background_file = background_file
+        self.overlay_files = overlay_files
+        self.output_files = output_files
+        self.width = width
+        self.height = height
+        self.offset_x = offset_x
+        self.offset_y = offset_y
+        self.gravity = gravity
+        self.images = [None] * len(overlay_files)
+        self.errors = [None] * len(overlay_files)
+
+
+class BitmapCompositor:
+    """ Overlays bitmaps over a background bitmap. """
+    LOG_FILENAME = 'compose_bitmap.log'
+
+    def __init__(self):
+        self.about = None
+        self.initialized = False
+        self.available = False
+        self.echo_commands = True
+        self.batch_size = DEFAULT_BATCH_SIZE
+        self.jobs_count = 1
+        # PNG output zlib compression level (0-9) and strategy name (see PNG_STRATEGIES), encoder defaults if None
+        self.png_compression_level = None
+        self.png_strategy = None
+        # ResizeCache of resized overlays, if any
+        self.resize_cache = None
+
+    def initialize(self):
+        pass
+
+    def is_available(self):
+        if not self.initialized:
+            self.initialize()
+        return self.available
+
+    def overlay(self, background_file, overlay_file, output_file, width=None, height=None, offset_x=None,
+                offset_y=None, gravity='center'):
+        """ Writes the overlay bitmap, resized to fit in width x height if any, over the background, at the position
+        given by gravity and offsets (see get_gravity_position). Returns 0 on success. """
+        pass
+
+    def overlay_data(self, background_file, overlay_png_data, output_file, width=None, height=None, offset_x=None,
+                     offset_y=None, gravity='center'):
+        """ Same as overlay(), with the overlay bitmap PNG data held in memory. """
+        pass
+
+    def overlay_batch(self, background_file, overlay_files, output_files, width=None, height=None, offset_x=None,
+                      offset_y=None, gravity='center'):
+        """ Same as overlay(), for each overlay file and the output file at the same index, with jobs_count overlays
+        run in parallel. Returns the list of overlay() return values. """
+        def overlay_files_pair(files_pair):
+            return self.overlay(background_file, files_pair[0], files_pair[1], width, height, offset_x, offset_y,
+                                gravity)
+        if self.jobs_count < 2:
+            return [overlay_files_pair(files_pair) for files_pair in zip(overlay_files, output_files)]
+        pipeline = Pipeline([PipelineStage('overlay', overlay_files_pair, self.jobs_count)], self.jobs_count * 2)
+        return [job_result.value if job_result.succeeded() else 1
+                for job_result in pipeline.run(zip(overlay_files, output_files))]
+
+    def close(self):
+        """ Releases resources kept between overlays. """
+        pass
+
+    def __repr__(self):
+        return '[' + self.__class__.__name__ + ']\n' + str(self.about)
+
+
+class ImageMagickCompositor(BitmapCompositor):
+    """ Overlays bitmaps with ImageMagick 'convert' command line: one command per overlay. """
+    NAME = 'imagemagick'
+    LOG_FILENAME = 'compose_bitmap_imagemagick.log'
+
+    def initialize(self):
+        if not self.initialized:
+            try:
+                self.about = subprocess.check_output(['convert', '-version'], stderr=subprocess.STDOUT)
+                self.available = True
+            except (subprocess.CalledProcessError, OSError):
+                pass
+            self.initialized = True
+
+    @staticmethod
+    def get_command_args(background_file, overlay_file, output_file, width=None, height=None, offset_x=None,
+                         offset_y=None, gravity='center', png_compression_level=None, png_strategy=None):
+        command_args = ['convert', background_file, '(', overlay_file]
+        if width or height:
+            command_args.extend(['-resize', get_resize_geometry(width, height)])
+        command_args.extend([')', '-gravity', gravity])
+        if offset_x or offset_y:
+            command_args.extend(['-geometry', get_offset_geometry(offset_x, offset_y)])
+        command_args.append('-composite')
+        if png_compression_level is not None:
+            command_args.extend(['-define', 'png:compression-level=' + str(png_compression_level)])
+        if png_strategy:
+            command_args.extend(['-define', 'png:compression-strategy=' + str(PNG_STRATEGIES[png_strategy])])
+        command_args.append(output_file)
+        return command_args
+
+    def overlay(self, background_file, overlay_file, output_file, width=None, height=None, offset_x=None,
+                offset_y=None, gravity='center'):
+        """ With a resize cache disk tier, overlays are resized once by a separate command, and the resized file is
+        overlaid as is. """
+        if (width or height) and self.resize_cache and self.resize_cache.disk_cache:
+            resized_overlay_file = self.get_resized_overlay_file(overlay_file, width, height)
+            if resized_overlay_file:
+                overlay_file, width, height = resized_overlay_file, None, None
+        command_args = ImageMagickCompositor.get_command_args(background_file, overlay_file, output_file, width,
+                                                              height, offset_x, offset_y, gravity,
+                                                              self.png_compression_level, self.png_strategy)
+        return exec_command(command_args, self.LOG_FILENAME, echo=self.echo_commands)
+
+    def get_resized_overlay_file(self, overlay_file, width=None, height=None):
+        """ Returns the resized overlay file from the resize cache, resizing it on cache miss. Returns None if resizing
+        failed. """
+        key = self.resize_cache.get_key(overlay_file, width, height, self.NAME)
+        resized_overlay_file = self.resize_cache.get_file(key)
+        if resized_overlay_file is None:
+            temporary_fd, temporary_file = tempfile.mkstemp(suffix='.png')
+            os.close(temporary_fd)
+            try:
+                command_args = ['convert', overlay_file, '-resize', get_resize_geometry(width, height), temporary_file]
+                if exec_command(command_args, self.LOG_FILENAME, echo=self.echo_commands) == 0:
+                    self.resize_cache.add_file(key, temporary_file)
+                    resized_overlay_file = self.resize_cache.disk_cache.get_cached_file(key)
+            finally:
+                os.remove(temporary_file)
+        return resized_overlay_file
+
+    def overlay_data(self, background_file, overlay_png_data, output_file, width=None, height=None, offset_x=None,
+                     offset_y=None, gravity='center'):
+        """ The overlay PNG data is piped to ImageMagick standard input. """
+        command_args = ImageMagickCompositor.get_command_args(background_file, 'png:-', output_file, width, height,
+                                                              offset_x, offset_y, gravity,
+                                                              self.png_compression_level, self.png_strategy)
+        return exec_command(command_args, self.LOG_FILENAME, overlay_png_data, self.echo_commands)
+
+
+class PillowCompositor(BitmapCompositor):
+    """ Overlays bitmaps in-process, with Pillow.
+
+    Backgrounds are decoded once and kept in memory: each overlay only decodes the overlay bitmap, alpha blends it over
+    a copy of the background, and encodes the output (format given by the output file extension).
+    Resizing uses Lanczos filter, ImageMagick default filter for downsizing.
+    Requires Pillow:
+        pip install Pillow
+    """
+    NAME = 'pillow'
+    LOG_FILENAME = 'compose_bitmap_pillow.log'
+    # Resampling filter of overlays, part of resize cache keys
+    RESIZE_FILTER_NAME = 'lanczos'
+
+    def __init__(self):
+        BitmapCompositor.__init__(self)
+        self.image_module = None
+        self.backgrounds = {}
+        self.backgrounds_lock = threading.Lock()
+
+    def initialize(self):
+        if not self.initialized:
+            try:
+                from PIL import Image
+                import PIL
+            except ImportError:
+                pass
+            else:
+                self.image_module = Image
+                self.about = 'Pillow ' + getattr(PIL, '__version__', getattr(Image, 'VERSION', '?'))
+                self.available = True
+            self.initialized = True
+
+    def get_background(self, background_file):
+        """ Returns the decoded background: a tuple (RGBA image, original mode). """
+        with self.backgrounds_lock:
+            background = self.backgrounds.get(background_file)
+            if background is None:
+                image = self.image_module.open(background_file)
+                image.load()
+                background = (image.convert('RGBA'), image.mode)
+                self.backgrounds[background_file] = background
+            return background
+
+    def prepare_overlay(self, overlay_image, width=None, height=None):
+        """ Returns the overlay image in RGBA mode, resized to fit in width x height if any. """
+        if overlay_image.mode != 'RGBA':
+            overlay_image = overlay_image.convert('RGBA')
+        if width or height:
+            resize_size = get_resize_size(overlay_image.size[0], overlay_image.size[1], width, height)
+            if resize_size != overlay_image.size:
+                overlay_image = overlay_image.resize(resize_size, self.image_module.LANCZOS)
+        return overlay_image
+
+    def load_overlay(self, overlay_source, width=None, height=None):
+        """ Returns the decoded overlay (a file path or a file object), in RGBA mode, resized to fit in width x height
+        if any. Resized overlay files are looked up in the resize cache, if any, and added to it. """
+        cache_key = None
+        if (width or height) and self.resize_cache and not hasattr(overlay_source, 'read'):
+            cache_key = self.resize_cache.get_key(overlay_source, width, height, self.RESIZE_FILTER_NAME)
+            overlay_image = self.resize_cache.get_image(cache_key, self.image_module)
+            if overlay_image is not None:
+                return overlay_image
+        overlay_image = self.image_module.open(overlay_source)
+        overlay_image.load()
+        overlay_image = self.prepare_overlay(overlay_image, width, height)
+        if cache_key:
+            self.resize_cache.add_image(cache_key, overlay_image)
+        return overlay_image
+
+    def compose(self, background_file, overlay_image, width=None, height=None, offset_x=None, offset_y=None,
+                gravity='center'):
+        """ Returns the composed image. """
+        background_image, background_mode = self.get_background(background_file)
+        output_image = background_image.copy()
+        PillowCompositor.blend_overlay(output_image, self.prepare_overlay(overlay_image, width, height), offset_x,
+                                       offset_y, gravity)
+        if background_mode in ['RGB', 'L']:
+            output_image = output_image.convert(background_mode)
+        return output_image
+
+    @staticmethod
+    def blend_overlay(output_image, overlay_image, offset_x=None, offset_y=None, gravity='center'):
+        """ Alpha blends the RGBA overlay image over the RGBA output image, in place. """
+        x, y = get_gravity_position(output_image.size, overlay_image.size, gravity, offset_x, offset_y)
+        # Clip the overlay to the background bounds
+        left, top = max(0, x), max(0, y)
+        right = min(output_image.size[0], x + overlay_image.size[0])
+        bottom = min(output_image.size[1], y + overlay_image.size[1])
+        if right > left and bottom > top:
+            output_image.alpha_composite(overlay_image, (left, top), (left - x, top - y, right - x, bottom - y))
+
+    def save_image(self, image, output_file):
+        """ Encodes the image to the output file, format given by its extension, with PNG compression settings. """
+        save_options = {}
+        if utils.is_png_file(output_file):
+            if self.png_compression_level is not None:
+                save_options['compress_level'] = self.png_compression_level
+            if self.png_strategy:
+                save_options['compress_type'] = PNG_STRATEGIES[self.png_strategy]
+        image.save(output_file, **save_options)
+
+    def overlay(self, background_file, overlay_file, output_file, width=None, height=None, offset_x=None,
+                offset_y=None, gravity='center'):
+        return self._overlay(background_file, overlay_file, overlay_file, output_file, width, height, offset_x,
+                             offset_y, gravity)
+
+    def overlay_data(self, background_file, overlay_png_data, output_file, width=None, height=None, offset_x=None,
+                     offset_y=None, gravity='center'):
+        return self._overlay(background_file, io.BytesIO(overlay_png_data), '<data>', output_file, width, height,
+                             offset_x, offset_y, gravity)
+
+    def overlay_batch(self, background_file, overlay_files, output_files, width=None, height=None, offset_x=None,
+                      offset_y=None, gravity='center'):
+        """ Overlays go through a pipeline of decode, compose and encode stages, each run by jobs_count threads
+        (Pillow releases the GIL while decoding and encoding): overlays are decoded while previous outputs are
+        encoded. """
+        chunk_size = self.get_chunk_size(len(overlay_files))
+        batches = [OverlayBatch(background_file, overlay_files[chunk_start:chunk_start + chunk_size],
+                                output_files[chunk_start:chunk_start + chunk_size], width, height, offset_x, offset_y,
+                                gravity)
+                   for chunk_start in range(0, len(overlay_files), chunk_size)]
+        stages = [PipelineStage('decode', self.decode_overlays, self.jobs_count),
+                  PipelineStage('compose', self.compose_overlays, self.jobs_count),
+                  PipelineStage('encode', self.encode_outputs, self.jobs_count)]
+        statuses = []
+        with open(self.LOG_FILENAME, 'a') as log_file:
+            for job_result in Pipeline(stages, self.jobs_count * 2).run(batches):
+                batch = job_result.job
+                for index, overlay_file in enumerate(batch.overlay_files):
+                    command_line = ('[' + self.NAME + '] ' + background_file + ' + ' + overlay_file + ' -> ' +
+                                    batch.output_files[index])
+                    if self.echo_commands:
+                        print(command_line)
+                    else:
+                        log_file.write(command_line + '\n')
+                    error = batch.errors[index] or (None if job_result.succeeded() else job_result.error)
+                    if error:
+                        log_file.write(error + '\n')
+                    statuses.append(1 if error else 0)
+        return statuses
+
+    def get_chunk_size(self, overlays_count):
+        """ Returns the count of overlays of each batch going through overlay_batch() pipeline. """
+        return 1
+
+    def decode_overlays(self, batch):
+        for index, overlay_file in enumerate(batch.overlay_files):
+            try:
+                batch.images[index] = self.load_overlay(overlay_file, batch.width, batch.height)
+            except Exception as err:
+                batch.errors[index] = 'Error decoding ' + overlay_file + ': ' + str(err)
+        return batch
+
+    def compose_overlays(self, batch):
+        for index, overlay_image in enumerate(batch.images):
+            if overlay_image is not None:
+                batch.images[index] = self.compose(batch.background_file, overlay_image, offset_x=batch.offset_x,
+                                                   offset_y=batch.offset_y, gravity=batch.gravity)
+        return batch
+
+    def encode_outputs(self, batch):
+        for index, output_image in enumerate(batch.images):
+            if output_image is not None:
+                try:
+                    self.save_image(output_image, batch.output_files[index])
+                except Exception as err:
+                    batch.errors[index] = 'Error composing ' + batch.output_files[index] + ': ' + str(err)
+                batch.images[index] = None
+        return batch
+
+    def _overlay(self, background_file, overlay_source, overlay_name, output_file, width, height, offset_x, offset_y,
+                 gravity):
+        command_line = '[' + self.NAME + '] ' + background_file + ' + ' + overlay_name + ' -> ' + output_file
+        with open(self.LOG_FILENAME, 'a') as log_file:
+            if self.echo_commands:
+                print(command_line)
+            else:
+                log_file.write(command_line + '\n')
+            try:
+                overlay_image = self.load_overlay(overlay_source, width, height)
+                output_image = self.compose(background_file, overlay_image, offset_x=offset_x, offset_y=offset_y,
+                                            gravity=gravity)
+                self.save_image(output_image, output_file)
+            except Exception as err:
+                log_file.write('Error composing ' + output_file + ': ' + str(err) + '\n')
+                return 1
+        return 0
+
+    def close(self):
+        with self.backgrounds_lock:
+            self.backgrounds.clear()
+
+
+class NumpyCompositor(PillowCompositor):
+    """ Overlays batches of bitmaps in-process, with NumPy.
+
+    overlay_batch() decodes overlays with Pillow, by batches of batch_size. Overlays of a batch with the same size (the
+    usual case once resized with width/height) are stacked in a single array, and alpha blended over the background
+    area in one vectorized Porter-Duff "over" operation. Single overlays are composed like PillowCompositor.
+    Requires Pillow and NumPy:
+        pip install Pillow numpy
+    """
+    NAME = 'numpy'
+    LOG_FILENAME = 'compose_bitmap_numpy.log'
+
+    def __init__(self):
+        PillowCompositor.__init__(self)
+        self.numpy_module = None
+        self.background_arrays = {}
+
+    def initialize(self):
+        if not self.initialized:
+            PillowCompositor.initialize(self)
+            if self.available:
+                try:
+                    import numpy
+                except ImportError:
+                    self.available = False
+                else:
+                    self.numpy_module = numpy
+                    self.about += '\nNumPy ' + numpy.__version__
+
+    def get_background_array(self, background_file):
+        """ Returns the decoded background as a float array of RGBA values in [0, 1]. """
+        background_image = self.get_background(background_file)[0]
+        with self.backgrounds_lock:
+            background_array = self.background_arrays.get(background_file)
+            if background_array is None:
+                background_array = self.numpy_module.asarray(background_image, self.numpy_module.float32) / 255
+                self.background_arrays[background_file] = background_array
+            return background_array
+
+    def compose_batch(self, background_file, overlay_images, offset_x=None, offset_y=None, gravity='center'):
+        """ Returns the composed images of RGBA overlay images, all of the same size. """
+        numpy = self.numpy_module
+        background_image, background_mode = self.get_background(background_file)
+        x, y = get_gravity_position(background_image.size, overlay_images[0].size, gravity, offset_x, offset_y)
+        left, top = max(0, x), max(0, y)
+        right = min(background_image.size[0], x + overlay_images[0].size[0])
+        bottom = min(background_image.size[1], y + overlay_images[0].size[1])
+        output_images = []
+        if right > left and bottom > top:
+            # (overlays count, height, width, RGBA) arrays, the background area being broadcast to all overlays
+            source = numpy.stack([numpy.asarray(overlay_image) for overlay_image in overlay_images])
+            source = source[:, top - y:bottom - y, left - x:right - x].astype(numpy.float32) / 255
+            destination = self.get_background_array(background_file)[top:bottom, left:right]
+            source_alpha = source[..., 3:]
+            destination_alpha = destination[..., 3:] * (1 - source_alpha)
+            output_alpha = source_alpha + destination_alpha
+            output_colors = source[..., :3] * source_alpha + destination[..., :3] * destination_alpha
+            # Fully transparent pixels keep the background colors, like Pillow alpha_composite
+            with numpy.errstate(divide='ignore', invalid='ignore'):
+                output_colors = numpy.where(output_alpha > 0, output_colors / output_alpha, destination[..., :3])
+            output = numpy.rint(numpy.concatenate([output_colors, output_alpha], -1) * 255).astype(numpy.uint8)
+            for output_area in output:
+                output_image = background_image.copy()
+                output_image.paste(self.image_module.fromarray(output_area, 'RGBA'), (left, top))
+                output_images.append(output_image)
+        else:
+            output_images = [background_image.copy() for overlay_image in overlay_images]
+        if background_mode in ['RGB', 'L']:
+            output_images = [output_image.convert(background_mode) for output_image in output_images]
+        return output_images
+
+    def get_chunk_size(self, overlays_count):
+        """ Batches hold up to batch_size overlays, fewer to share overlays among jobs_count workers. """
+        return max(1, min(self.batch_size, -(-overlays_count // max(1, self.jobs_count))))
+
+    def compose_overlays(self, batch):
+        indices_by_size = {}
+        for index, overlay_image in enumerate(batch.images):
+            if overlay_image is not None:
+                indices_by_size.setdefault(overlay_image.size, []).append(index)
+        for indices in indices_by_size.values():
+            output_images = self.compose_batch(batch.background_file, [batch.images[index] for index in indices],
+                                               batch.offset_x, batch.offset_y, batch.gravity)
+            for index, output_image in zip(indices, output_images):
+                batch.images[index] = output_image
+        return batch
+
+    def close(self):
+        PillowCompositor.close(self)
+        with self.backgrounds_lock:
+            self.background_arrays.clear()
+
+
+COMPOSITOR_CLASSES = {
+    'imagemagick': ImageMagickCompositor,
+    'numpy': NumpyCompositor,
+    'pillow': PillowCompositor,
+}
+# Compositors looked for when none is specified, by order of preference.
+DEFAULT_COMPOSITOR_NAMES = ['numpy', 'pillow', 'imagemagick']
+
+
+def get_compositor(compositor_name=None):
+    selected_compositor = None
+    if compositor_name:
+        compositor_class = COMPOSITOR_CLASSES.get(compositor_name)
+        if not compositor_class:
+            raise Exception('Unknown compositor backend ' + compositor_name)
+        selected_compositor = compositor_class()
+    else:
+        for default_compositor_name in DEFAULT_COMPOSITOR_NAMES:
+            compositor = COMPOSITOR_CLASSES[default_compositor_name]()
+            if compositor.is_available():
+                selected_compositor = compositor
+                break
+    if not selected_compositor or not selected_compositor.is_available():
+        raise Exception('No available compositor backend.')
+    return selected_compositor
+
+
+class BitmapCompositorGeometryTestCase(unittest.TestCase):
+    def test_formats_signed_offset_geometry(self):
+        self.assertEqual(get_offset_geometry(5, 3), '+5+3')
+        self.assertEqual(get_offset_geometry(-5, None), '-5+0')
+        self.assertEqual(get_offset_geometry(None, -3), '+0-3')
+
+    def test_resizes_to_fit_keeping_aspect_ratio(self):
+        self.assertEqual(get_resize_size(100, 50, 40, 40), (40, 20))
+        self.assertEqual(get_resize_size(100, 50, 200), (200, 100))
+        self.assertEqual(get_resize_size(100, 50, None, 10), (20, 10))
+        self.assertEqual(get_resize_size(100, 50), (100, 50))
+
+    def test_positions_overlay_with_gravity_and_offsets(self):
+        self.assertEqual(get_gravity_position((100, 80), (20, 10), 'center'), (40, 35))
+        self.assertEqual(get_gravity_position((100, 80), (20, 10), 'center', 5, -5), (45, 30))
+        self.assertEqual(get_gravity_position((100, 80), (20, 10), 'northwest', 5, 5), (5, 5))
+        self.assertEqual(get_gravity_position((100, 80), (20, 10), 'southeast', 5, 5), (75, 65))
+        self.assertEqual(get_gravity_position((100, 80), (20, 10), 'north', 0, 5), (40, 5))
+        self.assertEqual(get_gravity_position((100, 80), (21, 10), 'north'), (39, 0))
+        self.assertEqual(get_gravity_position((100, 80), (21, 10), 'north', exact=True), (39.5, 0))
+
+
+class PillowCompositorTestCase(unittest.TestCase):
+    def setUp(self):
+        self.compositor = PillowCompositor()
+        if not self.compositor.is_available():
+            self.skipTest('Pillow is not installed')
+        self.image_module = self.compositor.image_module
+
+    def test_alpha_blends_clipped_overlay_over_background(self):
+        background_file = io.BytesIO()
+        self.image_module.new('RGB', (4, 4), (0, 0, 255)).save(background_file, 'PNG')
+        background_file.seek(0)
+        with self.compositor.backgrounds_lock:
+            self.compositor.backgrounds['background'] = (self.image_module.open(background_file).convert('RGBA'),
+                                                         'RGB')
+        overlay_image = self.image_module.new('RGBA', (2, 2), (255, 0, 0, 128))
+        output_image = self.compositor.compose('background', overlay_image, offset_x=2, gravity='southeast')
+        self.assertEqual(output_image.mode, 'RGB')
+        self.assertEqual(output_image.getpixel((0, 3)), (128, 0, 127))
+        self.assertEqual(output_image.getpixel((3, 0)), (0, 0, 255))
+        self.assertEqual(output_image.getpixel((1, 1)), (0, 0, 255))
+
+    def test_loads_resized_overlays_from_resize_cache(self):
+        overlay_fd, overlay_file = tempfile.mkstemp(suffix='.png')
+        os.close(overlay_fd)
+        try:
+            self.image_module.new('RGBA', (8, 4), (255, 0, 0, 255)).save(overlay_file)
+            self.compositor.resize_cache = ResizeCache()
+            overlay_image = self.compositor.load_overlay(overlay_file, 4, 4)
+            self.assertEqual(overlay_image.size, (4, 2))
+            self.assertIs(self.compositor.load_overlay(overlay_file, 4, 4), overlay_image)
+            self.assertIsNot(self.compositor.load_overlay(overlay_file, 2, 2), overlay_image)
+        finally:
+            os.remove(overlay_file)
+
+
+class NumpyCompositorTestCase(unittest.TestCase):
+    def setUp(self):
+        self.compositor = NumpyCompositor()
+        if not self.compositor.is_available():
+            self.skipTest('Pillow or NumPy is not installed')
+        self.image_module = self.compositor.image_module
+        background_image = self.image_module.new('RGBA', (6, 5), (0, 0, 255, 255))
+        background_image.putpixel((0, 0), (0, 255, 0, 0))
+        with self.compositor.backgrounds_lock:
+            self.compositor.backgrounds['background'] = (background_image, 'RGBA')
+
+    def test_composes_batch_like_single_overlays(self):
+        overlay_images = [self.image_module.new('RGBA', (3, 2), color)
+                          for color in [(255, 0, 0, 128), (10, 200, 30, 255), (255, 255, 255, 0)]]
+        overlay_images[0].putpixel((1, 1), (40, 80, 120, 200))
+        for gravity, offset_x, offset_y in [('center', 0, 0), ('northwest', -1, 0), ('southeast', -1, -1)]:
+            output_images = self.compositor.compose_batch('background', overlay_images, offset_x, offset_y, gravity)
+            for overlay_image, output_image in zip(overlay_images, output_images):
+                expected_image = self.compositor.compose('background', overlay_image, offset_x=offset_x,
+                                                         offset_y=offset_y, gravity=gravity)
+                for pixel, expected_pixel in zip(output_image.getdata(), expected_image.getdata()):
+                    for value, expected_value in zip(pixel, expected_pixel):
+                        self.assertLessEqual(abs(value - expected_value), 1)
+
+    def test_keeps_background_of_overlays_out_of_bounds(self):
+        overlay_images = [self.image_module.new('RGBA', (2, 2), (255, 0, 0, 255))]
+        output_images = self.compositor.compose_batch('background', overlay_images, 10, 0, 'northwest')
+        background_image = self.compositor.get_background('background')[0]
+        self.assertEqual(list(output_images[0].getdata()), list(background_image.getdata()))
+
+
+class OverlayBatchTestCase(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_overlays_files_in_parallel_pipeline(self):
+        for compositor in [PillowCompositor(), NumpyCompositor()]:
+            if not compositor.is_available():
+                continue
+            image_module = compositor.image_module
+            background_file = os.path.join(self.directory, 'background.png')
+            image_module.new('RGB', (8, 8), (0, 0, 255)).save(background_file)
+            overlay_files = []
+            for index in range(5):
+                overlay_files.append(os.path.join(self.directory, str(index) + '.png'))
+                image_module.new('RGBA', (4 + index % 2 * 4, 4), (255, 0, 0, 255)).save(overlay_files[-1])
+            with open(overlay_files[2], 'w') as invalid_file:
+                invalid_file.write('not a bitmap')
+            output_files = [os.path.join(self.directory, 'out_' + str(index) + '.png') for index in range(5)]
+            compositor.echo_commands = False
+            compositor.jobs_count = 2
+            compositor.batch_size = 2
+            compositor.png_compression_level = 1
+            compositor.png_strategy = 'rle'
+            try:
+                statuses = compositor.overlay_batch(background_file, overlay_files, output_files, 4, 4, 1, 1,
+                                                    'northwest')
+            finally:
+                compositor.close()
+                os.remove(compositor.LOG_FILENAME)
+            self.assertEqual(statuses, [0, 0, 1, 0, 0])
+            output_image = image_module.open(output_files[1])
+            self.assertEqual(output_image.mode, 'RGB')
+            self.assertEqual(output_image.getpixel((1, 2)), (255, 0, 0))
+            self.assertEqual(output_image.getpixel((1, 3)), (0, 0, 255))
+            self.assertFalse(os.path.exists(output_files[2]))
+
+    def test_sets_imagemagick_png_compression(self):
+        command_args = ImageMagickCompositor.get_command_args('background.png', 'overlay.png', 'output.png',
+                                                              png_compression_level=3, png_strategy='filtered')
+        self.assertEqual(command_args[-5:], ['-define', 'png:compression-level=3', '-define',
+                                             'png:compression-strategy=1', 'output.png'])
+
+
+if __name__ == '__main__':
+    unittest.main(exit=False)
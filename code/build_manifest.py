@@ -0,0 +1,213 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+import json
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+
+import file_utils as utils
+from render_cache import get_file_digest
+
+
+def normalize_recipe(recipe):
+    """ Returns the recipe as read back from JSON (unicode strings, lists instead of tuples), for comparisons. """
+    return json.loads(json.dumps(recipe, sort_keys=True))
+
+
+class BuildTarget:
+    """ An output file built from source files, by a recipe: a JSON serializable dict of everything else the output
+    depends on (rules digest, size, density configuration, renderer version...). """
+
+    def __init__(self, output_file, source_files, recipe=None):
+        self.output_file = output_file
+        self.source_files = source_files
+        self.recipe = recipe or {}
+        # Digests of source files when planned, recorded once built
+        self.source_digests = None
+
+    def __repr__(self):
+        return '[BuildTarget]\t' + ', '.join(self.source_files) + ' -> ' + self.output_file
+
+
+class BuildManifest:
+    """ Record of the outputs of a stage, and of the inputs each one was built from, kept in the stage output directory.
+
+The manifest maps each output file (path relative to the output directory) to its source files (absolute paths), their
+content digests and the target recipe. A target is up to date if its output is there and was built from the same
+source contents by the same recipe (see plan_build). Source digests are computed again only for sources whose
+modification time or size changed since recorded.
+Outputs recorded in the manifest whose sources disappeared are orphans, that remove_orphaned_outputs() deletes.
+"""
+    VERSION = 1
+
+    def __init__(self, output_dir, stage_name):
+        self.output_dir = output_dir
+        self.stage_name = stage_name
+        self.manifest_file = os.path.join(output_dir, '.' + stage_name + '_manifest.json')
+        self.sources = {}
+        self.outputs = {}
+        self.lock = threading.RLock()
+        self.load()
+
+    def load(self):
+        if not os.path.isfile(self.manifest_file):
+            return
+        try:
+            with open(self.manifest_file) as manifest_file:
+                manifest_json = json.load(manifest_file)
+        except ValueError as err:
+            utils.print_warning('Ignoring invalid build manifest ' + self.manifest_file + ': ' + str(err))
+            return
+        if manifest_json.get('stage') != self.stage_name or manifest_json.get('version') != BuildManifest.VERSION:
+            return
+        self.sources = manifest_json.get('sources', {})
+        self.outputs = manifest_json.get('outputs', {})
+
+    def save(self):
+        """ Writes the manifest, replacing the previous one at once. """
+        with self.lock:
+            referenced_sources = set()
+            for output_entry in self.outputs.values():
+                referenced_sources.update(output_entry['sources'])
+            manifest_json = {'stage': self.stage_name, 'version': BuildManifest.VERSION,
+                             'sources': dict((source_path, source_state) for source_path, source_state in
+                                             self.sources.items() if source_path in referenced_sources),
+                             'outputs': self.outputs}
+            temporary_fd, temporary_file = tempfile.mkstemp(dir=self.output_dir, suffix='.tmp')
+            with os.fdopen(temporary_fd, 'w') as manifest_file:
+                json.dump(manifest_json, manifest_file, indent=1, sort_keys=True)
+            os.rename(temporary_file, self.manifest_file)
+
+    def get_output_key(self, output_file):
+        return os.path.relpath(output_file, self.output_dir).replace(os.sep, '/')
+
+    def get_source_digest(self, source_file):
+        """ Returns the source file content digest, or None if the file is missing. """
+        source_path = os.path.abspath(source_file)
+        try:
+            source_stat = os.stat(source_path)
+        except OSError:
+            return None
+        with self.lock:
+            source_state = self.sources.get(source_path)
+            if source_state and source_state['mtime'] == source_stat.st_mtime \
+                    and source_state['size'] == source_stat.st_size:
+                return source_state['digest']
+        digest = get_file_digest(source_path)
+        with self.lock:
+            self.sources[source_path] = {'digest': digest, 'mtime': source_stat.st_mtime, 'size': source_stat.st_size}
+        return digest
+
+    def is_up_to_date(self, target):
+        """ Checks if the target output was built from current sources by the same recipe, and is still there (or
+        was not written, see record()). Source digests are kept in the target, for record(). """
+        target.source_digests = [self.get_source_digest(source_file) for source_file in target.source_files]
+        with self.lock:
+            output_entry = self.outputs.get(self.get_output_key(target.output_file))
+        if output_entry is None or None in target.source_digests:
+            return False
+        return output_entry['sources'] == [os.path.abspath(source_file) for source_file in target.source_files] \
+            and output_entry['digests'] == target.source_digests \
+            and output_entry['recipe'] == normalize_recipe(target.recipe) \
+            and output_entry.get('written', True) == os.path.isfile(target.output_file)
+
+    def record(self, target, written=True):
+        """ Records a target built from its sources, as planned. written is False for targets built without writing
+        their output (unchanged files skipped by the style stage, for instance). """
+        source_digests = target.source_digests
+        if source_digests is None:
+            source_digests = [self.get_source_digest(source_file) for source_file in target.source_files]
+        output_entry = {'sources': [os.path.abspath(source_file) for source_file in target.source_files],
+                        'digests': source_digests, 'recipe': normalize_recipe(target.recipe)}
+        if not written:
+            output_entry['written'] = False
+        with self.lock:
+            self.outputs[self.get_output_key(target.output_file)] = output_entry
+
+    def forget(self, output_file):
+        with self.lock:
+            self.outputs.pop(self.get_output_key(output_file), None)
+
+    def get_orphaned_outputs(self, kept_output_files=()):
+        """ Returns the output files recorded in the manifest with a missing source, except kept_output_files. """
+        kept_keys = set(self.get_output_key(output_file) for output_file in kept_output_files)
+        with self.lock:
+            output_entries = list(self.outputs.items())
+        orphaned_outputs = []
+        for output_key, output_entry in sorted(output_entries):
+            if output_key not in kept_keys and not all(os.path.isfile(source_path) for source_path in
+                                                         output_entry['sources']):
+                orphaned_outputs.append(os.path.join(self.output_dir, *output_key.split('/')))
+        return orphaned_outputs
+
+    def remove_orphaned_outputs(self, kept_output_files=()):
+        """ Deletes orphaned outputs (see get_orphaned_outputs) and forgets them. Returns the list of deleted files. """
+        orphaned_outputs = self.get_orphaned_outputs(kept_output_files)
+        for output_file in orphaned_outputs:
+            if os.path.isfile(output_file):
+                os.remove(output_file)
+            self.forget(output_file)
+        return orphaned_outputs
+
+
+def plan_build(manifest, targets, force=False):
+    """ Returns the targets to build, like make: targets that are not up to date in the manifest (see
+    BuildManifest.is_up_to_date), or all targets if force. """
+    if force:
+        return list(targets)
+    return [target for target in targets if not manifest.is_up_to_date(target)]
+
+
+class BuildManifestTestCase(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.output_dir = os.path.join(self.directory, 'output')
+        os.mkdir(self.output_dir)
+        self.source_file = os.path.join(self.directory, 'icon.svg')
+        self.write_file(self.source_file, '<svg/>')
+        self.output_file = os.path.join(self.output_dir, 'icon.png')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def write_file(self, file_path, content):
+        with open(file_path, 'w') as output_file:
+            output_file.write(content)
+
+    def build(self, manifest, targets):
+        for target in plan_build(manifest, targets):
+            self.write_file(target.output_file, 'png')
+            manifest.record(target)
+        manifest.save()
+
+    def get_target(self, width=10):
+        return BuildTarget(self.output_file, [self.source_file], {'width': width, 'renderer': 'renderer 1.0'})
+
+    def test_plans_targets_missing_or_built_from_other_inputs(self):
+        self.build(BuildManifest(self.output_dir, 'test'), [self.get_target()])
+        manifest = BuildManifest(self.output_dir, 'test')
+        self.assertEqual(plan_build(manifest, [self.get_target()]), [])
+        self.assertEqual(len(plan_build(manifest, [self.get_target()], force=True)), 1)
+        self.assertEqual(len(plan_build(manifest, [self.get_target(20)])), 1)
+        self.assertEqual(len(plan_build(BuildManifest(self.output_dir, 'other stage'), [self.get_target()])), 1)
+        self.write_file(self.source_file, '<svg width="10"/>')
+        self.assertEqual(len(plan_build(manifest, [self.get_target()])), 1)
+        self.write_file(self.source_file, '<svg/>')
+        self.assertEqual(plan_build(manifest, [self.get_target()]), [])
+        os.remove(self.output_file)
+        self.assertEqual(len(plan_build(manifest, [self.get_target()])), 1)
+
+    def test_removes_outputs_of_missing_sources(self):
+        manifest = BuildManifest(self.output_dir, 'test')
+        self.build(manifest, [self.get_target()])
+        self.assertEqual(manifest.remove_orphaned_outputs(), [])
+        os.remove(self.source_file)
+        self.assertEqual(manifest.remove_orphaned_outputs(), [self.output_file])
+        self.assertFalse(os.path.exists(self.output_file))
+        self.assertEqual(manifest.outputs, {})
+
+
+if __name__ == '__main__':
+    unittest.main(exit=False)
@@ -4,13 +4,14 @@ import os
 import re
 import unittest
 
-from ConfigParser import SafeConfigParser
-
 
 COLOR_NAMES_CONFIG_FILE = os.path.join(os.path.dirname(__file__), 'color_names.cfg')
+COLOR_NAMES_MODULE_FILE = os.path.join(os.path.dirname(__file__), 'color_names.py')
+_color_names = None
 
 
 def parse_color_names_config_file():
+    from ConfigParser import SafeConfigParser
     color_names_parser = SafeConfigParser()
     color_names_parser.read(COLOR_NAMES_CONFIG_FILE)
     color_names_dict = {}
@@ -19,7 +20,37 @@ def parse_color_names_config_file():
     return color_names_dict
 
 
-COLOR_NAMES_DICT = parse_color_names_config_file()
+def compile_color_names(color_names_dict):
+    """ Returns the {color name: packed 0xRRGGBB value} table of a {color name: color string} dict. """
+    return dict((name, parse_color_value(value)) for name, value in color_names_dict.items())
+
+
+def get_color_names():
+    """ Returns the {color name: packed 0xRRGGBB value} table, loaded on first use only: from the color_names module,
+    compiled from color_names.cfg (see write_color_names_module), or from color_names.cfg itself if the module is
+    missing. """
+    global _color_names
+    if _color_names is None:
+        try:
+            from color_names import COLOR_NAMES
+        except ImportError:
+            COLOR_NAMES = compile_color_names(parse_color_names_config_file())
+        _color_names = COLOR_NAMES
+    return _color_names
+
+
+def write_color_names_module(module_file=COLOR_NAMES_MODULE_FILE):
+    """ Compiles color_names.cfg into a Python module, imported instead of parsing the config file. Must be run again
+    after color_names.cfg changes. """
+    color_names = compile_color_names(parse_color_names_config_file())
+    with open(module_file, 'w') as output_file:
+        output_file.write('# -*- coding: utf-8 -*-\n')
+        output_file.write('# Compiled from color_names.cfg by update_color_names.py, do not edit.\n')
+        output_file.write('COLOR_NAMES = {\n')
+        for name in sorted(color_names):
+            output_file.write("    '" + name + "': 0x{:06X},\n".format(color_names[name]))
+        output_file.write('}\n')
+
 # TODO: handle two disctinct files, one for CSS standard color names that could be written directly in SVG
 # and one for user-defined custom color names, that should be replaced with their HEX or rgb values
 # TODO; use a SVG file to allow visualising color and names instead of a config file, and parse it with minidom
@@ -51,54 +82,125 @@ TODO: handle alpha ?
 """
 
 
+class Color(object):
+    """Immutable RGB color, packed in a single 0xRRGGBB integer.
+
+Colors are interned (see get_color): a given color is a single instance, whatever the string it was parsed from, so
+that colors are compared and hashed as cheaply as integers.
+"""
+    __slots__ = ['value']
+
+    def __init__(self, value):
+        object.__setattr__(self, 'value', value)
+
+    def __setattr__(self, name, value):
+        raise AttributeError('Color is immutable')
+
+    @property
+    def r(self):
+        return self.value >> 16
+
+    @property
+    def g(self):
+        return (self.value >> 8) & 0xff
+
+    @property
+    def b(self):
+        return self.value & 0xff
+
+    def __eq__(self, other):
+        return isinstance(other, Color) and other.value == self.value
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash(self.value)
+
+    def __repr__(self):
+        return 'Color(0x{:06X})'.format(self.value)
+
+    def __str__(self):
+        return '#{:06X}'.format(self.value)
+
+
+COLOR_REGEX_HEXADECIMAL_6_DIGITS = re.compile('^#[0-9a-fA-F]{6}$')
+COLOR_REGEX_HEXADECIMAL_3_DIGITS = re.compile('^#[0-9a-fA-F]{3}$')
+COLOR_REGEX_RGB_INTEGER_CSS = re.compile('^rgb\(\s*[0-9]{1,3}\s*,\s*[0-9]{1,3}\s*,\s*[0-9]{1,3}\s*\)$')
+# Maximum number of color strings kept by parse_color
+PARSED_COLORS_MAX_COUNT = 4096
+_colors_by_value = {}
+_parsed_colors = {}
+
+
+def get_color(value):
+    """ Returns the interned Color of a packed 0xRRGGBB value. """
+    color = _colors_by_value.get(value)
+    if color is None:
+        color = _colors_by_value.setdefault(value, Color(value))
+    return color
+
+
+def parse_color_value(color_string):
+    """ Returns the packed 0xRRGGBB value of a CSS color string: "#FF0000", "#f00", "rgb(255, 0, 0)" or a color name
+    like "red" (case insensitive). Raises ColorStringFormatError if the string is not a valid color. """
+    color_string = color_string.strip()
+    if color_string.startswith('#'):
+        if COLOR_REGEX_HEXADECIMAL_6_DIGITS.match(color_string):
+            return int(color_string[1:], 16)
+        if COLOR_REGEX_HEXADECIMAL_3_DIGITS.match(color_string):
+            r, g, b = (int(digit, 16) * 17 for digit in color_string[1:])
+            return (r << 16) | (g << 8) | b
+        raise ColorStringFormatError(color_string, 'Hexadecimal format requires characters in [0-9] or [a-f].')
+    if COLOR_REGEX_RGB_INTEGER_CSS.match(color_string):
+        r, g, b = (int(value.strip()) for value in color_string[4:-1].split(','))
+        if r > 255 or g > 255 or b > 255:
+            raise ColorStringFormatError(color_string, 'RGB values should be in range [0, 255].')
+        return (r << 16) | (g << 8) | b
+    # Names last, so that the color names table is only loaded for names
+    value = get_color_names().get(color_string.lower())
+    if value is None:
+        raise ColorStringFormatError(color_string)
+    return value
+
+
+def parse_color(color_string):
+    """ Returns the interned Color of a CSS color string (see parse_color_value), or None if the string is not a color
+    ("none", "url(#gradient)"...). Results are cached by string: a string is parsed once. """
+    try:
+        return _parsed_colors[color_string]
+    except KeyError:
+        pass
+    try:
+        color = get_color(parse_color_value(color_string))
+    except ColorStringFormatError:
+        color = None
+    if len(_parsed_colors) >= PARSED_COLORS_MAX_COUNT:
+        _parsed_colors.clear()
+    _parsed_colors[color_string] = color
+    return color
+
+
 class ColorString:
     """Color class parsing CSS color strings.
 
 - Hexadecimal format with 6 or 3 digits: #FFFFFF, #f0f.
 - RGB format with [0-255] values: rgb(255,255,255).
-Access RGB integer values through members: color.r, color.g, color.b.
+- Color names: red (see color_names.cfg).
+Access RGB integer values through members: color.r, color.g, color.b, and the interned Color through color.color.
 """
-    COLOR_REGEX_HEXADECIMAL_6_DIGITS = re.compile('^#[a-f|A-F|0-9]{6}$')
-    COLOR_REGEX_HEXADECIMAL_3_DIGITS = re.compile('^#[a-f|A-F|0-9]{3}$')
-    COLOR_REGEX_RGB_INTEGER_CSS = re.compile('^rgb\(\s*[0-9]{1,3}\s*,\s*[0-9]{1,3}\s*,\s*[0-9]{1,3}\s*\)$')
 
     def __init__(self, color_string):
-        self.r = None
-        self.g = None
-        self.b = None
         if not color_string:
             raise Exception('No or empty color string provided.')
-        if color_string in COLOR_NAMES_DICT:
-            color_string = COLOR_NAMES_DICT[color_string]
-        if color_string.startswith('#'):
-            if ColorString.COLOR_REGEX_HEXADECIMAL_6_DIGITS.match(color_string):
-                self._parse_hexadecimal_six_digits(color_string)
-            elif ColorString.COLOR_REGEX_HEXADECIMAL_3_DIGITS.match(color_string):
-                self._parse_hexadecimal_three_digits(color_string)
-            else:
-                raise ColorStringFormatError(color_string, 'Hexadecimal format requires characters in [0-9] or [a-f].')
-        elif ColorString.COLOR_REGEX_RGB_INTEGER_CSS.match(color_string):
-            self._parse_rgb_integer_css(color_string)
-        else:
-            raise ColorStringFormatError(color_string)
-
-    def _parse_hexadecimal_six_digits(self, color_string):
-        hex_value = color_string.lstrip('#')
-        self.r, self.g, self.b = (int(hex_value[i:i + 2], 16) for i in range(0, 6, 2))
-
-    def _parse_hexadecimal_three_digits(self, color_string):
-        hex_value = color_string.lstrip('#')
-        self.r, self.g, self.b = (int(hex_value[i:i + 1], 16) * 17 for i in range(0, 3))
-
-    def _parse_rgb_integer_css(self, color_string):
-        rgb_values = color_string.lstrip('rgb(').rstrip(')').split(',')
-        r, g, b = (int(value.strip()) for value in rgb_values)
-        if r < 0 or g < 0 or b < 0 or r > 255 or g > 255 or b > 255:
-            raise ColorStringFormatError(color_string, 'RGB values should be in range [0, 255].')
-        self.r, self.g, self.b = r, g, b
+        self.color = parse_color(color_string)
+        if self.color is None:
+            # Not cached: parse again for a detailed error
+            parse_color_value(color_string)
+        self.r, self.g, self.b = self.color.r, self.color.g, self.color.b
 
     def __str__(self):
-        return '#{:02X}{:02X}{:02X}'.format(self.r, self.g, self.b)
+        return str(self.color)
 
 
 class ColorStringFormatError(Exception):
@@ -134,12 +236,33 @@ class ColorStringTestCase(unittest.TestCase):
         with self.assertRaises(ColorStringFormatError):
             ColorString('#gghhii')
 
+    def test_does_not_parse_malformed_hexadecimal_values(self):
+        for color_string in ['#a|b', '#AAAAA|', '#|||']:
+            self.assertIsNone(parse_color(color_string))
+            with self.assertRaises(ColorStringFormatError):
+                ColorString(color_string)
+
     def test_raises_ColorStringFormatError_on_out_of_bounds_RGB_values(self):
         with self.assertRaises(ColorStringFormatError):
             ColorString('rgb(0,255,256)')
         with self.assertRaises(ColorStringFormatError):
             ColorString('rgb(0,255,-1)')
 
+    def test_interns_colors_parsed_from_any_format(self):
+        color = parse_color('#ff0000')
+        self.assertEqual(color.value, 0xff0000)
+        for color_string in ['#F00', 'rgb(255, 0, 0)', 'Red', ' red']:
+            self.assertIs(parse_color(color_string), color)
+        self.assertIs(ColorString('#f00').color, color)
+        self.assertIsNone(parse_color('none'))
+        self.assertIsNone(parse_color('url(#gradient)'))
+        with self.assertRaises(AttributeError):
+            color.value = 0
+
+    def test_compiled_color_names_module_is_up_to_date(self):
+        from color_names import COLOR_NAMES
+        self.assertEqual(COLOR_NAMES, compile_color_names(parse_color_names_config_file()))
+
     def test_builds_hexadecimal_from_any_format(self):
         self.assertEquals('#0000FF', str(ColorString('#0000ff')))
         self.assertEquals('#0000FF', str(ColorString('#00f')))
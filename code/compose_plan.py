@@ -0,0 +1,390 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+import itertools
+import json
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+
+import file_utils as utils
+from bitmap_compositor import GRAVITIES, PillowCompositor
+from density_converter import ConfigFileFormatError, DensityConverter, DensityOutputConfig
+from pipeline import Pipeline, PipelineStage
+from resize_cache import ResizeCache
+
+
+class ComposeLayerGeometry:
+    """ Size and position of a layer bitmaps: resized to fit in width x height if any, and positioned by gravity and
+    offsets (see get_gravity_position). """
+    # JSON keys of geometry values converted between densities
+    LENGTH_KEYS = ['width', 'height', 'x', 'y']
+
+    def __init__(self, width=None, height=None, offset_x=None, offset_y=None, gravity='center'):
+        self.width = width
+        self.height = height
+        self.offset_x = offset_x
+        self.offset_y = offset_y
+        self.gravity = gravity
+
+    @classmethod
+    def from_json(cls, geometry_json):
+        gravity = geometry_json.get('gravity', 'center')
+        if gravity not in GRAVITIES:
+            raise ConfigFileFormatError('Invalid "gravity" value, should be in ' + str(GRAVITIES) + '.\nJSON '
+                                        + json.dumps(geometry_json))
+        return cls(geometry_json.get('width'), geometry_json.get('height'), geometry_json.get('x'),
+                   geometry_json.get('y'), gravity)
+
+    def __repr__(self):
+        return '[ComposeLayerGeometry]\t' + str(self.width) + '\t' + str(self.height) + '\t' + str(self.offset_x) \
+               + '\t' + str(self.offset_y) + '\t' + self.gravity
+
+
+class ComposeLayer:
+    """ Bitmaps overlaid at a same level of the outputs: a single bitmap (a badge), or a directory of bitmaps, each one
+    overlaid in separate outputs (icons).
+    Geometry values are given at the plan reference density and converted to other densities, unless set for a
+    density in "densities". """
+
+    def __init__(self, name, input_path, geometry, geometry_json_by_density=None):
+        self.name = name
+        self.input_path = input_path
+        self.geometry = geometry
+        self.geometry_json_by_density = geometry_json_by_density or {}
+
+    @classmethod
+    def from_json(cls, layer_json, base_dir):
+        name = layer_json.get('name')
+        if not name:
+            raise ConfigFileFormatError('Missing required "name" parameter.\nJSON ' + json.dumps(layer_json))
+        if '{' + name + '}' in [ComposePlan.BACKGROUND_KEY, ComposePlan.DENSITY_KEY]:
+            raise ConfigFileFormatError('Reserved layer name "' + name + '".\nJSON ' + json.dumps(layer_json))
+        input_path = layer_json.get('input')
+        if not input_path:
+            raise ConfigFileFormatError('Missing required "input" parameter.\nJSON ' + json.dumps(layer_json))
+        geometry_json_by_density = layer_json.get('densities', {})
+        for geometry_json in geometry_json_by_density.values():
+            ComposeLayerGeometry.from_json(geometry_json)
+        return cls(name, os.path.join(base_dir, input_path), ComposeLayerGeometry.from_json(layer_json),
+                   geometry_json_by_density)
+
+    def get_geometry(self, density=None, reference_density=None):
+        """ Returns the layer geometry in the density (a DensityOutputConfig). """
+        if not density:
+            return self.geometry
+        geometry_json = self.geometry_json_by_density.get(density.name, {})
+        lengths = [self.geometry.width, self.geometry.height, self.geometry.offset_x, self.geometry.offset_y]
+        converted_lengths = []
+        for length_key, length in zip(ComposeLayerGeometry.LENGTH_KEYS, lengths):
+            if length_key in geometry_json:
+                converted_lengths.append(geometry_json[length_key])
+            else:
+                converted_lengths.append(DensityConverter.convert(length, reference_density.scale, density.scale))
+        return ComposeLayerGeometry(*converted_lengths, gravity=geometry_json.get('gravity', self.geometry.gravity))
+
+    def get_files(self, density=None):
+        """ Returns the layer bitmap files, in the density if any. """
+        input_path = ComposePlan.replace_density_key(self.input_path, density)
+        if not os.path.exists(input_path):
+            raise Exception('Invalid input file or directory "' + input_path + '" of layer ' + self.name)
+        return sorted(utils.get_file_paths(input_path, utils.is_bitmap_file), key=lambda file_path: file_path.lower())
+
+
+class ComposeJob:
+    """ An output of a compose plan: a background and the bitmaps overlaid over it, with their geometry. """
+
+    def __init__(self, output_file, background_file, overlays):
+        self.output_file = output_file
+        self.background_file = background_file
+        # List of (bitmap file, ComposeLayerGeometry), from bottom to top
+        self.overlays = overlays
+        self.output_image = None
+
+    def __repr__(self):
+        return '[ComposeJob]\t' + self.output_file
+
+
+class ComposePlan:
+    """ Declarative composition of several backgrounds and layers in several densities, loaded from a JSON file:
+        {
+          "backgrounds": ["backgrounds/{DENSITY}/blue.png", "backgrounds/{DENSITY}/red.png"],
+          "layers": [
+            {"name": "icon", "input": "icons/{DENSITY}", "width": 24, "height": 24},
+            {"name": "badge", "input": "badge.png", "gravity": "northeast", "x": 2, "y": 2,
+             "densities": {"ldpi": {"x": 1, "y": 1}}}
+          ],
+          "reference_density": "mdpi",
+          "output": "{BACKGROUND}/drawable-{DENSITY}/{icon}.png"
+        }
+
+An output is composed for each density, background, and combination of layer bitmaps (each bitmap of a layer
+directory), layers overlaid in listed order. Output paths replace {BACKGROUND}, {DENSITY} and {LAYER_NAME} keys with
+the background name, density name and layer bitmap name (without extensions).
+With "reference_density", densities (all the densities config ones, or the ones listed in "densities") scale layers
+geometry. Input paths are relative to the plan file directory, and may hold the {DENSITY} key.
+"""
+    BACKGROUND_KEY = '{BACKGROUND}'
+    DENSITY_KEY = DensityOutputConfig.DENSITY_KEY
+
+    def __init__(self, backgrounds, layers, output_pattern, densities=None, reference_density=None):
+        self.backgrounds = backgrounds
+        self.layers = layers
+        self.output_pattern = output_pattern
+        self.densities = densities or []
+        self.reference_density = reference_density
+
+    @classmethod
+    def from_json_file(cls, plan_file, densities_config_file=None):
+        with open(plan_file) as plan_json_file:
+            plan_json = json.load(plan_json_file)
+        base_dir = os.path.dirname(os.path.abspath(plan_file))
+        backgrounds = [os.path.join(base_dir, background) for background in plan_json.get('backgrounds', [])]
+        if not backgrounds:
+            raise ConfigFileFormatError('Missing required "backgrounds" parameter.\nJSON ' + json.dumps(plan_json))
+        layers = [ComposeLayer.from_json(layer_json, base_dir) for layer_json in plan_json.get('layers', [])]
+        output_pattern = plan_json.get('output')
+        if not output_pattern:
+            raise ConfigFileFormatError('Missing required "output" parameter.\nJSON ' + json.dumps(plan_json))
+        densities = []
+        reference_density = None
+        if plan_json.get('reference_density'):
+            density_converter = DensityConverter(densities_config_file) if densities_config_file \
+                else DensityConverter.get_instance()
+            reference_density = density_converter.get_density(plan_json['reference_density'])
+            densities = [density_converter.get_density(density_name)
+                         for density_name in plan_json.get('densities', density_converter.get_density_names())]
+        elif any(ComposePlan.DENSITY_KEY in path for path in
+                 backgrounds + [layer.input_path for layer in layers] + [output_pattern]):
+            raise ConfigFileFormatError('"' + ComposePlan.DENSITY_KEY + '" key used without "reference_density".'
+                                        + '\nJSON ' + json.dumps(plan_json))
+        return cls(backgrounds, layers, output_pattern, densities, reference_density)
+
+    @staticmethod
+    def replace_density_key(path, density=None):
+        return path.replace(ComposePlan.DENSITY_KEY, density.name) if density else path
+
+    @staticmethod
+    def get_file_name(file_path):
+        return os.path.splitext(os.path.basename(file_path))[0]
+
+    def get_jobs(self, output_dir):
+        """ Returns the ComposeJob of each output, and creates their output directories. """
+        jobs = []
+        output_files = set()
+        for density in self.densities or [None]:
+            layer_overlays = []
+            for layer in self.layers:
+                layer_files = layer.get_files(density)
+                if not layer_files:
+                    raise Exception('No bitmap found for layer ' + layer.name + ' in "' + layer.input_path + '"')
+                layer_geometry = layer.get_geometry(density, self.reference_density)
+                layer_overlays.append([(layer, layer_file, layer_geometry) for layer_file in layer_files])
+            for background in self.backgrounds:
+                background_file = ComposePlan.replace_density_key(background, density)
+                if not os.path.exists(background_file):
+                    raise Exception('Invalid background image "' + background_file + '"')
+                for overlays in itertools.product(*layer_overlays):
+                    output_path = self.output_pattern.replace(ComposePlan.BACKGROUND_KEY,
+                                                              ComposePlan.get_file_name(background_file))
+                    output_path = ComposePlan.replace_density_key(output_path, density)
+                    for layer, layer_file, layer_geometry in overlays:
+                        output_path = output_path.replace('{' + layer.name + '}', ComposePlan.get_file_name(layer_file))
+                    output_file = os.path.normpath(os.path.join(output_dir, output_path))
+                    if output_file in output_files:
+                        raise Exception('Output pattern "' + self.output_pattern + '" gives the same output file '
+                                        + output_file + ' to several compositions')
+                    output_files.add(output_file)
+                    jobs.append(ComposeJob(output_file, background_file,
+                                           [(layer_file, layer_geometry) for layer, layer_file, layer_geometry
+                                            in overlays]))
+        for output_sub_dir in set(os.path.dirname(output_file) for output_file in output_files):
+            if not os.path.isdir(output_sub_dir):
+                os.makedirs(output_sub_dir)
+        return jobs
+
+
+class ComposePlanScheduler:
+    """ Runs compose jobs with an in-process compositor (see PillowCompositor).
+
+Backgrounds are decoded once, whatever the number of jobs using them, and cached until close(). Layer bitmaps are
+decoded once as long as they stay in a bounded in-memory ResizeCache, so that large layer directories are not held in
+memory at once. Resized overlays are cached in the compositor resize cache (a bounded in-memory ResizeCache if it has
+none): overlays are resized once per size, as long as they stay in the cache. Each overlay file is decoded and resized
+by one job at a time, distinct files in parallel.
+Jobs go through compose and encode stages, run by jobs_count threads each (see Pipeline).
+"""
+
+    def __init__(self, compositor, jobs_count=1):
+        if not isinstance(compositor, PillowCompositor):
+            raise Exception('Compose plans require an in-process compositor backend (pillow or numpy)')
+        self.compositor = compositor
+        self.jobs_count = jobs_count
+        if not self.compositor.resize_cache:
+            self.compositor.resize_cache = ResizeCache()
+        self.resize_cache = self.compositor.resize_cache
+        # Decoded layer bitmaps, by file path
+        self.decoded_overlays = ResizeCache()
+        self.overlay_locks = {}
+        self.overlays_lock = threading.Lock()
+
+    def get_overlay_lock(self, overlay_file):
+        with self.overlays_lock:
+            overlay_lock = self.overlay_locks.get(overlay_file)
+            if overlay_lock is None:
+                overlay_lock = self.overlay_locks[overlay_file] = threading.Lock()
+            return overlay_lock
+
+    def get_decoded_overlay(self, overlay_file):
+        decoded_overlay = self.decoded_overlays.get_image(overlay_file)
+        if decoded_overlay is None:
+            overlay_image = self.compositor.image_module.open(overlay_file)
+            overlay_image.load()
+            decoded_overlay = self.compositor.prepare_overlay(overlay_image)
+            self.decoded_overlays.add_image(overlay_file, decoded_overlay)
+        return decoded_overlay
+
+    def get_overlay(self, overlay_file, width=None, height=None):
+        """ Returns the overlay bitmap, in RGBA mode, resized to fit in width x height if any. """
+        if not width and not height:
+            with self.get_overlay_lock(overlay_file):
+                return self.get_decoded_overlay(overlay_file)
+        cache_key = self.resize_cache.get_key(overlay_file, width, height, self.compositor.RESIZE_FILTER_NAME)
+        with self.get_overlay_lock(overlay_file):
+            resized_overlay = self.resize_cache.get_image(cache_key, self.compositor.image_module)
+            if resized_overlay is None:
+                resized_overlay = self.compositor.prepare_overlay(self.get_decoded_overlay(overlay_file), width,
+                                                                  height)
+                self.resize_cache.add_image(cache_key, resized_overlay)
+        return resized_overlay
+
+    def compose(self, job):
+        background_image, background_mode = self.compositor.get_background(job.background_file)
+        output_image = background_image.copy()
+        for overlay_file, geometry in job.overlays:
+            PillowCompositor.blend_overlay(output_image, self.get_overlay(overlay_file, geometry.width,
+                                                                          geometry.height),
+                                           geometry.offset_x, geometry.offset_y, geometry.gravity)
+        if background_mode in ['RGB', 'L']:
+            output_image = output_image.convert(background_mode)
+        job.output_image = output_image
+        return job
+
+    def encode(self, job):
+        self.compositor.save_image(job.output_image, job.output_file)
+        job.output_image = None
+        return job
+
+    def run(self, jobs):
+        """ Yields a JobResult for each ComposeJob, in jobs order. """
+        stages = [PipelineStage('compose', self.compose, self.jobs_count),
+                  PipelineStage('encode', self.encode, self.jobs_count)]
+        return Pipeline(stages, self.jobs_count * 2).run(jobs)
+
+    def close(self):
+        self.decoded_overlays.clear()
+        with self.overlays_lock:
+            self.overlay_locks.clear()
+        self.resize_cache.clear()
+        self.compositor.close()
+
+
+class ComposePlanTestCase(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        for sub_dir in ['backgrounds/toto', 'backgrounds/titi', 'icons']:
+            os.makedirs(os.path.join(self.directory, sub_dir))
+        self.files = ['backgrounds/toto/blue.png', 'backgrounds/titi/blue.png', 'backgrounds/toto/red.png',
+                      'backgrounds/titi/red.png', 'icons/a.png', 'icons/b.png', 'badge.png']
+        for file_path in self.files:
+            open(os.path.join(self.directory, file_path), 'w').close()
+        self.plan_json = {
+            'backgrounds': ['backgrounds/{DENSITY}/blue.png', 'backgrounds/{DENSITY}/red.png'],
+            'layers': [{'name': 'icon', 'input': 'icons', 'width': 10, 'height': 10},
+                       {'name': 'badge', 'input': 'badge.png', 'gravity': 'northeast', 'x': 2, 'y': 3,
+                        'densities': {'titi': {'x': 5}}}],
+            'reference_density': 'toto',
+            'densities': ['toto', 'titi'],
+            'output': '{DENSITY}/{BACKGROUND}_{icon}.png'
+        }
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def _load_plan(self):
+        plan_file = os.path.join(self.directory, 'plan.json')
+        with open(plan_file, 'w') as plan_json_file:
+            json.dump(self.plan_json, plan_json_file)
+        return ComposePlan.from_json_file(plan_file, '../tests/densities_test.json')
+
+    def test_lists_jobs_of_all_densities_backgrounds_and_layer_bitmaps(self):
+        output_dir = os.path.join(self.directory, 'output')
+        jobs = self._load_plan().get_jobs(output_dir)
+        self.assertEqual([os.path.relpath(job.output_file, output_dir) for job in jobs],
+                         ['toto/blue_a.png', 'toto/blue_b.png', 'toto/red_a.png', 'toto/red_b.png',
+                          'titi/blue_a.png', 'titi/blue_b.png', 'titi/red_a.png', 'titi/red_b.png'])
+        self.assertTrue(os.path.isdir(os.path.join(output_dir, 'titi')))
+        job = jobs[5]
+        self.assertEqual(job.background_file, os.path.join(self.directory, 'backgrounds/titi/blue.png'))
+        self.assertEqual([os.path.relpath(overlay_file, self.directory) for overlay_file, geometry in job.overlays],
+                         ['icons/b.png', 'badge.png'])
+        icon_geometry, badge_geometry = [geometry for overlay_file, geometry in job.overlays]
+        self.assertEqual((icon_geometry.width, icon_geometry.height, icon_geometry.gravity), (20, 20, 'center'))
+        self.assertEqual((badge_geometry.offset_x, badge_geometry.offset_y, badge_geometry.gravity),
+                         (5, 6, 'northeast'))
+
+    def test_rejects_output_pattern_giving_same_output_to_several_jobs(self):
+        self.plan_json['output'] = '{DENSITY}/{BACKGROUND}.png'
+        with self.assertRaises(Exception):
+            self._load_plan().get_jobs(os.path.join(self.directory, 'output'))
+
+    def test_raises_ConfigFileFormatError_if_density_key_used_without_reference_density(self):
+        del self.plan_json['reference_density']
+        with self.assertRaises(ConfigFileFormatError):
+            self._load_plan()
+
+
+class ComposePlanSchedulerTestCase(unittest.TestCase):
+    def setUp(self):
+        self.compositor = PillowCompositor()
+        if not self.compositor.is_available():
+            self.skipTest('Pillow is not installed')
+        self.directory = tempfile.mkdtemp()
+        self.image_module = self.compositor.image_module
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def _save_image(self, name, mode, size, color):
+        image_file = os.path.join(self.directory, name)
+        self.image_module.new(mode, size, color).save(image_file)
+        return image_file
+
+    def test_composes_layers_decoding_and_resizing_overlays_once(self):
+        background_files = [self._save_image('blue.png', 'RGB', (8, 8), (0, 0, 255)),
+                            self._save_image('green.png', 'RGB', (8, 8), (0, 255, 0))]
+        icon_file = self._save_image('icon.png', 'RGBA', (8, 8), (255, 0, 0, 255))
+        badge_file = self._save_image('badge.png', 'RGBA', (2, 2), (255, 255, 255, 255))
+        jobs = [ComposeJob(os.path.join(self.directory, 'out_' + str(index) + '.png'), background_file,
+                           [(icon_file, ComposeLayerGeometry(4, 4)),
+                            (badge_file, ComposeLayerGeometry(gravity='southeast'))])
+                for index, background_file in enumerate(background_files)]
+        scheduler = ComposePlanScheduler(self.compositor, 2)
+        try:
+            job_results = list(scheduler.run(jobs))
+            self.assertEqual(sorted(scheduler.decoded_overlays.images.keys()), [badge_file, icon_file])
+            self.assertEqual((scheduler.resize_cache.hits_count, scheduler.resize_cache.misses_count), (1, 1))
+        finally:
+            scheduler.close()
+        self.assertTrue(all(job_result.succeeded() for job_result in job_results))
+        for job, background_color in zip(jobs, [(0, 0, 255), (0, 255, 0)]):
+            output_image = self.image_module.open(job.output_file)
+            self.assertEqual(output_image.mode, 'RGB')
+            self.assertEqual(output_image.getpixel((4, 4)), (255, 0, 0))
+            self.assertEqual(output_image.getpixel((1, 1)), background_color)
+            self.assertEqual(output_image.getpixel((7, 7)), (255, 255, 255))
+
+
+if __name__ == '__main__':
+    unittest.main(exit=False)
@@ -34,6 +34,10 @@ class DensityOutputConfig:
                                         + '\nJSON: ' + json.dumps(density_json))
         return cls(name, scale, output_sub_dir, file_name_pattern)
 
+    def to_json(self):
+        return {'name': self.name, 'scale': self.scale, 'sub_dir': self.output_sub_dir,
+                'file_name_pattern': self.file_name_pattern}
+
     def get_output_dir(self, base_output_dir):
         if self.output_sub_dir:
             return os.path.join(base_output_dir, self.output_sub_dir).replace(
@@ -1,8 +1,21 @@
 #! /usr/bin/env python
 # -*- coding: utf-8 -*-
 from __future__ import print_function
+import errno
+import fnmatch
 import os
+import shutil
 import sys
+import tempfile
+import unittest
+
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
 
 
 def print_warning(*objs):
@@ -23,16 +36,120 @@ def is_jpg_file(filename):
 def is_bitmap_file(filename):
     return is_png_file(filename) or is_jpg_file(filename)
 
+def is_json_file(filename):
+    return get_normalised_ext(filename) == '.json'
+
 def get_file_paths(file_or_directory, filter_function):
-    file_paths = []
-    if os.path.isdir(file_or_directory):
-        file_names = os.listdir(file_or_directory)
-        file_paths = [os.path.normpath(os.path.join(file_or_directory, fileName)) for fileName in list(filter(filter_function, file_names))]
-    elif os.path.isfile(file_or_directory) and filter_function(file_or_directory):
-        file_paths.append(file_or_directory)
-    return file_paths
+    return list(iter_file_paths(file_or_directory, filter_function))
+
+def iter_file_paths(file_or_directory, filter_function, recursive=False, include_patterns=None, exclude_patterns=None):
+    """ Yields paths of files accepted by filter_function, in the directory (and its sub-directories, if recursive) or
+    the file itself. Paths are yielded as directories are scanned, in file system order, so that callers can start
+    handling files before the whole tree is walked.
+    Glob patterns (see fnmatch, where '*' also matches '/') match paths relative to the directory, with '/' separators:
+    files must match one of include_patterns if any, and none of exclude_patterns. Sub-directories matching one of
+    exclude_patterns are not walked. Symbolic links to directories are not followed. """
+    if os.path.isfile(file_or_directory):
+        if filter_function(file_or_directory):
+            yield file_or_directory
+        return
+    if not os.path.isdir(file_or_directory):
+        return
+    directories = [(file_or_directory, '')]
+    while directories:
+        directory, relative_directory = directories.pop(0)
+        sub_directories = []
+        for name, is_directory in _scan_directory(directory):
+            relative_path = relative_directory + name
+            if is_directory:
+                if recursive and not _match_patterns(relative_path, exclude_patterns):
+                    sub_directories.append((os.path.join(directory, name), relative_path + '/'))
+            elif filter_function(name) and (not include_patterns or _match_patterns(relative_path, include_patterns)) \
+                    and not _match_patterns(relative_path, exclude_patterns):
+                yield os.path.normpath(os.path.join(directory, name))
+        # Depth first, so that files of a same directory are yielded together
+        directories[:0] = sub_directories
+
+def _scan_directory(directory):
+    """ Yields (name, is a directory) of directory entries. scandir (Python 3.5+, or the scandir package) reads entry
+    types from the directory listing itself, without a stat call per entry. """
+    if scandir:
+        for entry in scandir(directory):
+            yield entry.name, entry.is_dir(follow_symlinks=False)
+    else:
+        for name in os.listdir(directory):
+            path = os.path.join(directory, name)
+            yield name, os.path.isdir(path) and not os.path.islink(path)
+
+def _match_patterns(relative_path, patterns):
+    return any(fnmatch.fnmatch(relative_path, pattern) for pattern in patterns or [])
+
+def get_mirrored_output_dir(output_dir, file_path, input_file_or_directory):
+    """ Returns the output directory of a file found in the input directory: the output directory itself, or the same
+    sub-directory in it as in the input directory. """
+    if not os.path.isdir(input_file_or_directory):
+        return output_dir
+    relative_directory = os.path.dirname(os.path.relpath(file_path, input_file_or_directory))
+    return os.path.join(output_dir, relative_directory) if relative_directory else output_dir
+
+def make_directories(directory):
+    """ Creates the directory and its missing parents, if it doesn't exist yet. Safe with concurrent callers. """
+    if not os.path.isdir(directory):
+        try:
+            os.makedirs(directory)
+        except OSError as err:
+            if err.errno != errno.EEXIST:
+                raise
+
+def link_or_copy(source_file, target_file):
+    """ Hard links the source file to the target path, or copies it if linking is not possible (different file systems,
+    unsupported by OS). Replaces any existing target file. """
+    if os.path.exists(target_file):
+        if os.path.samefile(source_file, target_file):
+            return
+        os.remove(target_file)
+    try:
+        os.link(source_file, target_file)
+    except (OSError, AttributeError) as err:
+        if isinstance(err, OSError) and err.errno == errno.ENOENT:
+            raise
+        shutil.copyfile(source_file, target_file)
 
 def print_reporting(date_time_start, date_time_end, svg_files):
     plural = '' if len(svg_files) < 2 else 's'
     print('\n' + str(len(svg_files)) + ' file' + plural + ' handled.')
     print('Time: ' + str(date_time_end - date_time_start) + '\n')
+
+
+class IterFilePathsTestCase(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        for relative_path in ['a.svg', 'b.png', 'icons/c.svg', 'icons/big/d.svg', 'build/e.svg']:
+            file_path = os.path.join(self.directory, relative_path)
+            make_directories(os.path.dirname(file_path))
+            open(file_path, 'w').close()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def get_relative_paths(self, *args, **kwargs):
+        return sorted(os.path.relpath(file_path, self.directory).replace(os.sep, '/') for file_path in
+                      iter_file_paths(self.directory, is_svg_file, *args, **kwargs))
+
+    def test_walks_sub_directories_if_recursive(self):
+        self.assertEqual(self.get_relative_paths(), ['a.svg'])
+        self.assertEqual(self.get_relative_paths(True), ['a.svg', 'build/e.svg', 'icons/big/d.svg', 'icons/c.svg'])
+
+    def test_filters_relative_paths_with_glob_patterns(self):
+        self.assertEqual(self.get_relative_paths(True, ['icons/*']), ['icons/big/d.svg', 'icons/c.svg'])
+        self.assertEqual(self.get_relative_paths(True, exclude_patterns=['build', 'icons/big/*']),
+                         ['a.svg', 'icons/c.svg'])
+
+    def test_mirrors_input_sub_directories(self):
+        file_path = os.path.join(self.directory, 'icons', 'big', 'd.svg')
+        self.assertEqual(get_mirrored_output_dir('out', file_path, self.directory), os.path.join('out', 'icons', 'big'))
+        self.assertEqual(get_mirrored_output_dir('out', file_path, file_path), 'out')
+
+
+if __name__ == '__main__':
+    unittest.main(exit=False)
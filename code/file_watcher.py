@@ -0,0 +1,110 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+
+DEFAULT_POLL_INTERVAL = 0.5
+DEFAULT_DEBOUNCE_DELAY = 0.5
+
+
+class FileWatcher:
+    """ Watches files for changes, by polling their modification time and size.
+
+get_files is a function returning the files to watch: it is called at each poll, so that added files are reported too.
+Changes are debounced: they are reported once no file changed for debounce_delay seconds, so that an editor saving a
+file in several writes, or several files saved in a row, trigger a single update.
+Polling works on any file system, network shares included, without any dependency.
+"""
+
+    def __init__(self, get_files, poll_interval=DEFAULT_POLL_INTERVAL, debounce_delay=DEFAULT_DEBOUNCE_DELAY):
+        self.get_files = get_files
+        self.poll_interval = poll_interval
+        self.debounce_delay = debounce_delay
+        self.states = self.get_states()
+        self.changed_files = set()
+        self.last_change_time = None
+
+    def get_states(self):
+        """ Returns (modification time, size) of watched files, by path. """
+        states = {}
+        for file_path in self.get_files():
+            try:
+                file_stat = os.stat(file_path)
+            except OSError:
+                # Removed since listed
+                continue
+            states[file_path] = (file_stat.st_mtime, file_stat.st_size)
+        return states
+
+    def poll(self, now=None):
+        """ Returns the sorted list of files changed or added since last reported, once changes settled (empty list
+        otherwise). Removed files are not reported. """
+        now = time.time() if now is None else now
+        states = self.get_states()
+        for file_path, state in states.items():
+            if self.states.get(file_path) != state:
+                self.changed_files.add(file_path)
+                self.last_change_time = now
+        self.changed_files.intersection_update(states)
+        self.states = states
+        if not self.changed_files or now - self.last_change_time < self.debounce_delay:
+            return []
+        changed_files = sorted(self.changed_files)
+        self.changed_files.clear()
+        return changed_files
+
+    def watch(self):
+        """ Yields lists of changed files (see poll), forever. """
+        while True:
+            time.sleep(self.poll_interval)
+            changed_files = self.poll()
+            if changed_files:
+                yield changed_files
+
+
+class FileWatcherTestCase(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.files = [os.path.join(self.directory, name) for name in ['a.svg', 'b.svg']]
+        for file_path in self.files:
+            self.write_file(file_path, 'initial', 1000)
+        self.watcher = FileWatcher(lambda: [os.path.join(self.directory, name)
+                                            for name in sorted(os.listdir(self.directory))], debounce_delay=1)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def write_file(self, file_path, content, modification_time):
+        with open(file_path, 'w') as output_file:
+            output_file.write(content)
+        os.utime(file_path, (modification_time, modification_time))
+
+    def test_reports_changed_and_added_files_once_settled(self):
+        self.assertEqual(self.watcher.poll(10), [])
+        self.write_file(self.files[1], 'changed', 1001)
+        self.assertEqual(self.watcher.poll(20), [])
+        added_file = os.path.join(self.directory, 'c.svg')
+        self.write_file(added_file, 'added', 1002)
+        self.assertEqual(self.watcher.poll(20.5), [])
+        self.assertEqual(self.watcher.poll(21), [])
+        self.assertEqual(self.watcher.poll(21.5), [self.files[1], added_file])
+        self.assertEqual(self.watcher.poll(30), [])
+
+    def test_detects_size_changes_within_a_same_modification_time(self):
+        self.write_file(self.files[0], 'changed content', 1000)
+        self.assertEqual(self.watcher.poll(10), [])
+        self.assertEqual(self.watcher.poll(11), [self.files[0]])
+
+    def test_does_not_report_removed_files(self):
+        self.write_file(self.files[0], 'changed', 1001)
+        self.watcher.poll(10)
+        os.remove(self.files[0])
+        self.assertEqual(self.watcher.poll(11), [])
+
+
+if __name__ == '__main__':
+    unittest.main(exit=False)
@@ -0,0 +1,158 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+import os
+import pipes
+import subprocess
+import sys
+import threading
+import unittest
+from Queue import Queue, Empty
+
+
+class InkscapeShellSession:
+    """ Long-lived Inkscape process, driven through its interactive shell mode ('inkscape --shell').
+
+Each command line is written to Inkscape standard input, using the same arguments as a regular command line call, minus
+the Inkscape path. Inkscape prints a '>' prompt when ready for the next command.
+The process is (re)started on demand: when it exits unexpectedly or does not answer before the timeout, it is killed and
+the command is retried once in a fresh session.
+See: http://tavmjong.free.fr/INKSCAPE/MANUAL/html/CommandLine.html
+"""
+    PROMPT = '>'
+
+    def __init__(self, command_args, timeout=60):
+        self.command_args = command_args
+        self.timeout = timeout
+        self.process = None
+        self.output_queue = None
+        self.starts_count = 0
+
+    def is_running(self):
+        return self.process is not None and self.process.poll() is None
+
+    def start(self):
+        self.process = subprocess.Popen(self.command_args, stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                                        stderr=subprocess.STDOUT, bufsize=0)
+        self.output_queue = Queue()
+        reader_thread = threading.Thread(target=_read_output, args=(self.process.stdout, self.output_queue))
+        reader_thread.daemon = True
+        reader_thread.start()
+        self.starts_count += 1
+        self._read_until_prompt()
+
+    def close(self):
+        if self.is_running():
+            try:
+                self.process.stdin.write('quit\n')
+                self.process.stdin.close()
+                self.process.wait()
+            except (IOError, OSError):
+                self.kill()
+        self.process = None
+
+    def kill(self):
+        if self.is_running():
+            try:
+                self.process.kill()
+                self.process.wait()
+            except OSError:
+                pass
+        self.process = None
+
+    def run(self, args):
+        """ Runs a shell command, given as a list of Inkscape arguments, and returns its output. """
+        try:
+            return self._run_once(args)
+        except InkscapeShellError:
+            self.kill()
+            return self._run_once(args)
+
+    def _run_once(self, args):
+        if not self.is_running():
+            self.start()
+        command_line = ' '.join(pipes.quote(arg) for arg in args)
+        try:
+            self.process.stdin.write(command_line + '\n')
+        except (IOError, OSError) as err:
+            raise InkscapeShellError('Inkscape shell closed its input: ' + str(err))
+        return self._read_until_prompt()
+
+    def _read_until_prompt(self):
+        output = ''
+        while not (output == InkscapeShellSession.PROMPT or output.endswith('\n' + InkscapeShellSession.PROMPT)):
+            try:
+                data = self.output_queue.get(timeout=self.timeout)
+            except Empty:
+                self.kill()
+                raise InkscapeShellError('Inkscape shell did not answer within ' + str(self.timeout) + ' seconds.')
+            if not data:
+                self.kill()
+                raise InkscapeShellError('Inkscape shell exited unexpectedly.\n' + output)
+            output += data
+        return output[:-len(InkscapeShellSession.PROMPT)]
+
+
+def _read_output(output_file, output_queue):
+    """ Reader thread: forwards process output to the queue, and an empty string once the output is closed. """
+    while True:
+        data = os.read(output_file.fileno(), 4096)
+        output_queue.put(data)
+        if not data:
+            break
+
+
+class InkscapeShellError(Exception):
+    """Error class for Inkscape shell sessions crashing or hanging."""
+
+    def __init__(self, message):
+        super(InkscapeShellError, self).__init__(message)
+
+
+FAKE_INKSCAPE_SHELL_SCRIPT = """
+import sys
+sys.stdout.write('>')
+sys.stdout.flush()
+while True:
+    line = sys.stdin.readline()
+    if not line or line.strip() == 'quit':
+        break
+    if 'crash' in line:
+        sys.exit(1)
+    if 'hang' in line:
+        import time
+        time.sleep(60)
+    sys.stdout.write('done ' + line + '>')
+    sys.stdout.flush()
+"""
+
+
+class InkscapeShellSessionTestCase(unittest.TestCase):
+    def setUp(self):
+        self.session = InkscapeShellSession([sys.executable, '-c', FAKE_INKSCAPE_SHELL_SCRIPT], timeout=1)
+
+    def tearDown(self):
+        self.session.kill()
+
+    def test_streams_commands_through_a_single_process(self):
+        self.assertEqual(self.session.run(['a.svg', '--export-png=a.png']), 'done a.svg --export-png=a.png\n')
+        self.assertEqual(self.session.run(['my file.svg']), "done 'my file.svg'\n")
+        self.assertEqual(self.session.starts_count, 1)
+        self.session.close()
+        self.assertFalse(self.session.is_running())
+
+    def test_restarts_session_after_crash(self):
+        self.session.run(['a.svg'])
+        with self.assertRaises(InkscapeShellError):
+            self.session.run(['crash.svg'])
+        self.assertEqual(self.session.run(['b.svg']), 'done b.svg\n')
+        self.assertEqual(self.session.starts_count, 3)
+
+    def test_restarts_session_after_timeout(self):
+        with self.assertRaises(InkscapeShellError):
+            self.session.run(['hang.svg'])
+        self.assertFalse(self.session.is_running())
+        self.assertEqual(self.session.run(['b.svg']), 'done b.svg\n')
+
+
+if __name__ == '__main__':
+    unittest.main(exit=False)
@@ -0,0 +1,112 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+from __future__ import print_function
+import sys
+import traceback
+import unittest
+from multiprocessing import Pool
+from multiprocessing.pool import ThreadPool
+
+
+class JobResult:
+    """ Outcome of a job run by a JobPool: either the value returned by the job function, or the error it raised. """
+
+    def __init__(self, job, value=None, error=None, error_traceback=None):
+        self.job = job
+        self.value = value
+        self.error = error
+        self.error_traceback = error_traceback
+
+    def succeeded(self):
+        return self.error is None
+
+    def __repr__(self):
+        if self.error is not None:
+            return '[JobResult]\t' + str(self.job) + '\tFAILED\n' + self.error
+        return '[JobResult]\t' + str(self.job) + '\t' + str(self.value)
+
+
+def run_job(job_function_and_job):
+    """ Calls the job function and turns any exception into a JobResult error, so that a failing job never aborts the
+    whole batch. Defined at module level to be picklable by process pools. """
+    job_function, job = job_function_and_job
+    try:
+        return JobResult(job, value=job_function(job))
+    except Exception:
+        exception_type, exception, exception_traceback = sys.exc_info()
+        error = ''.join(traceback.format_exception_only(exception_type, exception)).rstrip()
+        error_traceback = ''.join(traceback.format_exception(exception_type, exception, exception_traceback)).rstrip()
+        return JobResult(job, error=error, error_traceback=error_traceback)
+
+
+class JobPool:
+    """ Runs a job function over a list of jobs, with a given number of parallel workers.
+
+With a single worker, jobs are run in the calling thread (no pool is created). Threads are well suited to jobs waiting on
+sub-processes; use processes for CPU-bound Python jobs (job function and jobs must then be picklable).
+Results are always yielded in job submission order, so that output stays deterministic whatever the scheduling.
+"""
+
+    def __init__(self, jobs_count=1, use_processes=False, initializer=None, initargs=()):
+        self.jobs_count = max(1, jobs_count or 1)
+        self.use_processes = use_processes
+        self.initializer = initializer
+        self.initargs = initargs
+
+    def imap(self, job_function, jobs):
+        """ Yields a JobResult for each job, in the order of the jobs iterable. """
+        job_items = ((job_function, job) for job in jobs)
+        if self.jobs_count == 1:
+            if self.initializer:
+                self.initializer(*self.initargs)
+            for job_item in job_items:
+                yield run_job(job_item)
+            return
+        pool_class = Pool if self.use_processes else ThreadPool
+        pool = pool_class(self.jobs_count, self.initializer, self.initargs)
+        try:
+            for job_result in pool.imap(run_job, job_items):
+                yield job_result
+            pool.close()
+        finally:
+            pool.terminate()
+            pool.join()
+
+
+def print_job_failures(job_results):
+    """ Prints a report of failed jobs to stderr. Returns the number of failures. """
+    failures = [job_result for job_result in job_results if not job_result.succeeded()]
+    if failures:
+        plural = '' if len(failures) < 2 else 's'
+        print('\n' + str(len(failures)) + ' job' + plural + ' failed:', file=sys.stderr)
+        for failure in failures:
+            print('\n' + str(failure.job) + '\n' + failure.error, file=sys.stderr)
+    return len(failures)
+
+
+def _square(value):
+    if value < 0:
+        raise ValueError('Negative value ' + str(value))
+    return value * value
+
+
+class JobPoolTestCase(unittest.TestCase):
+    def test_returns_results_in_submission_order_with_parallel_workers(self):
+        job_results = list(JobPool(4).imap(_square, range(20)))
+        self.assertEqual([job_result.job for job_result in job_results], list(range(20)))
+        self.assertEqual([job_result.value for job_result in job_results], [value * value for value in range(20)])
+
+    def test_runs_jobs_in_processes(self):
+        job_results = list(JobPool(2, use_processes=True).imap(_square, [3, 4]))
+        self.assertEqual([job_result.value for job_result in job_results], [9, 16])
+
+    def test_reports_job_errors_without_aborting_other_jobs(self):
+        for jobs_count in [1, 3]:
+            job_results = list(JobPool(jobs_count).imap(_square, [1, -2, 3]))
+            self.assertEqual([job_result.succeeded() for job_result in job_results], [True, False, True])
+            self.assertIn('Negative value -2', job_results[1].error)
+            self.assertEqual(job_results[2].value, 9)
+
+
+if __name__ == '__main__':
+    unittest.main(exit=False)
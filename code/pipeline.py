@@ -0,0 +1,160 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+import sys
+import threading
+import time
+import unittest
+from Queue import Queue
+
+from job_pool import JobResult, run_job
+
+
+class PipelineStage:
+    """ Step of a Pipeline: a function applied to each item, by workers_count threads. """
+
+    def __init__(self, name, function, workers_count=1):
+        self.name = name
+        self.function = function
+        self.workers_count = max(1, workers_count or 1)
+
+
+class Pipeline:
+    """ Chains stages run concurrently, each by its own worker threads, connected by bounded queues.
+
+Items flow through all stages at once: while a stage handles item N, the previous stage already handles item N+1.
+Queues are bounded, so that a fast stage never piles up items (documents, bitmaps) in memory ahead of a slow one.
+The first stage function takes the input item, next stage functions take the value returned by the previous stage.
+An exception raised by a stage ends the processing of the item: next stages are skipped, and its result holds the error.
+Results are yielded in items order, whatever the scheduling. An exception raised by the items iterator is raised again
+by run(), once results of items read before it are yielded.
+"""
+    END = object()
+
+    def __init__(self, stages, queue_size=2):
+        self.stages = stages
+        self.queue_size = queue_size
+
+    def run(self, items):
+        """ Yields a JobResult for each item, in items order. Result values are the values returned by the last
+        stage. """
+        queues = [Queue(self.queue_size) for stage in self.stages]
+        output_queue = Queue()
+        queues.append(output_queue)
+        # Exception info of the items iterator, if it raised
+        feed_errors = []
+        feeder_thread = threading.Thread(target=self._feed, args=(items, queues[0], self.stages[0].workers_count,
+                                                                  feed_errors))
+        feeder_thread.daemon = True
+        feeder_thread.start()
+        for stage_index, stage in enumerate(self.stages):
+            next_workers_count = self.stages[stage_index + 1].workers_count if stage_index + 1 < len(self.stages) else 1
+            # Shared by the stage workers: the last one to finish forwards the end of items to the next stage
+            running_workers = [stage.workers_count, threading.Lock()]
+            for worker_index in range(stage.workers_count):
+                worker_thread = threading.Thread(target=self._run_stage, args=(
+                    stage, queues[stage_index], queues[stage_index + 1], next_workers_count, running_workers))
+                worker_thread.daemon = True
+                worker_thread.start()
+        pending_results = {}
+        next_index = 0
+        while True:
+            message = output_queue.get()
+            if message is Pipeline.END:
+                break
+            index, item, job_result = message
+            pending_results[index] = JobResult(item, job_result.value, job_result.error, job_result.error_traceback)
+            while next_index in pending_results:
+                yield pending_results.pop(next_index)
+                next_index += 1
+        if feed_errors:
+            error_type, error_value, error_traceback = feed_errors[0]
+            raise error_type, error_value, error_traceback
+
+    @staticmethod
+    def _feed(items, first_queue, workers_count, feed_errors):
+        try:
+            for index, item in enumerate(items):
+                first_queue.put((index, item, JobResult(item, value=item)))
+        except Exception:
+            feed_errors.append(sys.exc_info())
+        finally:
+            for worker_index in range(workers_count):
+                first_queue.put(Pipeline.END)
+
+    @staticmethod
+    def _run_stage(stage, input_queue, output_queue, next_workers_count, running_workers):
+        while True:
+            message = input_queue.get()
+            if message is Pipeline.END:
+                break
+            index, item, job_result = message
+            if job_result.succeeded():
+                job_result = run_job((stage.function, job_result.value))
+                if not job_result.succeeded():
+                    job_result.error = stage.name + ': ' + job_result.error
+            output_queue.put((index, item, job_result))
+        with running_workers[1]:
+            running_workers[0] -= 1
+            if running_workers[0] == 0:
+                for worker_index in range(next_workers_count):
+                    output_queue.put(Pipeline.END)
+
+
+def _double(value):
+    return value * 2
+
+
+def _slow_increment(value):
+    time.sleep(0.02 * (value % 3))
+    return value + 1
+
+
+def _check_positive(value):
+    if value < 0:
+        raise ValueError('Negative value ' + str(value))
+    return value
+
+
+class PipelineTestCase(unittest.TestCase):
+    def test_chains_stages_and_yields_results_in_items_order(self):
+        pipeline = Pipeline([PipelineStage('double', _double), PipelineStage('increment', _slow_increment, 3)])
+        job_results = list(pipeline.run(range(10)))
+        self.assertEqual([job_result.job for job_result in job_results], list(range(10)))
+        self.assertEqual([job_result.value for job_result in job_results], [value * 2 + 1 for value in range(10)])
+
+    def test_skips_next_stages_of_failed_items(self):
+        calls = []
+        pipeline = Pipeline([PipelineStage('check', _check_positive, 2), PipelineStage('record', calls.append)])
+        job_results = list(pipeline.run([1, -2, 3]))
+        self.assertEqual([job_result.succeeded() for job_result in job_results], [True, False, True])
+        self.assertEqual(job_results[1].error, 'check: ValueError: Negative value -2')
+        self.assertEqual(sorted(calls), [1, 3])
+
+    def test_raises_items_iterator_errors_after_results_of_read_items(self):
+        def get_items():
+            yield 1
+            yield 2
+            raise OSError('Directory removed')
+        job_results = []
+        with self.assertRaises(OSError):
+            for job_result in Pipeline([PipelineStage('double', _double, 2)]).run(get_items()):
+                job_results.append(job_result)
+        self.assertEqual([job_result.value for job_result in job_results], [2, 4])
+
+    def test_overlaps_stages(self):
+        stage_threads = {}
+
+        def record_thread(stage_name):
+            def function(value):
+                stage_threads.setdefault(stage_name, set()).add(threading.current_thread().name)
+                time.sleep(0.05)
+                return value
+            return function
+        date_start = time.time()
+        list(Pipeline([PipelineStage('a', record_thread('a')), PipelineStage('b', record_thread('b'))]).run(range(4)))
+        self.assertLess(time.time() - date_start, 0.35)
+        self.assertFalse(stage_threads['a'] & stage_threads['b'])
+
+
+if __name__ == '__main__':
+    unittest.main(exit=False)
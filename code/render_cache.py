@@ -0,0 +1,206 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+import errno
+import hashlib
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+
+import file_utils as utils
+
+
+DEFAULT_CACHE_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'python_svg_batch_tools', 'renders')
+DEFAULT_CACHE_MAX_SIZE = 512 * 1024 * 1024
+
+
+def get_file_digest(file_path, block_size=65536):
+    """ Returns the SHA-1 hexadecimal digest of a file content. """
+    digest = hashlib.sha1()
+    with open(file_path, 'rb') as input_file:
+        for block in iter(lambda: input_file.read(block_size), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+class RenderCache:
+    """ On-disk cache of rendered PNG files, addressed by a key computed from everything a render depends on.
+
+Keys combine the SVG content digest, the renderer name and version, the output size and the density configuration.
+Cached renders are hard linked (or copied) to output paths, so that unchanged files are not rendered again.
+Each cache hit touches the cached file, and evict() removes least recently used files until the cache fits its maximum
+size.
+Output files must never be updated in place: they may be hard links to cached files (renderers write new files).
+"""
+
+    def __init__(self, cache_dir=DEFAULT_CACHE_DIR, max_size=DEFAULT_CACHE_MAX_SIZE):
+        self.cache_dir = cache_dir
+        self.max_size = max_size
+        self.digests_by_file = {}
+        self.lock = threading.Lock()
+        if not os.path.isdir(self.cache_dir):
+            try:
+                os.makedirs(self.cache_dir)
+            except OSError as err:
+                if err.errno != errno.EEXIST:
+                    raise
+
+    def get_file_digest(self, svg_file):
+        """ Returns the file content digest, computed once per file. """
+        with self.lock:
+            digest = self.digests_by_file.get(svg_file)
+            if digest is None:
+                digest = get_file_digest(svg_file)
+                self.digests_by_file[svg_file] = digest
+            return digest
+
+    def forget(self, svg_files):
+        """ Drops digests of files changed since read (see --watch), so that their keys are computed again. """
+        with self.lock:
+            for svg_file in svg_files:
+                self.digests_by_file.pop(svg_file, None)
+
+    def get_key(self, svg_file, renderer_version, width=None, height=None, density_config=None, downscale=False):
+        """ Returns the key of a render. Downscaled renders are resampled from a larger render, so they do not share
+        keys with direct renders. """
+        key_parts = [self.get_file_digest(svg_file), renderer_version, str(width), str(height)]
+        if density_config is not None:
+            key_parts.extend([density_config.name, str(density_config.scale)])
+        if downscale:
+            key_parts.append('downscale')
+        return hashlib.sha1('\n'.join(key_parts)).hexdigest()
+
+    def get_cached_file(self, key):
+        return os.path.join(self.cache_dir, key[:2], key + '.png')
+
+    def fetch(self, key, png_file):
+        """ Links the cached render to the output path. Returns False if there is no cached render for this key. """
+        cached_file = self.get_cached_file(key)
+        try:
+            os.utime(cached_file, None)
+            utils.link_or_copy(cached_file, png_file)
+        except OSError as err:
+            if err.errno == errno.ENOENT:
+                return False
+            raise
+        return True
+
+    def store(self, key, png_file):
+        """ Adds a rendered file to the cache. The cache entry is written atomically. """
+        cached_file = self.get_cached_file(key)
+        cached_file_dir = os.path.dirname(cached_file)
+        if not os.path.isdir(cached_file_dir):
+            try:
+                os.makedirs(cached_file_dir)
+            except OSError as err:
+                if err.errno != errno.EEXIST:
+                    raise
+        temporary_fd, temporary_file = tempfile.mkstemp(dir=cached_file_dir, suffix='.tmp')
+        os.close(temporary_fd)
+        try:
+            shutil.copyfile(png_file, temporary_file)
+            shutil.copymode(png_file, temporary_file)
+            os.rename(temporary_file, cached_file)
+        except (IOError, OSError):
+            os.remove(temporary_file)
+            raise
+
+    def get_entries(self):
+        """ Returns the list of (modification time, size, path) of cached files. """
+        entries = []
+        for sub_dir_name in os.listdir(self.cache_dir):
+            sub_dir = os.path.join(self.cache_dir, sub_dir_name)
+            if not os.path.isdir(sub_dir):
+                continue
+            for file_name in os.listdir(sub_dir):
+                cached_file = os.path.join(sub_dir, file_name)
+                try:
+                    stat = os.stat(cached_file)
+                except OSError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, cached_file))
+        return entries
+
+    def evict(self):
+        """ Removes least recently used files until the cache size is below its maximum size. Returns the number of
+        removed files. """
+        entries = sorted(self.get_entries())
+        cache_size = sum(size for mtime, size, cached_file in entries)
+        removed_count = 0
+        for mtime, size, cached_file in entries:
+            if cache_size <= self.max_size:
+                break
+            try:
+                os.remove(cached_file)
+            except OSError:
+                continue
+            cache_size -= size
+            removed_count += 1
+        return removed_count
+
+
+class RenderCacheTestCase(unittest.TestCase):
+    def setUp(self):
+        self.test_dir = tempfile.mkdtemp()
+        self.cache = RenderCache(os.path.join(self.test_dir, 'cache'), max_size=25)
+        self.svg_file = os.path.join(self.test_dir, 'icon.svg')
+        with open(self.svg_file, 'w') as svg_file:
+            svg_file.write('<svg/>')
+
+    def tearDown(self):
+        shutil.rmtree(self.test_dir)
+
+    def _write_png(self, content):
+        png_file = os.path.join(self.test_dir, 'rendered.png')
+        with open(png_file, 'w') as output_file:
+            output_file.write(content)
+        return png_file
+
+    def test_fetches_stored_render_to_output_path(self):
+        key = self.cache.get_key(self.svg_file, 'renderer 1.0', 10, 20)
+        output_file = os.path.join(self.test_dir, 'output.png')
+        self.assertFalse(self.cache.fetch(key, output_file))
+        self.cache.store(key, self._write_png('png data'))
+        self.assertTrue(self.cache.fetch(key, output_file))
+        with open(output_file) as fetched_file:
+            self.assertEqual(fetched_file.read(), 'png data')
+
+    def test_leaves_no_temporary_file_when_render_is_missing(self):
+        key = self.cache.get_key(self.svg_file, 'renderer 1.0', 10, 20)
+        self.assertRaises(IOError, self.cache.store, key, os.path.join(self.test_dir, 'missing.png'))
+        self.assertEqual(self.cache.get_entries(), [])
+
+    def test_computes_keys_of_forgotten_files_again(self):
+        key = self.cache.get_key(self.svg_file, 'renderer 1.0', 10, 20)
+        with open(self.svg_file, 'w') as svg_file:
+            svg_file.write('<svg width="10"/>')
+        self.assertEqual(key, self.cache.get_key(self.svg_file, 'renderer 1.0', 10, 20))
+        self.cache.forget([self.svg_file])
+        self.assertNotEqual(key, self.cache.get_key(self.svg_file, 'renderer 1.0', 10, 20))
+
+    def test_computes_distinct_keys_for_distinct_render_inputs(self):
+        key = self.cache.get_key(self.svg_file, 'renderer 1.0', 10, 20)
+        self.assertEqual(key, self.cache.get_key(self.svg_file, 'renderer 1.0', 10, 20))
+        self.assertNotEqual(key, self.cache.get_key(self.svg_file, 'renderer 1.1', 10, 20))
+        self.assertNotEqual(key, self.cache.get_key(self.svg_file, 'renderer 1.0', 20, 10))
+        self.assertNotEqual(key, self.cache.get_key(self.svg_file, 'renderer 1.0', 10, 20, downscale=True))
+        other_svg_file = os.path.join(self.test_dir, 'other.svg')
+        with open(other_svg_file, 'w') as svg_file:
+            svg_file.write('<svg></svg>')
+        self.assertNotEqual(key, self.cache.get_key(other_svg_file, 'renderer 1.0', 10, 20))
+
+    def test_evicts_least_recently_used_files_above_max_size(self):
+        keys = ['a' * 40, 'b' * 40, 'c' * 40]
+        for index, key in enumerate(keys):
+            self.cache.store(key, self._write_png('0123456789'))
+            os.utime(self.cache.get_cached_file(key), (index, index))
+        self.cache.fetch(keys[0], os.path.join(self.test_dir, 'output.png'))
+        self.assertEqual(self.cache.evict(), 1)
+        self.assertTrue(os.path.isfile(self.cache.get_cached_file(keys[0])))
+        self.assertFalse(os.path.isfile(self.cache.get_cached_file(keys[1])))
+        self.assertTrue(os.path.isfile(self.cache.get_cached_file(keys[2])))
+
+
+if __name__ == '__main__':
+    unittest.main(exit=False)
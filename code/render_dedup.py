@@ -0,0 +1,69 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+import hashlib
+import re
+import threading
+import unittest
+
+
+WHITESPACE_REGEX = re.compile(r'\s+')
+
+
+def normalize_svg_data(svg_data):
+    """ Returns SVG document data with whitespace runs collapsed to a single space, so that documents differing only by
+    formatting (indentation, line endings) are identical.
+    SVG renderers collapse whitespace the same way in text content, unless 'xml:space' asks to preserve it: such
+    documents only get their line endings normalized. """
+    if 'xml:space' in svg_data:
+        return svg_data.replace('\r\n', '\n')
+    return WHITESPACE_REGEX.sub(' ', svg_data).strip()
+
+
+class RenderDeduplicator:
+    """ Finds renders of identical documents to a same size, so that each unique render is done once.
+
+Render keys combine the normalized document content digest and the output size. The first output file written for a
+key is the source of all other outputs with the same key, hard linked or copied from it (see file_utils.link_or_copy).
+"""
+
+    def __init__(self):
+        self.output_files_by_key = {}
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def get_key(svg_data, width=None, height=None):
+        digest = hashlib.sha1(normalize_svg_data(svg_data)).hexdigest()
+        return digest + '\n' + str(width) + '\n' + str(height)
+
+    def get_output_file(self, key):
+        """ Returns the output file already written for the key, or None. """
+        with self.lock:
+            return self.output_files_by_key.get(key)
+
+    def add_output_file(self, key, output_file):
+        with self.lock:
+            self.output_files_by_key.setdefault(key, output_file)
+
+
+class RenderDeduplicatorTestCase(unittest.TestCase):
+    def test_ignores_formatting_differences(self):
+        key = RenderDeduplicator.get_key('<svg>\n  <path d="M0 0 L1 1"/>\n</svg>\n', 10, 10)
+        self.assertEqual(key, RenderDeduplicator.get_key('<svg>\r\n\t<path d="M0 0  L1 1"/>\r\n</svg>', 10, 10))
+        self.assertNotEqual(key, RenderDeduplicator.get_key('<svg><path d="M0 0 L1 1"/></svg>', 10, 10))
+        self.assertNotEqual(key, RenderDeduplicator.get_key('<svg>\n  <path d="M0 0 L1 1"/>\n</svg>\n', 20, 10))
+
+    def test_keeps_whitespace_of_documents_preserving_it(self):
+        self.assertNotEqual(normalize_svg_data('<text xml:space="preserve">a  b</text>'),
+                            normalize_svg_data('<text xml:space="preserve">a b</text>'))
+
+    def test_keeps_first_output_file_of_a_key(self):
+        deduplicator = RenderDeduplicator()
+        key = RenderDeduplicator.get_key('<svg/>')
+        self.assertIsNone(deduplicator.get_output_file(key))
+        deduplicator.add_output_file(key, 'a.png')
+        deduplicator.add_output_file(key, 'b.png')
+        self.assertEqual(deduplicator.get_output_file(key), 'a.png')
+
+
+if __name__ == '__main__':
+    unittest.main(exit=False)
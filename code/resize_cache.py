@@ -0,0 +1,187 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+import errno
+import hashlib
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+from collections import OrderedDict
+
+from render_cache import RenderCache, get_file_digest
+
+
+DEFAULT_RESIZE_CACHE_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'python_svg_batch_tools', 'resized')
+DEFAULT_MEMORY_MAX_SIZE = 64 * 1024 * 1024
+
+
+class ResizeCache:
+    """ Cache of resized overlay bitmaps, addressed by overlay content digest, size and resampling filter.
+
+The in-memory tier keeps decoded resized images (Pillow RGBA images), and drops least recently used ones above
+memory_max_size bytes of pixels. The optional on-disk tier (a RenderCache) keeps resized images as PNG files, across
+runs: command line compositors (ImageMagick) use these files directly, in-process ones decode them instead of
+resizing again.
+Cached images are shared: they must never be modified in place.
+"""
+
+    def __init__(self, memory_max_size=DEFAULT_MEMORY_MAX_SIZE, disk_cache=None):
+        self.memory_max_size = memory_max_size
+        self.disk_cache = disk_cache
+        self.images = OrderedDict()
+        self.memory_size = 0
+        self.digests_by_file = {}
+        self.lock = threading.Lock()
+        self.hits_count = 0
+        self.misses_count = 0
+
+    def get_file_digest(self, overlay_file):
+        """ Returns the file content digest, computed once per file. """
+        with self.lock:
+            digest = self.digests_by_file.get(overlay_file)
+        if digest is None:
+            digest = get_file_digest(overlay_file)
+            with self.lock:
+                self.digests_by_file[overlay_file] = digest
+        return digest
+
+    def get_key(self, overlay_file, width=None, height=None, filter_name=''):
+        key_parts = [self.get_file_digest(overlay_file), str(width), str(height), filter_name]
+        return hashlib.sha1('\n'.join(key_parts)).hexdigest()
+
+    def get_image(self, key, image_module=None):
+        """ Returns the cached resized image, from memory, or decoded from the disk tier with the image_module (PIL
+        Image module) if any. Returns None if not cached. """
+        with self.lock:
+            image = self.images.get(key)
+            if image is not None:
+                del self.images[key]
+                self.images[key] = image
+                self.hits_count += 1
+                return image
+        cached_file = self._get_cached_file(key) if image_module else None
+        if cached_file:
+            image = image_module.open(cached_file)
+            image.load()
+            if image.mode != 'RGBA':
+                image = image.convert('RGBA')
+            self._add_to_memory(key, image)
+        with self.lock:
+            if image is None:
+                self.misses_count += 1
+            else:
+                self.hits_count += 1
+        return image
+
+    def add_image(self, key, image):
+        """ Adds a resized image to the memory tier, and to the disk tier if any. """
+        self._add_to_memory(key, image)
+        if self.disk_cache:
+            temporary_fd, temporary_file = tempfile.mkstemp(suffix='.png')
+            os.close(temporary_fd)
+            try:
+                image.save(temporary_file)
+                self.disk_cache.store(key, temporary_file)
+            finally:
+                os.remove(temporary_file)
+
+    def get_file(self, key):
+        """ Returns the path of the cached resized PNG file in the disk tier, or None. """
+        cached_file = self._get_cached_file(key)
+        with self.lock:
+            if cached_file is None:
+                self.misses_count += 1
+            else:
+                self.hits_count += 1
+        return cached_file
+
+    def _get_cached_file(self, key):
+        if not self.disk_cache:
+            return None
+        cached_file = self.disk_cache.get_cached_file(key)
+        try:
+            os.utime(cached_file, None)
+        except OSError as err:
+            if err.errno == errno.ENOENT:
+                return None
+            raise
+        return cached_file
+
+    def add_file(self, key, resized_file):
+        """ Adds a resized PNG file to the disk tier, if any. """
+        if self.disk_cache:
+            self.disk_cache.store(key, resized_file)
+
+    def evict(self):
+        """ Removes least recently used files of the disk tier above its maximum size (see RenderCache.evict). """
+        return self.disk_cache.evict() if self.disk_cache else 0
+
+    def clear(self):
+        with self.lock:
+            self.images.clear()
+            self.memory_size = 0
+
+    def _add_to_memory(self, key, image):
+        image_size = image.size[0] * image.size[1] * 4
+        if image_size > self.memory_max_size:
+            return
+        with self.lock:
+            if key in self.images:
+                return
+            self.images[key] = image
+            self.memory_size += image_size
+            while self.memory_size > self.memory_max_size:
+                evicted_key, evicted_image = self.images.popitem(last=False)
+                self.memory_size -= evicted_image.size[0] * evicted_image.size[1] * 4
+
+
+class _FakeImage:
+    def __init__(self, width, height):
+        self.size = (width, height)
+
+
+class ResizeCacheTestCase(unittest.TestCase):
+    def setUp(self):
+        self.test_dir = tempfile.mkdtemp()
+        self.overlay_file = os.path.join(self.test_dir, 'overlay.png')
+        with open(self.overlay_file, 'w') as overlay_file:
+            overlay_file.write('png data')
+
+    def tearDown(self):
+        shutil.rmtree(self.test_dir)
+
+    def test_computes_keys_from_content_size_and_filter(self):
+        cache = ResizeCache()
+        key = cache.get_key(self.overlay_file, 10, 20, 'lanczos')
+        copy_file = os.path.join(self.test_dir, 'copy.png')
+        shutil.copyfile(self.overlay_file, copy_file)
+        self.assertEqual(key, cache.get_key(copy_file, 10, 20, 'lanczos'))
+        self.assertNotEqual(key, cache.get_key(self.overlay_file, 20, 20, 'lanczos'))
+        self.assertNotEqual(key, cache.get_key(self.overlay_file, 10, 20, 'imagemagick'))
+
+    def test_drops_least_recently_used_images_above_memory_max_size(self):
+        cache = ResizeCache(memory_max_size=2 * 10 * 10 * 4)
+        images = [_FakeImage(10, 10) for index in range(3)]
+        cache.add_image('a', images[0])
+        cache.add_image('b', images[1])
+        self.assertIs(cache.get_image('a'), images[0])
+        cache.add_image('c', images[2])
+        self.assertIsNone(cache.get_image('b'))
+        self.assertIs(cache.get_image('a'), images[0])
+        self.assertIs(cache.get_image('c'), images[2])
+        self.assertEqual((cache.hits_count, cache.misses_count), (3, 1))
+
+    def test_stores_resized_files_in_disk_tier(self):
+        cache = ResizeCache(disk_cache=RenderCache(os.path.join(self.test_dir, 'cache')))
+        key = cache.get_key(self.overlay_file, 10, 20)
+        self.assertIsNone(cache.get_file(key))
+        cache.add_file(key, self.overlay_file)
+        with open(cache.get_file(key)) as cached_file:
+            self.assertEqual(cached_file.read(), 'png data')
+        self.assertEqual((cache.hits_count, cache.misses_count), (1, 1))
+        self.assertIsNone(ResizeCache().get_file(key))
+
+
+if __name__ == '__main__':
+    unittest.main(exit=False)
@@ -0,0 +1,245 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+import os
+import re
+import shutil
+import sys
+import tempfile
+import threading
+import unittest
+from xml.dom import Node
+from xml.dom.minidom import parse, parseString
+
+from bitmap_compositor import BitmapCompositor, get_gravity_position
+from svg_metadata import SvgMetadata, parse_view_box
+from svg_writer import write_svg_document
+
+
+URL_REFERENCE_REGEX = re.compile(r'url\(\s*([\'"]?)#([^)\'"\s]+)\1\s*\)')
+# Attributes linking to an element by '#id'
+HREF_ATTRIBUTES = ['href', 'xlink:href']
+
+
+def format_svg_number(number):
+    return ('%.4f' % number).rstrip('0').rstrip('.')
+
+
+def prefix_svg_ids(root_element, id_prefix):
+    """ Prefixes the ids of the element and its descendants, and updates the references to them: 'url(#id)' in
+    attributes and style sheets, '#id' links and style sheet selectors. References to other ids are left unchanged. """
+    elements = [root_element] + root_element.getElementsByTagName('*')
+    ids = set(element.getAttribute('id') for element in elements if element.getAttribute('id'))
+    if not ids:
+        return
+
+    def replace_url_reference(match):
+        if match.group(2) not in ids:
+            return match.group(0)
+        return 'url(' + match.group(1) + '#' + id_prefix + match.group(2) + match.group(1) + ')'
+    selector_regex = re.compile(r'#(' + '|'.join(re.escape(element_id) for element_id in ids) + r')(?![\w-])')
+    for element in elements:
+        for attribute_name, attribute_value in element.attributes.items():
+            if attribute_name == 'id':
+                element.setAttribute('id', id_prefix + attribute_value)
+            elif attribute_name in HREF_ATTRIBUTES and attribute_value[1:] in ids and attribute_value[:1] == '#':
+                element.setAttribute(attribute_name, '#' + id_prefix + attribute_value[1:])
+            elif 'url(' in attribute_value:
+                element.setAttribute(attribute_name, URL_REFERENCE_REGEX.sub(replace_url_reference, attribute_value))
+        if element.tagName == 'style':
+            for child_node in element.childNodes:
+                if child_node.nodeType in [Node.TEXT_NODE, Node.CDATA_SECTION_NODE]:
+                    style_sheet = URL_REFERENCE_REGEX.sub(replace_url_reference, child_node.data)
+                    child_node.data = selector_regex.sub('#' + id_prefix + r'\1', style_sheet)
+
+
+def get_svg_root_size(svg_root):
+    """ Returns the size of the root <svg> element in pixels, and its view box (None if it has none). """
+    attributes = dict(svg_root.attributes.items())
+    view_box = parse_view_box(attributes.get('viewBox'))
+    metadata = SvgMetadata.from_root_attributes(attributes)
+    if metadata:
+        return (metadata.width, metadata.height), view_box
+    if view_box:
+        # Lengths with units or percentages: the view box gives the proportions
+        return (view_box[2], view_box[3]), view_box
+    return None, None
+
+
+class SvgCompositor(BitmapCompositor):
+    """ Overlays SVG documents over a background SVG document, without rasterizing them.
+
+The overlay document is merged into the background one as a nested <svg> element, scaled by its viewBox to the
+overlay width x height and placed like bitmap overlays (see get_gravity_position), in background pixels. Merged
+documents render at any density with a single render, exactly as the background and overlay documents would.
+Overlay ids are prefixed (see prefix_svg_ids), so that they don't collide with background ones. Overlay style sheets
+are kept as is: their rules apply to the whole merged document.
+Backgrounds are parsed once and kept in memory.
+"""
+    NAME = 'svg'
+    LOG_FILENAME = 'compose_svg.log'
+    ID_PREFIX = 'overlay-'
+
+    def __init__(self):
+        BitmapCompositor.__init__(self)
+        self.backgrounds = {}
+        self.backgrounds_lock = threading.Lock()
+
+    def initialize(self):
+        if not self.initialized:
+            self.about = 'SVG composition'
+            self.available = True
+            self.initialized = True
+
+    def get_background(self, background_file):
+        with self.backgrounds_lock:
+            background_dom = self.backgrounds.get(background_file)
+            if background_dom is None:
+                background_dom = parse(background_file)
+                self.backgrounds[background_file] = background_dom
+            return background_dom
+
+    def compose(self, background_file, overlay_dom, width=None, height=None, offset_x=None, offset_y=None,
+                gravity='center'):
+        """ Returns the merged document. """
+        background_dom = self.get_background(background_file)
+        with self.backgrounds_lock:
+            output_dom = background_dom.cloneNode(True)
+        output_root = output_dom.documentElement
+        background_size, background_view_box = get_svg_root_size(output_root)
+        if not background_size:
+            raise Exception('Size of background document ' + background_file + ' can not be read')
+        overlay_size, overlay_view_box = get_svg_root_size(overlay_dom.documentElement)
+        if not overlay_size:
+            raise Exception('Size of overlay document can not be read')
+        if not overlay_view_box:
+            overlay_view_box = (0, 0, overlay_size[0], overlay_size[1])
+        # Resized to fit in width x height, keeping aspect ratio, like bitmaps (see get_resize_size)
+        scale = 1.0
+        if width and height:
+            scale = min(float(width) / overlay_size[0], float(height) / overlay_size[1])
+        elif width:
+            scale = float(width) / overlay_size[0]
+        elif height:
+            scale = float(height) / overlay_size[1]
+        overlay_size = (overlay_size[0] * scale, overlay_size[1] * scale)
+        x, y = get_gravity_position(background_size, overlay_size, gravity, offset_x, offset_y, exact=True)
+        scale_x, scale_y, origin_x, origin_y = 1.0, 1.0, 0.0, 0.0
+        if background_view_box:
+            # From background pixels to background user units
+            origin_x, origin_y = background_view_box[0], background_view_box[1]
+            scale_x = background_view_box[2] / background_size[0]
+            scale_y = background_view_box[3] / background_size[1]
+        overlay_root = output_dom.importNode(overlay_dom.documentElement, True)
+        prefix_svg_ids(overlay_root, self.ID_PREFIX)
+        overlay_root.setAttribute('viewBox', ' '.join(format_svg_number(number) for number in overlay_view_box))
+        overlay_root.setAttribute('x', format_svg_number(origin_x + x * scale_x))
+        overlay_root.setAttribute('y', format_svg_number(origin_y + y * scale_y))
+        overlay_root.setAttribute('width', format_svg_number(overlay_size[0] * scale_x))
+        overlay_root.setAttribute('height', format_svg_number(overlay_size[1] * scale_y))
+        output_root.appendChild(overlay_root)
+        return output_dom
+
+    def overlay(self, background_file, overlay_file, output_file, width=None, height=None, offset_x=None,
+                offset_y=None, gravity='center'):
+        return self._overlay(background_file, parse, overlay_file, overlay_file, output_file, width, height, offset_x,
+                             offset_y, gravity)
+
+    def overlay_data(self, background_file, overlay_svg_data, output_file, width=None, height=None, offset_x=None,
+                     offset_y=None, gravity='center'):
+        """ Same as overlay(), with the overlay SVG document data held in memory. """
+        return self._overlay(background_file, parseString, overlay_svg_data, '<data>', output_file, width, height,
+                             offset_x, offset_y, gravity)
+
+    def _overlay(self, background_file, parse_function, overlay_source, overlay_name, output_file, width, height,
+                 offset_x, offset_y, gravity):
+        command_line = '[' + self.NAME + '] ' + background_file + ' + ' + overlay_name + ' -> ' + output_file
+        with open(self.LOG_FILENAME, 'a') as log_file:
+            if self.echo_commands:
+                # Single write, so that lines of overlays run in parallel do not interleave
+                sys.stdout.write(command_line + '\n')
+            else:
+                log_file.write(command_line + '\n')
+            try:
+                overlay_dom = parse_function(overlay_source)
+                output_dom = self.compose(background_file, overlay_dom, width, height, offset_x, offset_y, gravity)
+                overlay_dom.unlink()
+                write_svg_document(output_dom, output_file, 'preserve')
+                output_dom.unlink()
+            except Exception as err:
+                log_file.write('Error composing ' + output_file + ': ' + str(err) + '\n')
+                return 1
+        return 0
+
+    def close(self):
+        with self.backgrounds_lock:
+            for background_dom in self.backgrounds.values():
+                background_dom.unlink()
+            self.backgrounds.clear()
+
+
+COMPOSE_TEST_BACKGROUND_SVG = """<?xml version="1.0" encoding="UTF-8"?>
+<svg xmlns="http://www.w3.org/2000/svg" width="200" height="100" viewBox="0 0 100 50">
+  <rect id="shape" width="100" height="50" fill="blue"/>
+</svg>
+"""
+COMPOSE_TEST_OVERLAY_SVG = """<?xml version="1.0" encoding="UTF-8"?>
+<svg xmlns="http://www.w3.org/2000/svg" xmlns:xlink="http://www.w3.org/1999/xlink" width="40" height="20">
+  <style>#shape { stroke: black; } #shape-2 { fill: url(#gradient); }</style>
+  <defs><linearGradient id="gradient"><stop offset="0" stop-color="red"/></linearGradient></defs>
+  <rect id="shape" width="40" height="20" style="fill:url(#gradient)"/>
+  <use xlink:href="#shape" clip-path="url(#unknown)"/>
+</svg>
+"""
+
+
+class SvgCompositorTestCase(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.background_file = os.path.join(self.directory, 'background.svg')
+        with open(self.background_file, 'w') as background_file:
+            background_file.write(COMPOSE_TEST_BACKGROUND_SVG)
+        self.compositor = SvgCompositor()
+
+    def tearDown(self):
+        self.compositor.close()
+        shutil.rmtree(self.directory)
+
+    def test_prefixes_overlay_ids_and_references(self):
+        overlay_root = parseString(COMPOSE_TEST_OVERLAY_SVG).documentElement
+        prefix_svg_ids(overlay_root, 'overlay-')
+        self.assertEqual(overlay_root.getElementsByTagName('style')[0].firstChild.data,
+                         '#overlay-shape { stroke: black; } #shape-2 { fill: url(#overlay-gradient); }')
+        rect = overlay_root.getElementsByTagName('rect')[0]
+        self.assertEqual(rect.getAttribute('id'), 'overlay-shape')
+        self.assertEqual(rect.getAttribute('style'), 'fill:url(#overlay-gradient)')
+        use = overlay_root.getElementsByTagName('use')[0]
+        self.assertEqual(use.getAttribute('xlink:href'), '#overlay-shape')
+        self.assertEqual(use.getAttribute('clip-path'), 'url(#unknown)')
+
+    def test_nests_resized_overlay_in_background_user_units(self):
+        output_dom = self.compositor.compose(self.background_file, parseString(COMPOSE_TEST_OVERLAY_SVG), 100, 100,
+                                             offset_x=10, gravity='southeast')
+        nested_svg = output_dom.documentElement.getElementsByTagName('svg')[0]
+        self.assertEqual([nested_svg.getAttribute(name) for name in ['x', 'y', 'width', 'height', 'viewBox']],
+                         ['45', '25', '50', '25', '0 0 40 20'])
+        self.assertEqual(output_dom.documentElement.getElementsByTagName('rect')[0].getAttribute('id'), 'shape')
+        background_root = self.compositor.get_background(self.background_file).documentElement
+        self.assertEqual(background_root.getElementsByTagName('svg'), [])
+
+    def test_writes_merged_document(self):
+        overlay_file = os.path.join(self.directory, 'overlay.svg')
+        with open(overlay_file, 'w') as overlay_svg_file:
+            overlay_svg_file.write(COMPOSE_TEST_OVERLAY_SVG)
+        output_file = os.path.join(self.directory, 'output.svg')
+        self.compositor.echo_commands = False
+        try:
+            self.assertEqual(self.compositor.overlay(self.background_file, overlay_file, output_file, 40), 0)
+            self.assertEqual(self.compositor.overlay_data(self.background_file, '<svg/>', output_file), 1)
+        finally:
+            os.remove(SvgCompositor.LOG_FILENAME)
+        nested_svg = parse(output_file).documentElement.getElementsByTagName('svg')[0]
+        self.assertEqual(nested_svg.getAttribute('width'), '20')
+
+
+if __name__ == '__main__':
+    unittest.main(exit=False)
@@ -0,0 +1,184 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+import os
+import re
+import tempfile
+import threading
+import unittest
+from StringIO import StringIO
+from xml.etree.cElementTree import iterparse, ParseError
+
+
+LENGTH_REGEX = re.compile(r'^\s*([+-]?(?:[0-9]+\.?[0-9]*|\.[0-9]+)(?:[eE][+-]?[0-9]+)?)\s*(px)?\s*$')
+
+
+def parse_pixel_length(value):
+    """ Returns a length attribute value in pixels, or None if it has no unit or 'px' unit (percentages and absolute
+    units depend on the renderer resolution, they are left to the renderer). """
+    if value is None:
+        return None
+    match = LENGTH_REGEX.match(value)
+    if not match:
+        return None
+    return float(match.group(1))
+
+
+def parse_view_box(value):
+    """ Returns a viewBox attribute value as a tuple of floats (min_x, min_y, width, height), or None. """
+    if value is None:
+        return None
+    try:
+        view_box = tuple(float(number) for number in value.replace(',', ' ').split())
+    except ValueError:
+        return None
+    if len(view_box) != 4 or view_box[2] <= 0 or view_box[3] <= 0:
+        return None
+    return view_box
+
+
+class SvgMetadata:
+    """ Intrinsic size of a SVG document: width and height in pixels, view box and density (dots per inch).
+
+Density is the one ImageMagick reports for SVG documents: 72 dpi (see SvgToPngImageMagickRenderer).
+"""
+    DEFAULT_DENSITY = 72.0
+
+    def __init__(self, width, height, view_box=None, density_x=DEFAULT_DENSITY, density_y=DEFAULT_DENSITY):
+        self.width = width
+        self.height = height
+        self.view_box = view_box
+        self.density_x = density_x
+        self.density_y = density_y
+
+    def __repr__(self):
+        return '[SvgMetadata]\t' + str(self.width) + '\t' + str(self.height) + '\t' + str(self.view_box) + '\t' \
+               + str(self.density_x) + '\t' + str(self.density_y)
+
+    @classmethod
+    def from_svg_file(cls, svg_file):
+        """ Reads the root <svg> element only, without parsing the rest of the document.
+        Returns None if the intrinsic size can't be computed from its attributes. """
+        try:
+            for event, element in iterparse(svg_file, events=('start',)):
+                return cls.from_root_attributes(element.attrib)
+        except (ParseError, IOError):
+            return None
+        return None
+
+    @classmethod
+    def from_svg_data(cls, svg_data):
+        """ Same as from_svg_file(), for a document in memory. """
+        return cls.from_svg_file(StringIO(svg_data))
+
+    @classmethod
+    def from_root_attributes(cls, attributes):
+        view_box = parse_view_box(attributes.get('viewBox'))
+        width = parse_pixel_length(attributes.get('width'))
+        height = parse_pixel_length(attributes.get('height'))
+        if view_box:
+            if 'width' not in attributes and 'height' not in attributes:
+                width, height = view_box[2], view_box[3]
+            elif 'width' not in attributes and height:
+                width = height * view_box[2] / view_box[3]
+            elif 'height' not in attributes and width:
+                height = width * view_box[3] / view_box[2]
+        if not width or not height:
+            return None
+        return cls(width, height, view_box)
+
+
+class SvgMetadataCache:
+    """ Cache of SvgMetadata by SVG file path.
+
+probe() reads metadata of a whole set of files in one pass: directly from the root <svg> element when possible, then
+with a single call to the fallback probe function for the remaining files (lengths with units or percentages).
+The fallback function takes a list of SVG file paths and returns a dict of SvgMetadata by path.
+"""
+
+    def __init__(self, fallback_probe_function=None):
+        self.fallback_probe_function = fallback_probe_function
+        self.metadata_by_file = {}
+        self.lock = threading.Lock()
+
+    def probe(self, svg_files):
+        unresolved_files = []
+        for svg_file in svg_files:
+            if svg_file in self.metadata_by_file:
+                continue
+            metadata = SvgMetadata.from_svg_file(svg_file)
+            if metadata:
+                self.metadata_by_file[svg_file] = metadata
+            else:
+                unresolved_files.append(svg_file)
+        if unresolved_files and self.fallback_probe_function:
+            self.metadata_by_file.update(self.fallback_probe_function(unresolved_files))
+
+    def get(self, svg_file):
+        """ Returns the file SvgMetadata, probing it if not done yet. Returns None if it could not be read. """
+        with self.lock:
+            if svg_file not in self.metadata_by_file:
+                self.probe([svg_file])
+            return self.metadata_by_file.get(svg_file)
+
+    def forget(self, svg_files):
+        """ Drops metadata of files changed since probed. """
+        with self.lock:
+            for svg_file in svg_files:
+                self.metadata_by_file.pop(svg_file, None)
+
+
+class SvgMetadataTestCase(unittest.TestCase):
+    def test_reads_pixel_size_from_root_attributes(self):
+        metadata = SvgMetadata.from_root_attributes({'width': '48px', 'height': '24', 'viewBox': '0 0 96 48'})
+        self.assertEqual((metadata.width, metadata.height), (48, 24))
+        self.assertEqual(metadata.view_box, (0, 0, 96, 48))
+        self.assertEqual(metadata.density_x, SvgMetadata.DEFAULT_DENSITY)
+
+    def test_computes_missing_size_from_view_box(self):
+        metadata = SvgMetadata.from_root_attributes({'viewBox': '0,0,100,50'})
+        self.assertEqual((metadata.width, metadata.height), (100, 50))
+        metadata = SvgMetadata.from_root_attributes({'width': '20', 'viewBox': '0 0 100 50'})
+        self.assertEqual((metadata.width, metadata.height), (20, 10))
+
+    def test_does_not_resolve_units_or_percentages(self):
+        self.assertIsNone(SvgMetadata.from_root_attributes({'width': '10mm', 'height': '10mm'}))
+        self.assertIsNone(SvgMetadata.from_root_attributes({'width': '100%', 'height': '100%', 'viewBox': '0 0 1 1'}))
+        self.assertIsNone(SvgMetadata.from_root_attributes({}))
+
+    def test_reads_test_files_root_element(self):
+        metadata = SvgMetadata.from_svg_file('../tests/svg/androidstudio.svg')
+        self.assertIsNotNone(metadata)
+        self.assertTrue(metadata.width > 0 and metadata.height > 0)
+
+    def test_reads_document_data_root_element(self):
+        metadata = SvgMetadata.from_svg_data('<svg xmlns="http://www.w3.org/2000/svg" width="32" height="16"><g/>'
+                                             '</svg>')
+        self.assertEqual((metadata.width, metadata.height), (32, 16))
+        self.assertIsNone(SvgMetadata.from_svg_data('not a document'))
+
+
+class SvgMetadataCacheTestCase(unittest.TestCase):
+    def setUp(self):
+        self.svg_file = tempfile.NamedTemporaryFile(suffix='.svg', delete=False)
+        self.svg_file.write('<svg xmlns="http://www.w3.org/2000/svg" width="1in" height="1in"/>')
+        self.svg_file.close()
+        self.fallback_calls = []
+
+    def tearDown(self):
+        os.remove(self.svg_file.name)
+
+    def _fallback_probe(self, svg_files):
+        self.fallback_calls.append(svg_files)
+        return dict((svg_file, SvgMetadata(90, 90, density_x=90, density_y=90)) for svg_file in svg_files)
+
+    def test_probes_unresolved_files_with_one_fallback_call_and_caches_results(self):
+        cache = SvgMetadataCache(self._fallback_probe)
+        cache.probe(['../tests/svg/androidstudio.svg', self.svg_file.name, '../tests/svg/test_2.svg'])
+        self.assertEqual(self.fallback_calls, [[self.svg_file.name]])
+        self.assertEqual(cache.get(self.svg_file.name).density_x, 90)
+        self.assertIsNotNone(cache.get('../tests/svg/androidstudio.svg'))
+        self.assertEqual(len(self.fallback_calls), 1)
+
+
+if __name__ == '__main__':
+    unittest.main(exit=False)
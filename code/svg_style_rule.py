@@ -1,35 +1,91 @@
 #! /usr/bin/env python
 # -*- coding: utf-8 -*-
+import hashlib
 import json
-from xml.dom.minidom import parse
+import os
+import shutil
+import tempfile
+import unittest
+from bisect import bisect_left
+from xml.dom.minidom import parse, parseString
+
+import file_utils as utils
+from color_string import parse_color
+from svg_writer import write_svg_document
 
 
 def split_xml_attribute_properties(value):
     return value.rstrip(';').split(';')
 
 
-def set_attribute_inner_property(xml_element, attribute_name, property_name, property_value):
-    """ Sets or updates an XML attribute inner property.
+class SvgElementStyle:
+    """ Style properties of a SVG element, decoded once to be matched and updated by any number of rules.
 
-Typically for attribute with multiple properties like:
-'<element attribute="property_a:value_a;property_b:value_b"/>'
+The "style" attribute is split once into an ordered list of [name, property string] entries, and property values are
+kept lowercase for matching. Properties defined as attributes are read and updated directly on the element, inner
+properties of the "style" attribute are only updated in this representation: write() serializes the "style" attribute
+back to the element, once all rules were applied.
+Unchanged inner properties are written back as found in the original attribute value.
 """
-    updated_property_string = property_name + ':' + property_value
-    if xml_element.attributes.get(attribute_name) is None:
-        xml_element.setAttribute(attribute_name, updated_property_string)
-    else:
-        attribute_value = xml_element.attributes[attribute_name].value
-        updated_value = ''
-        found_property = False
-        for property_string in split_xml_attribute_properties(attribute_value):
-            p_name, p_value = property_string.split(':')
-            if p_name == property_name:
-                updated_value = attribute_value.replace(p_name + ':' + p_value, updated_property_string)
-                found_property = True
-                break
-        if not found_property:
-            updated_value = attribute_value.rstrip(';') + ';' + updated_property_string
-        xml_element.setAttribute(attribute_name, updated_value)
+
+    def __init__(self, svg_element):
+        self.svg_element = svg_element
+        self.style_entries = []
+        self.style_entry_indices = {}
+        # {property name: lowercase value, or None if not defined}
+        self.values = {}
+        self.style_trailing_separator = False
+        self.style_updated = False
+        style_attribute = svg_element.attributes.get('style')
+        if style_attribute is not None:
+            self.style_trailing_separator = style_attribute.value.endswith(';')
+            for property_string in split_xml_attribute_properties(style_attribute.value):
+                if not property_string:
+                    continue
+                name = property_string.split(':', 1)[0]
+                if name not in self.style_entry_indices:
+                    self.style_entry_indices[name] = len(self.style_entries)
+                self.style_entries.append([name, property_string])
+
+    def get_value(self, property_name):
+        """ Returns the lowercase value of a style property, either defined as an attribute or in the "style"
+        attribute. Returns None if the property is not defined. """
+        if property_name in self.values:
+            return self.values[property_name]
+        property_attribute = self.svg_element.attributes.get(property_name)
+        if property_attribute is not None:
+            value = property_attribute.value.lower()
+        elif property_name in self.style_entry_indices:
+            value = self.style_entries[self.style_entry_indices[property_name]][1].split(':', 1)[1].lower()
+        else:
+            value = None
+        self.values[property_name] = value
+        return value
+
+    def set_value(self, property_name, property_value):
+        """ Updates a property in its current form, or adds it to the "style" attribute if not defined. """
+        if self.svg_element.attributes.get(property_name) is not None:
+            self.svg_element.setAttribute(property_name, property_value)
+        else:
+            property_string = property_name + ':' + property_value
+            entry_index = self.style_entry_indices.get(property_name)
+            if entry_index is None:
+                self.style_entry_indices[property_name] = len(self.style_entries)
+                self.style_entries.append([property_name, property_string])
+                self.style_trailing_separator = False
+            else:
+                self.style_entries[entry_index][1] = property_string
+            self.style_updated = True
+        self.values[property_name] = property_value.lower()
+
+    def write(self):
+        """ Serializes the "style" attribute back to the element, if updated. """
+        if self.style_updated:
+            style_value = ';'.join(property_string for name, property_string in self.style_entries)
+            if self.style_trailing_separator:
+                style_value += ';'
+            self.svg_element.setAttribute('style', style_value)
+            self.style_updated = False
 
 
 class SvgStyleProperty:
@@ -47,10 +103,23 @@ Form B: '<element style="property:value"/>'
     # - <style> tag embedding CSS
     # - external CSS file
     # TODO: add tests for SvgStyleProperty class
+    # Properties matched by color, whatever its format: '#F00', '#ff0000', 'rgb(255,0,0)' and 'red' match each other
+    COLOR_PROPERTY_NAMES = frozenset(['fill', 'stroke'])
 
     def __init__(self, name, value):
         self.name = name
         self.value = value
+        self.match_key = SvgStyleProperty.get_match_key(name, value.lower())
+
+    @staticmethod
+    def get_match_key(property_name, value):
+        """ Returns what a lowercase property value is matched by: its Color for color properties, if it is a color,
+        the value itself otherwise. """
+        if property_name in SvgStyleProperty.COLOR_PROPERTY_NAMES:
+            color = parse_color(value)
+            if color is not None:
+                return color
+        return value
 
     def __repr__(self):
         return self.name + ':' + self.value
@@ -58,33 +127,24 @@ Form B: '<element style="property:value"/>'
     def match_element(self, svg_element):
         """ Checks if the rule matches the given element style properties.
         Property set to 'none' will match elements where it is not found. """
-        property_attribute = svg_element.attributes.get(self.name)
-        if property_attribute is not None:
-            return property_attribute.value.lower() == self.value.lower()
-        found_property = False
-        style_attribute = svg_element.attributes.get('style')
-        if style_attribute is not None:
-            found_property, matched = self._match_attribute_value(style_attribute.value)
-            if matched:
-                return True
-        if not found_property and self.value == 'none':
-            return True
-        return False
-
-    def _match_attribute_value(self, value):
-        """ Returns a tuple with two booleans: (found, matched) """
-        for property_string in split_xml_attribute_properties(value):
-            property_name, property_value = property_string.split(':')
-            if property_name == self.name:
-                return True, property_value.lower() == self.value.lower()
-        return False, False
+        return self.match_style(SvgElementStyle(svg_element))
+
+    def match_style(self, element_style):
+        return self.match_value(element_style.get_value(self.name))
+
+    def match_value(self, element_value):
+        """ Checks if the property matches the given lowercase element value (None if not defined). """
+        if element_value is None:
+            return self.value == 'none'
+        return SvgStyleProperty.get_match_key(self.name, element_value) == self.match_key
 
     def apply_to_element(self, svg_element):
-        property_attribute = svg_element.attributes.get(self.name)
-        if property_attribute is not None:
-            svg_element.setAttribute(self.name, self.value)
-        else:
-            set_attribute_inner_property(svg_element, 'style', self.name, self.value)
+        element_style = SvgElementStyle(svg_element)
+        self.apply_to_style(element_style)
+        element_style.write()
+
+    def apply_to_style(self, element_style):
+        element_style.set_value(self.name, self.value)
 
 
 class SvgStyleRule:
@@ -122,27 +182,121 @@ class SvgStyleRule:
         return style_properties
 
     def match_element(self, svg_element):
+        return self.match_style(SvgElementStyle(svg_element))
+
+    def match_style(self, element_style):
         if self.properties_to_match:
             for property_to_match in self.properties_to_match:
-                if not property_to_match.match_element(svg_element):
+                if not property_to_match.match_style(element_style):
                     return False
         return True
 
     def apply_to_element(self, svg_element):
+        element_style = SvgElementStyle(svg_element)
+        self.apply_to_style(element_style)
+        element_style.write()
+
+    def apply_to_style(self, element_style):
         for property_to_set in self.properties_to_set:
-            property_to_set.apply_to_element(svg_element)
+            property_to_set.apply_to_style(element_style)
 
     def apply_to_document(self, svg_dom):
         applied = False
         for primitiveTag in SvgStyleRule.STYLABLE_SVG_ELEMENTS:
             svg_elements = svg_dom.getElementsByTagName(primitiveTag)
             for svgElement in svg_elements:
-                if self.match_element(svgElement):
-                    self.apply_to_element(svgElement)
+                element_style = SvgElementStyle(svgElement)
+                if self.match_style(element_style):
+                    self.apply_to_style(element_style)
+                    element_style.write()
                     applied = True
         return applied
 
 
+def iter_stylable_elements(svg_dom):
+    """ Yields elements of the document that style rules apply to, in document order. """
+    stylable_tag_names = frozenset(SvgStyleRule.STYLABLE_SVG_ELEMENTS)
+    nodes_to_visit = [svg_dom]
+    while nodes_to_visit:
+        node = nodes_to_visit.pop()
+        if node.nodeType == node.ELEMENT_NODE and node.tagName in stylable_tag_names:
+            yield node
+        if node.childNodes:
+            nodes_to_visit.extend(reversed(node.childNodes))
+
+
+class SvgStyleRuleSet:
+    """ List of style rules compiled to be applied to a document in a single pass.
+
+Each element is visited once, and all rules are evaluated for it, in order: an element updated by a rule is matched by
+the next rules with its updated properties, exactly as when each rule is applied to the whole document in turn.
+Rules are indexed by the value of their first property to match, so that finding the next rule matching an element only
+costs a dictionary lookup per matched property name, instead of evaluating every rule. Element styles are decoded once
+(see SvgElementStyle) and written back once all rules were applied.
+"""
+
+    def __init__(self, rules):
+        self.rules = list(rules)
+        self.rule_matches = []
+        self.unconditional_rule_indices = []
+        # {property name: {match key: [rule indices]}} of rules first property to match (see get_match_key)
+        self.rule_indices_by_value = {}
+        # {property name: [rule indices]} of rules with a first property to match set to 'none'
+        self.rule_indices_if_undefined = {}
+        for index, rule in enumerate(self.rules):
+            matches = [(property_to_match.name, property_to_match)
+                       for property_to_match in (rule.properties_to_match or [])]
+            self.rule_matches.append(matches)
+            if not matches:
+                self.unconditional_rule_indices.append(index)
+                continue
+            name, property_to_match = matches[0]
+            rule_indices_by_value = self.rule_indices_by_value.setdefault(name, {})
+            rule_indices_by_value.setdefault(property_to_match.match_key, []).append(index)
+            if property_to_match.value == 'none':
+                self.rule_indices_if_undefined.setdefault(name, []).append(index)
+
+    def apply_to_document(self, svg_dom):
+        """ Returns a list of booleans: for each rule, whether it was applied to at least one element. """
+        applied = [False] * len(self.rules)
+        for svg_element in iter_stylable_elements(svg_dom):
+            self.apply_to_element(svg_element, applied)
+        return applied
+
+    def apply_to_element(self, svg_element, applied):
+        """ Applies matching rules to the element, in order, and flags them in the applied list. """
+        element_style = SvgElementStyle(svg_element)
+        rule_index = self._find_next_candidate(element_style, 0)
+        while rule_index is not None:
+            if self._match_style(element_style, rule_index):
+                self.rules[rule_index].apply_to_style(element_style)
+                applied[rule_index] = True
+            rule_index = self._find_next_candidate(element_style, rule_index + 1)
+        element_style.write()
+
+    def _find_next_candidate(self, element_style, first_index):
+        """ Returns the index of the first rule from first_index that may match the element, or None. """
+        candidate_index = None
+        candidate_lists = [self.unconditional_rule_indices]
+        for name, rule_indices_by_value in self.rule_indices_by_value.items():
+            value = element_style.get_value(name)
+            if value is None:
+                candidate_lists.append(self.rule_indices_if_undefined.get(name, []))
+            else:
+                candidate_lists.append(rule_indices_by_value.get(SvgStyleProperty.get_match_key(name, value), []))
+        for rule_indices in candidate_lists:
+            position = bisect_left(rule_indices, first_index)
+            if position < len(rule_indices) and (candidate_index is None or rule_indices[position] < candidate_index):
+                candidate_index = rule_indices[position]
+        return candidate_index
+
+    def _match_style(self, element_style, rule_index):
+        for name, property_to_match in self.rule_matches[rule_index]:
+            if not property_to_match.match_value(element_style.get_value(name)):
+                return False
+        return True
+
+
 class SvgStyleRulesManager:
     """ Manager of a list of SVG style rules, loaded from a JSON file.
 
@@ -163,9 +317,26 @@ Style rules JSON format:
 
     def __init__(self):
         self.rules = []
+        self.rule_set = None
 
     def add_rule(self, rule):
         self.rules.append(rule)
+        self.rule_set = None
+
+    def get_rule_set(self):
+        """ Returns the rules compiled for single pass application, compiled once. """
+        if self.rule_set is None:
+            self.rule_set = SvgStyleRuleSet(self.rules)
+        return self.rule_set
+
+    def get_digest(self):
+        """ Returns a digest of the properties to match and to set of all rules, in order. Rule names and rules file
+        formatting do not change it. """
+        digest = hashlib.sha1()
+        for rule in self.rules:
+            for properties in [rule.properties_to_match or [], rule.properties_to_set or []]:
+                digest.update((';'.join(repr(style_property) for style_property in properties) + '\n').encode('utf-8'))
+        return digest.hexdigest()
 
     def load_rules_from_json(self, rules_json_file_path):
         with open(rules_json_file_path) as json_file:
@@ -174,12 +345,186 @@ Style rules JSON format:
             rule = SvgStyleRule()
             rule.load_from_json(rule_json)
             self.rules.append(rule)
+        self.rule_set = None
 
-    def apply_rules_to_svg_file(self, svg_input_file, svg_output_file):
-        svg_dom = parse(svg_input_file)
-        for rule in self.rules:
-            applied = rule.apply_to_document(svg_dom)
-            if applied:
-                print ' applied ' + str(rule)
-        with open(svg_output_file, 'w') as output_file:
-            output_file.write(svg_dom.toprettyxml().encode('utf-8'))
+    def apply_rules_to_svg_dom(self, svg_dom):
+        """ Returns the list of rules applied to at least one element, in rules order. """
+        return [rule for rule, applied in zip(self.rules, self.get_rule_set().apply_to_document(svg_dom)) if applied]
+
+    def apply_rules_to_svg_file(self, svg_input_file, svg_output_file, output_format='pretty', write_unchanged=True):
+        """ Returns the list of rules applied to at least one element, in rules order.
+        The output file is not written if no rule applied and write_unchanged is False. See write_svg_document() for
+        output formats. """
+        return apply_themes_to_svg_file(svg_input_file, [(self, svg_output_file)], output_format, write_unchanged)[0]
+
+
+def get_theme_name(rules_file):
+    return os.path.splitext(os.path.basename(rules_file))[0]
+
+
+def load_style_themes(rules_files_or_dirs):
+    """ Returns a list of (theme name, SvgStyleRulesManager), one theme per JSON rules file, named after the file.
+    Directories are searched for JSON rules files, in name order. """
+    themes = []
+    for rules_file_or_dir in rules_files_or_dirs:
+        rules_files = sorted(utils.get_file_paths(rules_file_or_dir, utils.is_json_file))
+        if not rules_files:
+            raise Exception('No JSON rules file found at "' + rules_file_or_dir + '"')
+        for rules_file in rules_files:
+            rules_manager = SvgStyleRulesManager()
+            rules_manager.load_rules_from_json(rules_file)
+            themes.append((get_theme_name(rules_file), rules_manager))
+    theme_names = [theme_name for theme_name, rules_manager in themes]
+    for theme_name in theme_names:
+        if theme_names.count(theme_name) > 1:
+            raise Exception('Several rules files define theme "' + theme_name + '". Theme names must be unique.')
+    return themes
+
+
+def apply_themes_to_svg_file(svg_input_file, themed_outputs, output_format='pretty', write_unchanged=True):
+    """ Applies several sets of rules to a SVG file, each one to its own output file. themed_outputs is a list of
+    (SvgStyleRulesManager, output file) tuples. Returns the lists of applied rules, in themed_outputs order.
+
+    The file is parsed once: each set of rules applies to a deep copy of the original document, cloned in memory, except
+    the last one, which updates the original document itself.
+    """
+    pristine_svg_dom = parse(svg_input_file)
+    applied_rules_list = []
+    for index, (rules_manager, svg_output_file) in enumerate(themed_outputs):
+        last_theme = index == len(themed_outputs) - 1
+        svg_dom = pristine_svg_dom if last_theme else pristine_svg_dom.cloneNode(True)
+        applied_rules = rules_manager.apply_rules_to_svg_dom(svg_dom)
+        if applied_rules or write_unchanged:
+            write_svg_document(svg_dom, svg_output_file, output_format)
+        svg_dom.unlink()
+        applied_rules_list.append(applied_rules)
+    return applied_rules_list
+
+
+class SvgElementStyleTestCase(unittest.TestCase):
+    def test_reads_attribute_and_inner_properties(self):
+        element_style = SvgElementStyle(parseString('<path fill="#00FFFF" style="stroke:#FF0000;opacity:1"/>')
+                                        .documentElement)
+        self.assertEqual(element_style.get_value('fill'), '#00ffff')
+        self.assertEqual(element_style.get_value('stroke'), '#ff0000')
+        self.assertIsNone(element_style.get_value('stroke-width'))
+
+    def test_writes_updated_style_once_keeping_unchanged_properties(self):
+        svg_element = parseString('<path fill="none" style="stroke: red;opacity:1;"/>').documentElement
+        element_style = SvgElementStyle(svg_element)
+        element_style.set_value('fill', '#00FFFF')
+        element_style.set_value('opacity', '0.5')
+        self.assertEqual(svg_element.getAttribute('fill'), '#00FFFF')
+        self.assertEqual(svg_element.getAttribute('style'), 'stroke: red;opacity:1;')
+        self.assertEqual(element_style.get_value('opacity'), '0.5')
+        element_style.write()
+        self.assertEqual(svg_element.getAttribute('style'), 'stroke: red;opacity:0.5;')
+        element_style.set_value('stroke-width', '2')
+        element_style.write()
+        self.assertEqual(svg_element.getAttribute('style'), 'stroke: red;opacity:0.5;stroke-width:2')
+
+
+RULE_SET_TEST_SVG = """<svg xmlns="http://www.w3.org/2000/svg">
+  <path fill="#00FFFF"/>
+  <g><circle style="fill:#00ffff;stroke:none"/><rect fill="none"/></g>
+  <ellipse fill="none" stroke="#000000"/>
+  <line style="stroke:#ff0000"/>
+  <polygon/>
+</svg>
+"""
+
+RULE_SET_TEST_RULES = [
+    {"match": "stroke:#ff0000", "set": "stroke:none"},
+    {"match": "fill:none", "set": "fill:#00ffff"},
+    {"match": "fill:#00ffff", "set": "fill:#ff00ff;stroke:#00ff00"},
+    {"match": "stroke:none", "set": "stroke:#00ffff;stroke-width:2"},
+    {"set": "opacity:0.5"},
+    {"match": "stroke:#00ff00;fill:#ff00ff", "set": "stroke-width:4"},
+    {"match": "stroke:none", "set": "stroke:#000000"},
+    {"match": "rule:impossible", "set": "fill:#00346b"}
+]
+
+
+class SvgStyleRuleSetTestCase(unittest.TestCase):
+    def _load_rules(self, rules_json):
+        rules = []
+        for rule_json in rules_json:
+            rule = SvgStyleRule()
+            rule.load_from_json(rule_json)
+            rules.append(rule)
+        return rules
+
+    def _assert_same_results(self, svg_string, rules):
+        sequential_dom = parseString(svg_string)
+        sequential_applied = [rule.apply_to_document(sequential_dom) for rule in rules]
+        single_pass_dom = parseString(svg_string)
+        single_pass_applied = SvgStyleRuleSet(rules).apply_to_document(single_pass_dom)
+        self.assertEqual(single_pass_applied, sequential_applied)
+        self.assertEqual(single_pass_dom.toxml(), sequential_dom.toxml())
+
+    def test_applies_rules_in_single_pass_like_sequential_rules(self):
+        self._assert_same_results(RULE_SET_TEST_SVG, self._load_rules(RULE_SET_TEST_RULES))
+
+    def test_applies_test_rules_file_to_test_files_like_sequential_rules(self):
+        rules_manager = SvgStyleRulesManager()
+        rules_manager.load_rules_from_json('../tests/update_style_rules.json')
+        for svg_file_name in ['androidstudio.svg', 'sapin.svg', 'test_2.svg', 'test_css.svg', 'test_path.svg',
+                              'test_shapes_no_fill_color.svg', 'test_shapes_with_stroke_and_color.svg',
+                              'test_transform.svg', 'test_use.svg']:
+            with open('../tests/svg/' + svg_file_name) as svg_file:
+                self._assert_same_results(svg_file.read(), rules_manager.rules)
+
+    def test_matches_undefined_property_with_none_value_only(self):
+        svg_element = parseString('<path style="stroke:#000000"/>').documentElement
+        self.assertTrue(SvgStyleProperty('fill', 'none').match_element(svg_element))
+        self.assertFalse(SvgStyleProperty('stroke', 'none').match_element(svg_element))
+        self.assertTrue(SvgStyleProperty('stroke', '#000000').match_element(svg_element))
+
+    def test_matches_colors_whatever_their_format(self):
+        svg_string = '<svg><path fill="#F00"/><path style="fill: rgb(255,0,0)"/><path fill="Red" stroke="#f00"/></svg>'
+        rules = self._load_rules([{"match": "fill:#ff0000", "set": "fill:#0000ff"},
+                                  {"match": "stroke:red", "set": "stroke:none"}])
+        svg_dom = parseString(svg_string)
+        self.assertEqual(SvgStyleRuleSet(rules).apply_to_document(svg_dom), [True, True])
+        self.assertEqual([path.toxml() for path in svg_dom.getElementsByTagName('path')],
+                         ['<path fill="#0000ff"/>', '<path style="fill:#0000ff"/>',
+                          '<path fill="#0000ff" stroke="none"/>'])
+        self._assert_same_results(svg_string, rules)
+
+
+class SvgStyleThemesTestCase(unittest.TestCase):
+    def setUp(self):
+        self.test_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.test_dir)
+
+    def test_applies_themes_to_copies_of_a_single_parsed_document(self):
+        red_rules_manager = SvgStyleRulesManager()
+        red_rules_manager.load_rules_from_json('../tests/update_style_rules.json')
+        green_rules_manager = SvgStyleRulesManager()
+        green_rules_manager.add_rule(SvgStyleRule([SvgStyleProperty('fill', '#00ff00')], name='green'))
+        svg_file = '../tests/svg/test_shapes_no_fill_color.svg'
+        themed_outputs = [(rules_manager, os.path.join(self.test_dir, name + '.svg')) for name, rules_manager in
+                          [('red', red_rules_manager), ('green', green_rules_manager)]]
+        applied_rules_list = apply_themes_to_svg_file(svg_file, themed_outputs)
+        self.assertEqual([[rule.name for rule in applied_rules] for applied_rules in applied_rules_list],
+                         [[red_rules_manager.rules[0].name, red_rules_manager.rules[2].name], ['green']])
+        for rules_manager, output_file in themed_outputs:
+            expected_output_file = os.path.join(self.test_dir, 'expected.svg')
+            rules_manager.apply_rules_to_svg_file(svg_file, expected_output_file)
+            with open(output_file) as output, open(expected_output_file) as expected_output:
+                self.assertEqual(output.read(), expected_output.read())
+
+    def test_loads_one_theme_per_rules_file(self):
+        for theme_name in ['dark', 'light']:
+            shutil.copy('../tests/update_style_rules.json', os.path.join(self.test_dir, theme_name + '.json'))
+        themes = load_style_themes([self.test_dir])
+        self.assertEqual([theme_name for theme_name, rules_manager in themes], ['dark', 'light'])
+        self.assertEqual(len(themes[1][1].rules), 4)
+        with self.assertRaises(Exception):
+            load_style_themes([self.test_dir, os.path.join(self.test_dir, 'dark.json')])
+
+
+if __name__ == '__main__':
+    unittest.main(exit=False)
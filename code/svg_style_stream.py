@@ -0,0 +1,202 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+import os
+import shutil
+import tempfile
+import unittest
+from collections import OrderedDict
+from xml.dom.minidom import parse
+from xml.parsers import expat
+from xml.sax.saxutils import escape
+
+from svg_style_rule import SvgStyleRule, SvgStyleRuleSet, SvgStyleRulesManager
+
+
+ATTRIBUTE_ENTITIES = {'"': '&quot;', '\n': '&#10;', '\r': '&#13;', '\t': '&#9;'}
+
+
+class SvgStreamAttribute:
+    def __init__(self, value):
+        self.value = value
+
+
+class SvgStreamElement:
+    """ Element read from a SVG stream, with the subset of xml.dom.minidom Element interface used by style rules. """
+
+    def __init__(self, tag_name, attribute_list):
+        self.tagName = tag_name
+        self.attributes = OrderedDict()
+        for index in range(0, len(attribute_list), 2):
+            self.attributes[attribute_list[index]] = SvgStreamAttribute(attribute_list[index + 1])
+
+    def setAttribute(self, name, value):
+        attribute = self.attributes.get(name)
+        if attribute is None:
+            self.attributes[name] = SvgStreamAttribute(value)
+        else:
+            attribute.value = value
+
+
+class SvgStyleStreamUpdater:
+    """ Applies style rules to a SVG file while streaming it to the output file.
+
+The document is never loaded as a whole: expat parser callbacks handle it element by element, so memory use does not
+depend on the document size. Rules only depend on each element own attributes, so applying all rules, in order, to each
+element gives the same result as applying each rule to the whole document in turn.
+Everything but updated elements is written as found in the input: formatting, comments, DOCTYPE, processing
+instructions, CDATA sections and entity references. Output is UTF-8 encoded: character references are written as
+characters. Empty elements are written as self-closing tags.
+"""
+    BUFFER_SIZE = 65536
+
+    def __init__(self, rules):
+        self.rules = rules
+        self.rule_set = SvgStyleRuleSet(rules)
+        self.output_file = None
+        self.pending_start_tag = None
+        self.in_cdata = False
+        self.applied_rules = None
+
+    def update_file(self, svg_input_file, svg_output_file):
+        """ Returns the list of rules applied to at least one element, in rules order. """
+        self.pending_start_tag = None
+        self.in_cdata = False
+        applied = [False] * len(self.rules)
+        self.applied_rules = applied
+        parser = expat.ParserCreate()
+        parser.ordered_attributes = True
+        parser.buffer_text = True
+        parser.buffer_size = SvgStyleStreamUpdater.BUFFER_SIZE
+        parser.XmlDeclHandler = self._xml_declaration
+        parser.StartElementHandler = self._start_element
+        parser.EndElementHandler = self._end_element
+        parser.CharacterDataHandler = self._character_data
+        parser.StartCdataSectionHandler = self._start_cdata
+        parser.EndCdataSectionHandler = self._end_cdata
+        parser.DefaultHandler = self._default
+        with open(svg_input_file, 'rb') as input_file, open(svg_output_file, 'wb') as output_file:
+            self.output_file = output_file
+            parser.ParseFile(input_file)
+            self._flush_pending_start_tag()
+        self.output_file = None
+        return [rule for rule, rule_applied in zip(self.rules, applied) if rule_applied]
+
+    def _write(self, text):
+        self.output_file.write(text.encode('utf-8'))
+
+    def _flush_pending_start_tag(self):
+        if self.pending_start_tag is not None:
+            self._write(self.pending_start_tag + '>')
+            self.pending_start_tag = None
+
+    def _xml_declaration(self, version, encoding, standalone):
+        declaration = '<?xml version="' + (version or '1.0') + '" encoding="utf-8"'
+        if standalone != -1:
+            declaration += ' standalone="' + ('yes' if standalone else 'no') + '"'
+        self._write(declaration + '?>')
+
+    def _start_element(self, name, attribute_list):
+        self._flush_pending_start_tag()
+        element = SvgStreamElement(name, attribute_list)
+        if name in SvgStyleRule.STYLABLE_SVG_ELEMENTS:
+            self.rule_set.apply_to_element(element, self.applied_rules)
+        start_tag = '<' + name
+        for attribute_name, attribute in element.attributes.items():
+            start_tag += ' ' + attribute_name + '="' + escape(attribute.value, ATTRIBUTE_ENTITIES) + '"'
+        self.pending_start_tag = start_tag
+
+    def _end_element(self, name):
+        if self.pending_start_tag is not None:
+            self._write(self.pending_start_tag + '/>')
+            self.pending_start_tag = None
+        else:
+            self._write('</' + name + '>')
+
+    def _character_data(self, data):
+        self._flush_pending_start_tag()
+        self._write(data if self.in_cdata else escape(data))
+
+    def _start_cdata(self):
+        self._flush_pending_start_tag()
+        self._write('<![CDATA[')
+        self.in_cdata = True
+
+    def _end_cdata(self):
+        self._write(']]>')
+        self.in_cdata = False
+
+    def _default(self, data):
+        """ Any markup without a dedicated handler (comments, DOCTYPE, processing instructions, entity references,
+        whitespace outside the root element) is written as is. """
+        self._flush_pending_start_tag()
+        self._write(data)
+
+
+TEST_SVG = """<?xml version="1.0" encoding="UTF-8" standalone="no"?>
+<!DOCTYPE svg PUBLIC "-//W3C//DTD SVG 1.1//EN" "http://www.w3.org/Graphics/SVG/1.1/DTD/svg11.dtd" [
+  <!ENTITY color "#00ffff">
+]>
+<!-- comment before root -->
+<svg xmlns="http://www.w3.org/2000/svg" width="10" height="10">
+  <style><![CDATA[ path > circle { fill: red; } ]]></style>
+  <path d="M0 0" fill="#00ffff"/>
+  <circle r="1" style="fill:#00ffff;stroke:none"/>
+  <ellipse rx="1" fill="red"/>
+  <text x="0">a &amp; b &#169; &color;</text>
+  <rect fill="#00ffff"/>
+</svg>
+"""
+
+EXPECTED_SVG = """<?xml version="1.0" encoding="utf-8" standalone="no"?>
+<!DOCTYPE svg PUBLIC "-//W3C//DTD SVG 1.1//EN" "http://www.w3.org/Graphics/SVG/1.1/DTD/svg11.dtd" [
+  <!ENTITY color "#00ffff">
+]>
+<!-- comment before root -->
+<svg xmlns="http://www.w3.org/2000/svg" width="10" height="10">
+  <style><![CDATA[ path > circle { fill: red; } ]]></style>
+  <path d="M0 0" fill="#ff00ff" style="stroke:#00ff00;stroke-opacity:1;stroke-width:25"/>
+  <circle r="1" style="fill:#ff00ff;stroke:#00ff00;stroke-opacity:1;stroke-width:25"/>
+  <ellipse rx="1" fill="red" style="stroke:#00ffff;stroke-opacity:0.5;stroke-width:25"/>
+  <text x="0">a &amp; b \xc2\xa9 &color;</text>
+  <rect fill="#00ffff"/>
+</svg>
+"""
+
+
+class SvgStyleStreamUpdaterTestCase(unittest.TestCase):
+    def setUp(self):
+        self.test_dir = tempfile.mkdtemp()
+        self.input_file = os.path.join(self.test_dir, 'input.svg')
+        with open(self.input_file, 'w') as input_file:
+            input_file.write(TEST_SVG)
+        self.rules_manager = SvgStyleRulesManager()
+        self.rules_manager.load_rules_from_json('../tests/update_style_rules.json')
+
+    def tearDown(self):
+        shutil.rmtree(self.test_dir)
+
+    def _stream(self):
+        output_file = os.path.join(self.test_dir, 'output.svg')
+        applied_rules = SvgStyleStreamUpdater(self.rules_manager.rules).update_file(self.input_file, output_file)
+        with open(output_file) as output:
+            return applied_rules, output.read()
+
+    def test_applies_rules_like_dom_engine(self):
+        applied_rules, output = self._stream()
+        self.assertEqual([rule.name for rule in applied_rules], [rule.name for rule in self.rules_manager.rules[1:3]])
+        svg_dom = parse(self.input_file)
+        for rule in self.rules_manager.rules:
+            rule.apply_to_document(svg_dom)
+        streamed_dom = parse(os.path.join(self.test_dir, 'output.svg'))
+        for tag_name in ['path', 'circle', 'ellipse', 'rect']:
+            expected_element = svg_dom.getElementsByTagName(tag_name)[0]
+            streamed_element = streamed_dom.getElementsByTagName(tag_name)[0]
+            self.assertEqual(dict(streamed_element.attributes.items()), dict(expected_element.attributes.items()))
+
+    def test_keeps_document_formatting(self):
+        applied_rules, output = self._stream()
+        self.assertEqual(output, EXPECTED_SVG)
+
+
+if __name__ == '__main__':
+    unittest.main(exit=False)
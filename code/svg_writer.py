@@ -0,0 +1,102 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+import codecs
+import os
+import shutil
+import tempfile
+import unittest
+from xml.dom.minidom import parseString
+
+
+SVG_OUTPUT_FORMATS = ['pretty', 'compact', 'preserve']
+
+# Elements where whitespace is part of the content: it is kept in compact output
+WHITESPACE_PRESERVING_ELEMENTS = frozenset(['text', 'tspan', 'textPath', 'title', 'desc', 'style', 'script'])
+
+
+def remove_whitespace_text_nodes(svg_dom):
+    """ Removes whitespace-only text nodes used to indent the document, except from text content elements. """
+    nodes_to_visit = [svg_dom.documentElement]
+    while nodes_to_visit:
+        node = nodes_to_visit.pop()
+        if node.tagName in WHITESPACE_PRESERVING_ELEMENTS:
+            continue
+        for child_node in list(node.childNodes):
+            if child_node.nodeType == child_node.TEXT_NODE and not child_node.data.strip():
+                node.removeChild(child_node)
+                child_node.unlink()
+            elif child_node.nodeType == child_node.ELEMENT_NODE:
+                nodes_to_visit.append(child_node)
+
+
+def write_svg_document(svg_dom, svg_output_file, output_format='pretty'):
+    """ Serializes a SVG document directly to the output file, UTF-8 encoded, without building it as a string.
+
+Output formats:
+- 'pretty': indented with tabs, as xml.dom.minidom toprettyxml() (existing whitespace is kept and indented again).
+- 'compact': indentation whitespace is removed, except in text content elements.
+- 'preserve': whitespace found in the document is written as is.
+'compact' removes whitespace text nodes from the document.
+"""
+    if output_format not in SVG_OUTPUT_FORMATS:
+        raise ValueError('Unknown SVG output format "' + str(output_format) + '"')
+    with open(svg_output_file, 'wb') as output_file:
+        write_svg_document_to_stream(svg_dom, output_file, output_format)
+
+
+def write_svg_document_to_stream(svg_dom, output_stream, output_format='pretty'):
+    """ Serializes a SVG document to a binary file-like object. See write_svg_document(). """
+    if output_format not in SVG_OUTPUT_FORMATS:
+        raise ValueError('Unknown SVG output format "' + str(output_format) + '"')
+    writer = codecs.getwriter('utf-8')(output_stream)
+    if output_format == 'pretty':
+        svg_dom.writexml(writer, '', '\t', '\n')
+        return
+    if output_format == 'compact':
+        remove_whitespace_text_nodes(svg_dom)
+    writer.write('<?xml version="1.0" encoding="utf-8"?>')
+    for node in svg_dom.childNodes:
+        writer.write('\n')
+        node.writexml(writer)
+    writer.write('\n')
+
+
+WRITER_TEST_SVG = """<?xml version="1.0" encoding="UTF-8"?>
+<!-- icon -->
+<svg xmlns="http://www.w3.org/2000/svg">
+  <g>
+    <path d="M0 0"/>
+  </g>
+  <text>  two  words </text>
+</svg>
+"""
+
+
+class SvgWriterTestCase(unittest.TestCase):
+    def setUp(self):
+        self.test_dir = tempfile.mkdtemp()
+        self.output_file = os.path.join(self.test_dir, 'output.svg')
+
+    def tearDown(self):
+        shutil.rmtree(self.test_dir)
+
+    def _write(self, output_format, svg_string=WRITER_TEST_SVG):
+        write_svg_document(parseString(svg_string), self.output_file, output_format)
+        with open(self.output_file, 'rb') as output_file:
+            return output_file.read()
+
+    def test_writes_pretty_output_like_toprettyxml(self):
+        svg_string = '<svg><text>\xc3\xa9</text><g><path/></g></svg>'
+        self.assertEqual(self._write('pretty', svg_string), parseString(svg_string).toprettyxml().encode('utf-8'))
+
+    def test_writes_compact_output_keeping_text_content(self):
+        self.assertEqual(self._write('compact'), '<?xml version="1.0" encoding="utf-8"?>\n<!-- icon -->\n'
+                         '<svg xmlns="http://www.w3.org/2000/svg"><g><path d="M0 0"/></g>'
+                         '<text>  two  words </text></svg>\n')
+
+    def test_writes_preserved_output_with_original_whitespace(self):
+        self.assertEqual(self._write('preserve'), WRITER_TEST_SVG.replace('UTF-8', 'utf-8'))
+
+
+if __name__ == '__main__':
+    unittest.main(exit=False)
@@ -5,45 +5,85 @@ import sys
 import os
 import datetime
 import argparse
-import subprocess
 
 import code.file_utils as utils
+from code.bitmap_compositor import get_compositor, COMPOSITOR_CLASSES, DEFAULT_BATCH_SIZE, GRAVITIES, \
+    PNG_STRATEGIES
+from code.svg_compositor import SvgCompositor
+from code.compose_plan import ComposePlan, ComposePlanScheduler
+from code.job_pool import print_job_failures
+from code.build_manifest import BuildManifest, BuildTarget, plan_build
+from code.render_cache import RenderCache, DEFAULT_CACHE_MAX_SIZE
+from code.resize_cache import ResizeCache, DEFAULT_MEMORY_MAX_SIZE, DEFAULT_RESIZE_CACHE_DIR
 
 
-def exec_command(command_args, log_filename):
-    with open(log_filename, 'a+') as log_file:
-        log_file.seek(0, os.SEEK_END)
-        print(' '.join(command_args))
-        return subprocess.call(command_args, stdout=log_file, stderr=subprocess.STDOUT)
+def overlay(background_file, overlay_file, output_file, width=None, height=None, offset_x=None, offset_y=None):
+    """ Overlays a single bitmap with the default compositor backend. Returns 0 on success.
+    To overlay several bitmaps, use a compositor (see get_compositor) and its overlay_batch(). """
+    compositor = get_compositor()
+    try:
+        return compositor.overlay(background_file, overlay_file, output_file, width, height, offset_x, offset_y)
+    finally:
+        compositor.close()
 
 
-def overlay(background_file, overlay_file, output_file, width=None, height=None, offset_x=None, offset_y=None):
-    log_filename = 'compose_bitmap_imagemagick.log'
-    command_args = ['convert', background_file, '(', overlay_file]
-    if width or height:
-        resize_geometry = str(width) if width else ''
-        resize_geometry += ('x' + str(height)) if height else ''
-        command_args.extend(['-resize', resize_geometry])
-    command_args.extend([')', '-gravity', 'center'])
-    if offset_x or offset_y:
-        offset_geometry = str(offset_x) if offset_x else '+0'
-        offset_geometry += str(offset_y) if offset_y else ''
-        command_args.extend(['-geometry', offset_geometry])
-    command_args.extend(['-composite', output_file])
-    exec_command(command_args, log_filename)
+def overlay_data(background_file, overlay_png_data, output_file, width=None, height=None, offset_x=None,
+                 offset_y=None, echo=True):
+    """ Same as overlay(), with the overlaid bitmap PNG data held in memory. """
+    compositor = get_compositor()
+    compositor.echo_commands = echo
+    try:
+        return compositor.overlay_data(background_file, overlay_png_data, output_file, width, height, offset_x,
+                                       offset_y)
+    finally:
+        compositor.close()
 
 
 def parse_command_line(argv):
     parser = argparse.ArgumentParser(
-        description='Overlay a list of bitmaps over a same background.')
-    parser.add_argument('--background', dest='BACKGROUND_BITMAP', help='Bitmap to use as background image',
-                        required=True)
-    parser.add_argument('-i', dest='INPUT_FILE_OR_DIR', help='File or directory with bitmaps to overlay', required=True)
-    parser.add_argument('-o', dest='OUTPUT_DIR', help='Output directory for PNG files', required=True)
+        description='Overlay a list of bitmaps over a same background. With a SVG background, SVG documents are \
+overlaid instead, into SVG documents.')
+    parser.add_argument('--background', dest='BACKGROUND_BITMAP', help='Bitmap or SVG document to use as background \
+image (required without --plan)')
+    parser.add_argument('-i', dest='INPUT_FILE_OR_DIR', help='File or directory with bitmaps (SVG documents with a SVG \
+background) to overlay (required without --plan)')
+    parser.add_argument('--plan', dest='PLAN_FILE', help='JSON compose plan listing backgrounds, layers, geometry per \
+density and output paths, instead of --background, -i and geometry options (see code/compose_plan.py)')
+    parser.add_argument('--config', dest='DENSITIES_CONFIG_FILE', default='densities.json',
+                        help='Config file describing densities scales, for --plan.')
+    parser.add_argument('-o', dest='OUTPUT_DIR', help='Output directory for PNG (or SVG) files', required=True)
     parser.add_argument('--width', dest='WIDTH', type=int, help='Width of overlaid bitmap, if resized')
     parser.add_argument('--height', dest='HEIGHT', type=int, help='Height of overlaid bitmap, if resized')
     parser.add_argument('-x', dest='OFFSET_X', type=int, help='Horizontal offset of overlaid bitmaps')
     parser.add_argument('-y', dest='OFFSET_Y', type=int, help='Vertical offset of overlaid bitmaps')
+    parser.add_argument('--gravity', dest='GRAVITY', choices=GRAVITIES, default='center',
+                        help='Position of overlaid bitmaps, before offsets (default: center)')
+    parser.add_argument('--backend', dest='BACKEND', choices=sorted(COMPOSITOR_CLASSES.keys()),
+                        help='Force compositor to use. "numpy" (default if installed) composes batches of same size \
+bitmaps in single vectorized operations; "pillow" decodes the background once and composes in-process; "imagemagick" \
+runs a command per bitmap.')
+    parser.add_argument('--batch-size', dest='BATCH_SIZE', type=int, default=DEFAULT_BATCH_SIZE,
+                        help='Count of bitmaps composed at once by the numpy backend, bounding memory use (default: ' +
+                        str(DEFAULT_BATCH_SIZE) + ')')
+    parser.add_argument('--jobs', dest='JOBS', type=int, default=1,
+                        help='Number of parallel workers of each stage: decode, compose and encode with pillow and numpy \
+backends, commands with imagemagick backend (default: 1)')
+    parser.add_argument('--png-compression', dest='PNG_COMPRESSION', type=int, choices=range(10), metavar='LEVEL',
+                        help='zlib compression level of PNG outputs, from 0 (fastest, largest files) to 9 (default: \
+backend default)')
+    parser.add_argument('--png-strategy', dest='PNG_STRATEGY', choices=sorted(PNG_STRATEGIES.keys()),
+                        help='zlib compression strategy of PNG outputs: "huffman" and "rle" encode faster, "filtered" \
+and "default" compress better (default: backend default)')
+    parser.add_argument('--force', dest='FORCE', action='store_true',
+                        help='Compose all outputs, including outputs up to date in the output directory build manifest')
+    parser.add_argument('--resize-cache-size', dest='RESIZE_CACHE_SIZE', type=int,
+                        default=DEFAULT_MEMORY_MAX_SIZE / (1024 * 1024),
+                        help='Memory used to keep resized overlays, in megabytes, for overlays composed several times \
+(default: ' + str(DEFAULT_MEMORY_MAX_SIZE / (1024 * 1024)) + ')')
+    parser.add_argument('--resize-cache-dir', dest='RESIZE_CACHE_DIR', nargs='?', const=DEFAULT_RESIZE_CACHE_DIR,
+                        help='Keeps resized overlays on disk too, across runs (default directory: ' +
+                        DEFAULT_RESIZE_CACHE_DIR + '). Least recently used ones are removed above ' +
+                        str(DEFAULT_CACHE_MAX_SIZE / (1024 * 1024)) + ' megabytes.')
     return parser.parse_args(argv)
 
 
@@ -51,12 +91,110 @@ def check_command_line_arguments(args):
     args.OUTPUT_DIR = os.path.normpath(args.OUTPUT_DIR)
     if not os.path.exists(args.OUTPUT_DIR):
         os.makedirs(args.OUTPUT_DIR)
-    args.INPUT_FILE_OR_DIR = os.path.normpath(args.INPUT_FILE_OR_DIR)
-    if not os.path.exists(args.INPUT_FILE_OR_DIR):
-        raise Exception('Invalid input file or directory "' + args.INPUT_FILE_OR_DIR + '"')
-    args.BACKGROUND_BITMAP = os.path.normpath(args.BACKGROUND_BITMAP)
-    if not os.path.exists(args.BACKGROUND_BITMAP):
-        raise Exception('Invalid background image "' + args.BACKGROUND_BITMAP + '"')
+    if args.PLAN_FILE:
+        if args.INPUT_FILE_OR_DIR or args.BACKGROUND_BITMAP:
+            raise Exception('--plan lists backgrounds and inputs: --background and -i can not be used with it')
+        if not os.path.isfile(args.PLAN_FILE):
+            raise Exception('Invalid compose plan file "' + args.PLAN_FILE + '"')
+    else:
+        if not args.INPUT_FILE_OR_DIR or not args.BACKGROUND_BITMAP:
+            raise Exception('--background and -i are required without --plan')
+        args.INPUT_FILE_OR_DIR = os.path.normpath(args.INPUT_FILE_OR_DIR)
+        if not os.path.exists(args.INPUT_FILE_OR_DIR):
+            raise Exception('Invalid input file or directory "' + args.INPUT_FILE_OR_DIR + '"')
+        args.BACKGROUND_BITMAP = os.path.normpath(args.BACKGROUND_BITMAP)
+        if not os.path.exists(args.BACKGROUND_BITMAP):
+            raise Exception('Invalid background image "' + args.BACKGROUND_BITMAP + '"')
+    if args.BATCH_SIZE < 1:
+        raise Exception('Invalid batch size ' + str(args.BATCH_SIZE))
+    if args.JOBS < 1:
+        raise Exception('Invalid jobs count ' + str(args.JOBS))
+    if args.BACKEND and args.BACKGROUND_BITMAP and utils.is_svg_file(args.BACKGROUND_BITMAP):
+        raise Exception('--backend applies to bitmap backgrounds only')
+
+
+def set_compositor_options(compositor, args):
+    compositor.batch_size = args.BATCH_SIZE
+    compositor.jobs_count = args.JOBS
+    compositor.png_compression_level = args.PNG_COMPRESSION
+    compositor.png_strategy = args.PNG_STRATEGY
+    # In single background mode, overlays are distinct files resized once each: only a disk tier can be reused
+    if args.PLAN_FILE or args.RESIZE_CACHE_DIR:
+        disk_cache = RenderCache(args.RESIZE_CACHE_DIR) if args.RESIZE_CACHE_DIR else None
+        compositor.resize_cache = ResizeCache(args.RESIZE_CACHE_SIZE * 1024 * 1024, disk_cache)
+
+
+def print_resize_cache_report(resize_cache):
+    if not resize_cache:
+        return
+    lookups_count = resize_cache.hits_count + resize_cache.misses_count
+    if lookups_count:
+        print('\n' + str(resize_cache.hits_count) + '/' + str(lookups_count) + ' resized overlays reused from cache.')
+    resize_cache.evict()
+
+
+def get_compositor_recipe(compositor):
+    """ Returns the build manifest recipe entries of the compositor and its output options. """
+    return {'compositor': compositor.NAME + '\n' + str(compositor.about),
+            'png_compression_level': compositor.png_compression_level, 'png_strategy': compositor.png_strategy}
+
+
+def plan_compose_targets(manifest, build_targets, force=False):
+    """ Returns the targets to compose (see plan_build), and prints how many are up to date. """
+    planned_targets = plan_build(manifest, build_targets, force)
+    print('\n' + str(len(build_targets) - len(planned_targets)) + '/' + str(len(build_targets))
+          + ' outputs up to date (see ' + manifest.manifest_file + ').')
+    return planned_targets
+
+
+def record_compose_results(manifest, build_targets, statuses):
+    """ Records composed targets in the manifest (statuses are 0 on success), removes orphaned outputs and saves it. """
+    for build_target, status in zip(build_targets, statuses):
+        if status:
+            manifest.forget(build_target.output_file)
+        else:
+            manifest.record(build_target)
+    for output_file in manifest.remove_orphaned_outputs():
+        print('Removed orphaned ' + output_file)
+    manifest.save()
+
+
+def run_compose_plan(args, date_time_start):
+    plan = ComposePlan.from_json_file(args.PLAN_FILE, args.DENSITIES_CONFIG_FILE)
+    jobs = plan.get_jobs(args.OUTPUT_DIR)
+    compositor = get_compositor(args.BACKEND)
+    set_compositor_options(compositor, args)
+    print('\nSelected ' + str(compositor))
+    manifest = BuildManifest(args.OUTPUT_DIR, 'compose_bitmap')
+    build_targets = []
+    for job in jobs:
+        recipe = get_compositor_recipe(compositor)
+        recipe['geometries'] = [[geometry.width, geometry.height, geometry.offset_x, geometry.offset_y,
+                                 geometry.gravity] for overlay_file, geometry in job.overlays]
+        source_files = [job.background_file] + [overlay_file for overlay_file, geometry in job.overlays]
+        build_targets.append(BuildTarget(job.output_file, source_files, recipe))
+    planned_output_files = set(build_target.output_file for build_target in
+                               plan_compose_targets(manifest, build_targets, args.FORCE))
+    jobs = [job for job in jobs if job.output_file in planned_output_files]
+    scheduler = ComposePlanScheduler(compositor, args.JOBS)
+    job_results = []
+    try:
+        for job_result in scheduler.run(jobs):
+            if compositor.echo_commands:
+                print(' + '.join([job_result.job.background_file] + [overlay_file for overlay_file, geometry
+                                                                     in job_result.job.overlays])
+                      + ' -> ' + job_result.job.output_file)
+            job_results.append(job_result)
+    finally:
+        scheduler.close()
+    build_targets_by_output_file = dict((build_target.output_file, build_target) for build_target in build_targets)
+    record_compose_results(manifest, [build_targets_by_output_file[job_result.job.output_file]
+                                      for job_result in job_results],
+                           [0 if job_result.succeeded() else 1 for job_result in job_results])
+    failures_count = print_job_failures(job_results)
+    print_resize_cache_report(compositor.resize_cache)
+    utils.print_reporting(date_time_start, datetime.datetime.now(), jobs)
+    return 1 if failures_count else 0
 
 
 def main(argv=None):
@@ -65,12 +203,38 @@ def main(argv=None):
     args = parse_command_line(argv)
     check_command_line_arguments(args)
     date_time_start = datetime.datetime.now()
-    input_files = sorted(utils.get_file_paths(args.INPUT_FILE_OR_DIR, utils.is_png_file), key=str.lower)
+    if args.PLAN_FILE:
+        return run_compose_plan(args, date_time_start)
+    svg_composition = utils.is_svg_file(args.BACKGROUND_BITMAP)
+    compositor = SvgCompositor() if svg_composition else get_compositor(args.BACKEND)
+    compositor.initialize()
+    set_compositor_options(compositor, args)
+    print('\nSelected ' + str(compositor))
+    input_filter = utils.is_svg_file if svg_composition else utils.is_png_file
+    input_files = sorted(utils.get_file_paths(args.INPUT_FILE_OR_DIR, input_filter), key=str.lower)
+    manifest = BuildManifest(args.OUTPUT_DIR, 'compose_bitmap')
+    recipe = get_compositor_recipe(compositor)
+    recipe['geometry'] = [args.WIDTH, args.HEIGHT, args.OFFSET_X, args.OFFSET_Y, args.GRAVITY]
+    build_targets = []
     for input_file in input_files:
         filename, ext = os.path.splitext(os.path.basename(input_file))
         output_path = os.path.join(args.OUTPUT_DIR, filename + '_out' + ext)
-        overlay(args.BACKGROUND_BITMAP, input_file, output_path, args.WIDTH, args.HEIGHT, args.OFFSET_X, args.OFFSET_Y)
+        build_targets.append(BuildTarget(output_path, [args.BACKGROUND_BITMAP, input_file], recipe))
+    build_targets = plan_compose_targets(manifest, build_targets, args.FORCE)
+    input_files = [build_target.source_files[1] for build_target in build_targets]
+    output_paths = [build_target.output_file for build_target in build_targets]
+    try:
+        statuses = compositor.overlay_batch(args.BACKGROUND_BITMAP, input_files, output_paths, args.WIDTH, args.HEIGHT,
+                                            args.OFFSET_X, args.OFFSET_Y, args.GRAVITY)
+    finally:
+        compositor.close()
+    record_compose_results(manifest, build_targets, statuses)
+    failed_files = [input_file for input_file, status in zip(input_files, statuses) if status]
+    for failed_file in failed_files:
+        utils.print_warning('Could not overlay ' + failed_file + ' (see ' + compositor.LOG_FILENAME + ')')
+    print_resize_cache_report(compositor.resize_cache)
     utils.print_reporting(date_time_start, datetime.datetime.now(), input_files)
+    return 1 if failed_files else 0
 
 
 if __name__ == '__main__':
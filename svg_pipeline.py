@@ -0,0 +1,310 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+from __future__ import print_function
+import sys
+import os
+import datetime
+import argparse
+import io
+from xml.dom.minidom import parse
+
+from code.color_string import ColorString
+from code.svg_writer import write_svg_document_to_stream
+from code.pipeline import Pipeline, PipelineStage
+from code.job_pool import print_job_failures
+from code.render_dedup import RenderDeduplicator
+import code.file_utils as utils
+from code.density_converter import DensityConverter
+from svg_style_updater import get_svg_style_themes, get_theme_output_dir
+from svg_to_png import get_renderer, get_png_filename, RENDERER_CLASSES
+from code.bitmap_compositor import get_compositor, COMPOSITOR_CLASSES, GRAVITIES
+
+
+class PipelineRender:
+    """ An output PNG file of a SVG file: rendered from the document styled with a theme, to a given size. """
+
+    def __init__(self, theme_name, output_file, width=None, height=None):
+        self.theme_name = theme_name
+        self.output_file = output_file
+        self.width = width
+        self.height = height
+        self.png_data = None
+        self.render_key = None
+        # Output file of an identical render (same document and size) to link instead of rendering
+        self.source_file = None
+        self.source_render = None
+
+
+class PipelineDocument:
+    """ A SVG file going through the pipeline stages: styled document data for each theme, then rendered PNG data. """
+
+    def __init__(self, svg_file, renders):
+        self.svg_file = svg_file
+        self.renders = renders
+        self.svg_data_by_theme = {}
+        self.applied_rules_by_theme = {}
+
+    def __repr__(self):
+        return '[PipelineDocument]\t' + self.svg_file
+
+
+class SvgPipeline:
+    """ Styles, renders and overlays SVG files in a single run, without intermediate files.
+
+Stages run concurrently (see Pipeline): a file is rendered while the next one is styled, and overlaid while the next
+one is rendered. Styled documents are passed to the renderer in memory (through standard input for ImageMagick, see
+SvgToPngRenderer.render_data), and rendered bitmaps are piped to ImageMagick for the overlay.
+Each SVG file is parsed once for all themes: each theme styles a copy of the document, cloned in memory.
+Identical renders (same styled document and size, see RenderDeduplicator) are done once: other outputs are linked to
+the first one, whatever the icon, theme or density.
+"""
+    QUEUE_SIZE = 4
+
+    def __init__(self, themes, renderer, compositor=None, background_file=None, offset_x=None, offset_y=None,
+                 gravity='center', jobs_count=1):
+        self.themes = themes
+        for theme_name, rules_manager in themes:
+            rules_manager.get_rule_set()
+        self.renderer = renderer
+        self.compositor = compositor
+        self.background_file = background_file
+        self.offset_x = offset_x
+        self.offset_y = offset_y
+        self.gravity = gravity
+        self.jobs_count = jobs_count
+        self.deduplicator = RenderDeduplicator()
+        self.linked_renders_count = 0
+
+    def get_stages(self):
+        # Styling is CPU-bound Python code: a single thread. Renders and overlays wait on external processes.
+        stages = [PipelineStage('style', self.style), PipelineStage('render', self.render, self.jobs_count)]
+        if self.background_file:
+            stages.append(PipelineStage('overlay', self.overlay, self.jobs_count))
+        return stages
+
+    def run(self, documents):
+        """ Yields a JobResult for each PipelineDocument, in documents order. """
+        self.renderer.echo_commands = False
+        if self.compositor:
+            self.compositor.echo_commands = False
+        try:
+            for job_result in Pipeline(self.get_stages(), SvgPipeline.QUEUE_SIZE).run(documents):
+                yield job_result
+        finally:
+            self.renderer.echo_commands = True
+            if self.compositor:
+                self.compositor.echo_commands = True
+
+    def style(self, document):
+        pristine_svg_dom = parse(document.svg_file)
+        for index, (theme_name, rules_manager) in enumerate(self.themes):
+            last_theme = index == len(self.themes) - 1
+            svg_dom = pristine_svg_dom if last_theme else pristine_svg_dom.cloneNode(True)
+            document.applied_rules_by_theme[theme_name] = rules_manager.apply_rules_to_svg_dom(svg_dom)
+            svg_data = io.BytesIO()
+            write_svg_document_to_stream(svg_dom, svg_data, 'compact')
+            svg_dom.unlink()
+            document.svg_data_by_theme[theme_name] = svg_data.getvalue()
+        return document
+
+    def render(self, document):
+        renders_by_key = {}
+        for render in document.renders:
+            svg_data = document.svg_data_by_theme[render.theme_name]
+            render.render_key = RenderDeduplicator.get_key(svg_data, render.width, render.height)
+            render.source_file = self.deduplicator.get_output_file(render.render_key)
+            render.source_render = renders_by_key.get(render.render_key)
+            if render.source_file or render.source_render:
+                if not self.background_file:
+                    self._link_render(render)
+                continue
+            renders_by_key[render.render_key] = render
+            png_data = self.renderer.render_data(svg_data, render.width, render.height)
+            if png_data is None:
+                raise Exception('Render of ' + render.output_file + ' failed (see ' + self.renderer.LOG_FILENAME + ')')
+            if self.background_file:
+                render.png_data = png_data
+            else:
+                self._write_render(render, png_data)
+        document.svg_data_by_theme = {}
+        return document
+
+    def overlay(self, document):
+        for render in document.renders:
+            if render.source_file or render.source_render:
+                self._link_render(render)
+                continue
+            if os.path.isfile(render.output_file):
+                os.remove(render.output_file)
+            return_code = self.compositor.overlay_data(self.background_file, render.png_data, render.output_file,
+                                                       offset_x=self.offset_x, offset_y=self.offset_y,
+                                                       gravity=self.gravity)
+            render.png_data = None
+            if return_code:
+                raise Exception('Overlay of ' + render.output_file + ' failed (see ' + self.compositor.LOG_FILENAME
+                                + ')')
+            self.deduplicator.add_output_file(render.render_key, render.output_file)
+        return document
+
+    def _write_render(self, render, png_data):
+        # Output may be a hard link to a previous duplicate render, which must not be overwritten in place.
+        if os.path.isfile(render.output_file):
+            os.remove(render.output_file)
+        with open(render.output_file, 'wb') as output_file:
+            output_file.write(png_data)
+        self.deduplicator.add_output_file(render.render_key, render.output_file)
+
+    def _link_render(self, render):
+        """ Links the output of an identical render, from a previous document or from the same document. """
+        utils.link_or_copy(render.source_file or render.source_render.output_file, render.output_file)
+        self.linked_renders_count += 1
+
+
+def iter_pipeline_documents(svg_files, themes, output_dir, width=None, height=None, density_sizes=None,
+                            input_dir=None):
+    """ Yields a PipelineDocument for each SVG file, with a PipelineRender for each theme and density (or a single
+    size without density), and creates their output directories. svg_files may be any iterable, consumed lazily.
+    Themes write to output sub-directories named after them, densities to their configured sub-directories. Files found
+    in sub-directories of input_dir, if any, are written to the same sub-directories of these output directories. """
+    output_sizes = []
+    for theme_name, rules_manager in themes:
+        theme_output_dir = get_theme_output_dir(output_dir, theme_name)
+        if density_sizes:
+            for density_size in density_sizes:
+                output_sizes.append((theme_name, density_size.output_config.get_output_dir(theme_output_dir),
+                                     density_size.output_config.get_filename, density_size.width, density_size.height))
+        else:
+            output_sizes.append((theme_name, theme_output_dir, None, width, height))
+    for theme_name, size_output_dir, get_filename, size_width, size_height in output_sizes:
+        if not os.path.isdir(size_output_dir):
+            os.makedirs(size_output_dir)
+    for svg_file in svg_files:
+        renders = []
+        for theme_name, size_output_dir, get_filename, size_width, size_height in output_sizes:
+            if input_dir:
+                size_output_dir = utils.get_mirrored_output_dir(size_output_dir, svg_file, input_dir)
+                utils.make_directories(size_output_dir)
+            png_filename = get_png_filename(svg_file)
+            if get_filename:
+                png_filename = get_filename(png_filename)
+            renders.append(PipelineRender(theme_name, os.path.join(size_output_dir, png_filename), size_width,
+                                          size_height))
+        yield PipelineDocument(svg_file, renders)
+
+
+def parse_command_line(argv):
+    parser = argparse.ArgumentParser(description='Styles SVG files, renders them to PNG and overlays them over a \
+background bitmap, in a single pass without intermediate files. Same options as svg_style_updater.py, svg_to_png.py \
+and compose_bitmap.py.')
+    parser.add_argument('-i', dest='INPUT_FILE_OR_DIR', default='', help='Input SVG files or directory')
+    parser.add_argument('-o', dest='OUTPUT_DIR', default='png_output', help='Output directory for PNG files')
+    parser.add_argument('-r', '--recursive', dest='RECURSIVE', action='store_true', help='Also handle SVGs of \
+sub-directories of the input directory, written to the same sub-directories of the output directories')
+    parser.add_argument('--include', dest='INCLUDE_PATTERNS', action='append', metavar='PATTERN', help='Only handle \
+SVGs with a path (relative to the input directory) matching this glob pattern. Can be repeated.')
+    parser.add_argument('--exclude', dest='EXCLUDE_PATTERNS', action='append', metavar='PATTERN', help='Skip SVGs \
+and sub-directories with a path (relative to the input directory) matching this glob pattern. Can be repeated.')
+    parser.add_argument('--no-sort', dest='NO_SORT', action='store_true', help='Handle SVGs as they are found, while \
+the input directory is walked, instead of sorting them by path first')
+    parser.add_argument('--color', dest='COLOR_TO_APPLY', type=ColorString, help='Color to apply')
+    parser.add_argument('--match', dest='COLOR_TO_MATCH', type=ColorString, default=None, help='Color to match (all if \
+none specified)')
+    parser.add_argument('--rules', dest='RULES_FILES', nargs='+', help='JSON rules file. With several files, or a \
+directory of rules files, each file is a theme rendered to an output sub-directory named after it.')
+    parser.add_argument('--width', dest='WIDTH', type=int, help='Output width, in pixels')
+    parser.add_argument('--height', dest='HEIGHT', type=int, help='Output height, in pixels')
+    parser.add_argument('--renderer', dest='RENDERER', choices=sorted(RENDERER_CLASSES.keys()),
+                        help='Force renderer to use')
+    parser.add_argument('--density', dest='DENSITY_LABEL', choices=DensityConverter.get_instance().get_density_names(),
+                        help='Specifies density to consider as reference and exports PNG to ALL densities specified in \
+config file.')
+    parser.add_argument('--config', dest='DENSITIES_CONFIG_FILE', default='densities.json',
+                        help='Config file describing densities output scales and output paths.')
+    parser.add_argument('--background', dest='BACKGROUND_BITMAP', help='Bitmap to use as background image (no \
+overlay if none specified)')
+    parser.add_argument('-x', dest='OFFSET_X', type=int, help='Horizontal offset of overlaid bitmaps')
+    parser.add_argument('-y', dest='OFFSET_Y', type=int, help='Vertical offset of overlaid bitmaps')
+    parser.add_argument('--gravity', dest='GRAVITY', choices=GRAVITIES, default='center',
+                        help='Position of overlaid bitmaps, before offsets (default: center)')
+    parser.add_argument('--backend', dest='BACKEND', choices=sorted(COMPOSITOR_CLASSES.keys()),
+                        help='Force compositor to use for overlays')
+    parser.add_argument('--jobs', dest='JOBS', type=int, default=1, help='Number of renders and overlays to run in \
+parallel (default: 1)')
+    return parser.parse_args(argv)
+
+
+def check_command_line_arguments(args):
+    if args.RULES_FILES and args.COLOR_TO_APPLY:
+        raise Exception('Incompatible arguments. Option --color and --rules are exclusive.')
+    args.INPUT_FILE_OR_DIR = os.path.normpath(args.INPUT_FILE_OR_DIR)
+    if not os.path.exists(args.INPUT_FILE_OR_DIR):
+        raise Exception('Invalid input file or directory "' + args.INPUT_FILE_OR_DIR + '"')
+    args.OUTPUT_DIR = os.path.normpath(args.OUTPUT_DIR)
+    if not os.path.exists(args.OUTPUT_DIR):
+        os.makedirs(args.OUTPUT_DIR)
+    if args.BACKGROUND_BITMAP is not None:
+        args.BACKGROUND_BITMAP = os.path.normpath(args.BACKGROUND_BITMAP)
+        if not os.path.exists(args.BACKGROUND_BITMAP):
+            raise Exception('Invalid background image "' + args.BACKGROUND_BITMAP + '"')
+    if args.DENSITY_LABEL is not None and not os.path.isfile(args.DENSITIES_CONFIG_FILE):
+        raise Exception('Invalid config file "' + args.DENSITIES_CONFIG_FILE + '"')
+    if args.JOBS < 1:
+        raise Exception('Invalid number of jobs ' + str(args.JOBS) + '. Should be at least 1.')
+
+
+def main(argv=None):
+    if argv is None:
+        argv = sys.argv[1:]
+    args = parse_command_line(argv)
+    check_command_line_arguments(args)
+    date_time_start = datetime.datetime.now()
+
+    themes = get_svg_style_themes(args)
+    renderer = get_renderer(args.RENDERER)
+    print('\nSelected ' + str(renderer))
+
+    input_svg_files = utils.iter_file_paths(args.INPUT_FILE_OR_DIR, utils.is_svg_file, args.RECURSIVE,
+                                            args.INCLUDE_PATTERNS, args.EXCLUDE_PATTERNS)
+    # Without sorting, files stream to the pipeline as they are found: the first ones render while the walk goes on.
+    progress_total = ''
+    if not args.NO_SORT:
+        input_svg_files = sorted(input_svg_files, key=str.lower)
+        progress_total = '/' + str(len(input_svg_files))
+    density_sizes = None
+    if args.DENSITY_LABEL is not None:
+        density_converter = DensityConverter(args.DENSITIES_CONFIG_FILE)
+        density_sizes = density_converter.get_density_sizes(args.WIDTH, args.HEIGHT, args.DENSITY_LABEL)
+    documents = iter_pipeline_documents(input_svg_files, themes, args.OUTPUT_DIR, args.WIDTH, args.HEIGHT,
+                                        density_sizes, args.INPUT_FILE_OR_DIR)
+    compositor = None
+    if args.BACKGROUND_BITMAP:
+        compositor = get_compositor(args.BACKEND)
+        print('\nSelected ' + str(compositor))
+    pipeline = SvgPipeline(themes, renderer, compositor, args.BACKGROUND_BITMAP, args.OFFSET_X, args.OFFSET_Y,
+                           args.GRAVITY, args.JOBS)
+    job_results = []
+    try:
+        for job_result in pipeline.run(documents):
+            job_results.append(job_result)
+            document = job_result.job
+            status = '' if job_result.succeeded() else '\tFAILED'
+            print('[' + str(len(job_results)) + progress_total + ']\t' + document.svg_file + status)
+            for theme_name, rules_manager in themes:
+                prefix = ' [' + theme_name + ']' if theme_name else ''
+                for rule in document.applied_rules_by_theme.get(theme_name, []):
+                    print(prefix + ' applied ' + str(rule))
+    finally:
+        renderer.close()
+        if compositor:
+            compositor.close()
+    renders_count = sum(len(job_result.job.renders) for job_result in job_results)
+    print('\n' + str(pipeline.linked_renders_count) + '/' + str(renders_count)
+          + ' renders linked from identical renders.')
+    failures_count = print_job_failures(job_results)
+
+    utils.print_reporting(date_time_start, datetime.datetime.now(), [job_result.job for job_result in job_results])
+    return 1 if failures_count else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
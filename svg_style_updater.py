@@ -4,26 +4,196 @@ import sys
 import os
 import datetime
 import argparse
+import shutil
 
 from code.color_string import ColorString
-from code.svg_style_rule import SvgStyleRulesManager, SvgStyleRule, SvgStyleProperty
+from code.svg_style_rule import SvgStyleRulesManager, SvgStyleRule, SvgStyleProperty, load_style_themes, \
+    apply_themes_to_svg_file
+from code.svg_style_stream import SvgStyleStreamUpdater
+from code.job_pool import JobPool, print_job_failures
+from code.file_watcher import FileWatcher, DEFAULT_DEBOUNCE_DELAY
+from code.build_manifest import BuildManifest, BuildTarget
+from code.svg_writer import SVG_OUTPUT_FORMATS
 import code.file_utils as utils
 
 
-def update_svg_files(svg_files, rules_manager, output_dir):
+# State of style update workers, set once per worker process by init_style_update_worker()
+_style_update_worker = {}
+
+
+def get_theme_output_dir(output_dir, theme_name):
+    return os.path.join(output_dir, theme_name) if theme_name else output_dir
+
+
+def get_output_svg_files(input_svg_file, themes, output_dir, input_dir=None):
+    """ Returns the output file of the SVG file for each theme, in themes order. Files found in sub-directories of
+    input_dir, if any, are written to the same sub-directories of theme output directories. """
     output_svg_files = []
-    for input_svg_file in svg_files:
-        print 'processing ' + input_svg_file
-        output_svg_file = os.path.join(output_dir, os.path.basename(input_svg_file))
-        rules_manager.apply_rules_to_svg_file(input_svg_file, output_svg_file)
-        output_svg_files.append(output_svg_file)
+    for theme_name, rules_manager in themes:
+        theme_output_dir = get_theme_output_dir(output_dir, theme_name)
+        if input_dir:
+            theme_output_dir = utils.get_mirrored_output_dir(theme_output_dir, input_svg_file, input_dir)
+        output_svg_files.append(os.path.join(theme_output_dir, os.path.basename(input_svg_file)))
     return output_svg_files
 
 
+def init_style_update_worker(themes, output_dir, engine, output_format, unchanged_files, input_dir=None):
+    """ Job pool initializer: rules are shipped once to each worker, and compiled once there. """
+    _style_update_worker['themes'] = themes
+    _style_update_worker['output_dir'] = output_dir
+    _style_update_worker['input_dir'] = input_dir
+    _style_update_worker['output_format'] = output_format
+    _style_update_worker['unchanged_files'] = unchanged_files
+    if engine == 'stream':
+        _style_update_worker['stream_updaters'] = [SvgStyleStreamUpdater(rules_manager.rules)
+                                                   for theme_name, rules_manager in themes]
+    else:
+        _style_update_worker['stream_updaters'] = None
+        for theme_name, rules_manager in themes:
+            rules_manager.get_rule_set()
+
+
+def update_svg_file(input_svg_file):
+    """ Job function: updates a SVG file, once per theme. Returns a list of (theme name, output file path or None if
+    not written, descriptions of the rules applied), in themes order. """
+    themes = _style_update_worker['themes']
+    output_svg_files = get_output_svg_files(input_svg_file, themes, _style_update_worker['output_dir'],
+                                            _style_update_worker['input_dir'])
+    for output_svg_file in output_svg_files:
+        utils.make_directories(os.path.dirname(output_svg_file))
+    stream_updaters = _style_update_worker['stream_updaters']
+    unchanged_files = _style_update_worker['unchanged_files']
+    try:
+        if stream_updaters:
+            # Streamed documents are never held in memory: each theme streams the input file again.
+            applied_rules_list = []
+            for stream_updater, output_svg_file in zip(stream_updaters, output_svg_files):
+                applied_rules = stream_updater.update_file(input_svg_file, output_svg_file)
+                if not applied_rules and unchanged_files != 'write':
+                    os.remove(output_svg_file)
+                applied_rules_list.append(applied_rules)
+        else:
+            themed_outputs = [(rules_manager, output_svg_file) for (theme_name, rules_manager), output_svg_file in
+                              zip(themes, output_svg_files)]
+            applied_rules_list = apply_themes_to_svg_file(input_svg_file, themed_outputs,
+                                                          _style_update_worker['output_format'],
+                                                          unchanged_files == 'write')
+    except Exception:
+        # Do not leave partially written files in the output directories
+        for output_svg_file in output_svg_files:
+            if os.path.isfile(output_svg_file):
+                os.remove(output_svg_file)
+        raise
+    file_results = []
+    for (theme_name, rules_manager), output_svg_file, applied_rules in zip(themes, output_svg_files,
+                                                                           applied_rules_list):
+        if not applied_rules and unchanged_files != 'write':
+            if unchanged_files == 'skip':
+                output_svg_file = None
+            else:
+                shutil.copyfile(input_svg_file, output_svg_file)
+        file_results.append((theme_name, output_svg_file, [str(rule) for rule in applied_rules]))
+    return file_results
+
+
+def update_svg_files(svg_files, themes, output_dir, engine='dom', jobs_count=1, output_format='pretty',
+                     unchanged_files='write', input_dir=None, manifest=None, force=False):
+    """ Updates SVG files with a pool of jobs_count worker processes. Applied rules are printed in files order, and
+    files that could not be updated are reported once all files were processed.
+    svg_files may be any iterable, consumed as workers are ready for more files (see JobPool.imap).
+    Files found in sub-directories of input_dir, if any, are written to the same sub-directories of the output
+    directories.
+    themes is a list of (theme name, SvgStyleRulesManager). Each theme writes to its own output sub-directory, named
+    after the theme, except a theme without name, which writes to the output directory itself. Each input file is
+    parsed once for all themes.
+    Files where no rule applied are either written like others, copied as is or skipped (unchanged_files 'write',
+    'copy' or 'skip').
+    With a build manifest, files with all theme outputs up to date in it are not updated, unless force (see
+    BuildManifest.is_up_to_date), and updates are recorded in it.
+    Returns the list of output files and the number of failures. """
+    for theme_name, rules_manager in themes:
+        theme_output_dir = get_theme_output_dir(output_dir, theme_name)
+        if not os.path.isdir(theme_output_dir):
+            os.makedirs(theme_output_dir)
+    build_targets_by_file = {}
+    up_to_date_files = []
+
+    def get_planned_svg_files():
+        # Planned as the pool asks for more files, so that files found while walking directories are still streamed
+        recipes = [{'rules': rules_manager.get_digest(), 'engine': engine, 'format': output_format,
+                    'unchanged': unchanged_files} for theme_name, rules_manager in themes]
+        for svg_file in svg_files:
+            build_targets = [BuildTarget(output_svg_file, [svg_file], recipe) for output_svg_file, recipe in
+                             zip(get_output_svg_files(svg_file, themes, output_dir, input_dir), recipes)]
+            if not force and all([manifest.is_up_to_date(build_target) for build_target in build_targets]):
+                up_to_date_files.append(svg_file)
+                continue
+            build_targets_by_file[svg_file] = build_targets
+            yield svg_file
+    planned_svg_files = get_planned_svg_files() if manifest else svg_files
+    output_svg_files = []
+    job_results = []
+    job_pool = JobPool(jobs_count, use_processes=True, initializer=init_style_update_worker,
+                       initargs=(themes, output_dir, engine, output_format, unchanged_files, input_dir))
+    for job_result in job_pool.imap(update_svg_file, planned_svg_files):
+        print 'processing ' + job_result.job
+        job_results.append(job_result)
+        if job_result.succeeded():
+            for theme_name, output_svg_file, applied_rules in job_result.value:
+                prefix = ' [' + theme_name + ']' if theme_name else ''
+                for applied_rule in applied_rules:
+                    print prefix + ' applied ' + applied_rule
+                if output_svg_file is None:
+                    print prefix + ' skipped: no rule applied'
+                else:
+                    output_svg_files.append(output_svg_file)
+        else:
+            print ' failed'
+        if manifest:
+            for index, build_target in enumerate(build_targets_by_file.pop(job_result.job)):
+                if job_result.succeeded():
+                    manifest.record(build_target, job_result.value[index][1] is not None)
+                else:
+                    manifest.forget(build_target.output_file)
+    if manifest:
+        print '\n' + str(len(up_to_date_files)) + ' file' + ('' if len(up_to_date_files) < 2 else 's') \
+            + ' up to date (see ' + manifest.manifest_file + ').'
+        for output_svg_file in manifest.remove_orphaned_outputs():
+            print 'Removed orphaned ' + output_svg_file
+        manifest.save()
+    return output_svg_files, print_job_failures(job_results)
+
+
+def watch_svg_files(watcher, themes, args, manifest=None):
+    """ Updates SVG files again, for all themes, each time they change, until interrupted (Ctrl+C). Changed files are
+    updated in this process, with rules compiled once, unless enough files changed to share them between --jobs
+    workers. """
+    print 'Watching ' + args.INPUT_DIR + ' for changes (Ctrl+C to stop)...'
+    try:
+        for changed_svg_files in watcher.watch():
+            date_time_start = datetime.datetime.now()
+            output_svg_files, failures_count = update_svg_files(changed_svg_files, themes, args.OUTPUT_DIR,
+                                                                args.ENGINE, min(args.JOBS, len(changed_svg_files)),
+                                                                args.OUTPUT_FORMAT, args.UNCHANGED_FILES,
+                                                                args.INPUT_DIR, manifest, args.FORCE)
+            utils.print_reporting(date_time_start, datetime.datetime.now(), output_svg_files)
+            print 'Watching ' + args.INPUT_DIR + ' for changes (Ctrl+C to stop)...'
+    except KeyboardInterrupt:
+        print '\nStopped watching.'
+
+
+def get_svg_style_themes(args):
+    """ Returns the list of (theme name, SvgStyleRulesManager) to apply. With several rules files, or a directory of
+    rules files, each file is a theme named after it. Otherwise, the only theme has no name. """
+    if args.RULES_FILES and (len(args.RULES_FILES) > 1 or os.path.isdir(args.RULES_FILES[0])):
+        return load_style_themes(args.RULES_FILES)
+    return [(None, get_svg_style_rules_manager(args))]
+
+
 def get_svg_style_rules_manager(args):
     rules_manager = SvgStyleRulesManager()
-    if args.RULES_FILE is not None:
-        rules_manager.load_rules_from_json(args.RULES_FILE)
+    if args.RULES_FILES:
+        rules_manager.load_rules_from_json(args.RULES_FILES[0])
     elif args.COLOR_TO_APPLY is not None:
         property_to_set = SvgStyleProperty('fill', str(args.COLOR_TO_APPLY))
         rule_name = '[command line rule] apply color ' + str(args.COLOR_TO_APPLY)
@@ -38,10 +208,12 @@ def get_svg_style_rules_manager(args):
 
 
 def check_command_line_arguments(args):
-    if not (args.RULES_FILE or args.COLOR_TO_APPLY):
+    if not (args.RULES_FILES or args.COLOR_TO_APPLY):
         raise Exception('No style specified. Specify either a color with --color or a JSON rules file with --rules.')
-    if args.RULES_FILE and args.COLOR_TO_APPLY:
+    if args.RULES_FILES and args.COLOR_TO_APPLY:
         raise Exception('Incompatible arguments. Option --color and --rules are exclusive.')
+    if args.JOBS < 1:
+        raise Exception('Invalid number of jobs ' + str(args.JOBS) + '. Should be at least 1.')
     if args.INPUT_DIR is not None:
         args.INPUT_DIR = os.path.normpath(args.INPUT_DIR)
         if not os.path.isdir(args.INPUT_DIR):
@@ -62,7 +234,34 @@ JSON file (kinda CSS-like).')
     parser.add_argument('--color', dest='COLOR_TO_APPLY', type=ColorString, help='Color to apply')
     parser.add_argument('--match', dest='COLOR_TO_MATCH', type=ColorString, default=None, help='Color to match (all if \
 none specified)')
-    parser.add_argument('--rules', dest='RULES_FILE', help='JSON rules file')
+    parser.add_argument('--rules', dest='RULES_FILES', nargs='+', help='JSON rules file. With several files, or a \
+directory of rules files, each file is a theme: updated files are written to an output sub-directory named after it.')
+    parser.add_argument('--engine', dest='ENGINE', choices=['dom', 'stream'], default='dom', help='"dom" loads each \
+document as a whole and pretty prints it (default). "stream" applies rules while streaming documents, with a constant \
+memory use, and keeps their original formatting.')
+    parser.add_argument('--jobs', dest='JOBS', type=int, default=1, help='Number of files to update in parallel, in \
+separate processes (default: 1)')
+    parser.add_argument('--format', dest='OUTPUT_FORMAT', choices=SVG_OUTPUT_FORMATS, default='pretty', help='Output \
+format of the "dom" engine: "pretty" indents documents (default), "compact" removes indentation whitespace, "preserve" \
+keeps whitespace as found in input files.')
+    parser.add_argument('-r', '--recursive', dest='RECURSIVE', action='store_true', help='Also update SVGs of \
+sub-directories of the input directory, written to the same sub-directories of the output directory')
+    parser.add_argument('--include', dest='INCLUDE_PATTERNS', action='append', metavar='PATTERN', help='Only update \
+SVGs with a path (relative to the input directory) matching this glob pattern. Can be repeated.')
+    parser.add_argument('--exclude', dest='EXCLUDE_PATTERNS', action='append', metavar='PATTERN', help='Skip SVGs \
+and sub-directories with a path (relative to the input directory) matching this glob pattern. Can be repeated.')
+    parser.add_argument('--no-sort', dest='NO_SORT', action='store_true', help='Update SVGs in the order they are \
+found, as the input directory is walked, instead of sorting them by path first')
+    parser.add_argument('--force', dest='FORCE', action='store_true', help='Update all files, including files up to \
+date in the output directory build manifest')
+    parser.add_argument('--watch', dest='WATCH', action='store_true', help='Once all files are updated, keep \
+watching them, and update changed and added files again as they are saved')
+    parser.add_argument('--debounce', dest='DEBOUNCE_DELAY', type=float, default=DEFAULT_DEBOUNCE_DELAY, help='With \
+--watch, seconds without further change before changed files are updated (default: ' + str(DEFAULT_DEBOUNCE_DELAY)
+                        + ')')
+    parser.add_argument('--unchanged', dest='UNCHANGED_FILES', choices=['write', 'copy', 'skip'], default='write',
+                        help='Files where no rule applied are either written like other files (default), copied as \
+is, or skipped.')
     return parser.parse_args(argv)
 
 
@@ -72,12 +271,23 @@ def main(argv=None):
     args = parse_command_line(argv)
     check_command_line_arguments(args)
     date_time_start = datetime.datetime.now()
-    rules_manager = get_svg_style_rules_manager(args)
-    # TODO: use glob to improve flexibility : https://docs.python.org/2/library/glob.html#module-glob
-    # and os.path.exist : https://docs.python.org/2/library/os.path.html#os.path.expandvars
-    input_svg_files = sorted(utils.get_file_paths(args.INPUT_DIR, utils.is_svg_file))
-    output_svg_files = update_svg_files(input_svg_files, rules_manager, args.OUTPUT_DIR)
+    themes = get_svg_style_themes(args)
+    get_input_svg_files = lambda: utils.iter_file_paths(args.INPUT_DIR, utils.is_svg_file, args.RECURSIVE,
+                                                        args.INCLUDE_PATTERNS, args.EXCLUDE_PATTERNS)
+    # Files saved during the first run are updated again once it is done
+    watcher = FileWatcher(get_input_svg_files, debounce_delay=args.DEBOUNCE_DELAY) if args.WATCH else None
+    input_svg_files = get_input_svg_files()
+    if not args.NO_SORT:
+        input_svg_files = sorted(input_svg_files)
+    manifest = BuildManifest(args.OUTPUT_DIR, 'svg_style_updater')
+    output_svg_files, failures_count = update_svg_files(input_svg_files, themes, args.OUTPUT_DIR, args.ENGINE,
+                                                        args.JOBS, args.OUTPUT_FORMAT, args.UNCHANGED_FILES,
+                                                        args.INPUT_DIR, manifest, args.FORCE)
     utils.print_reporting(date_time_start, datetime.datetime.now(), output_svg_files)
+    if watcher:
+        watch_svg_files(watcher, themes, args, manifest)
+    if failures_count:
+        return 1
 
 
 if __name__ == '__main__':
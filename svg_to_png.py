@@ -6,19 +6,57 @@ import sys
 import os
 import datetime
 import argparse
+import io
+import itertools
+import shutil
 import subprocess
+import tempfile
+import threading
+from collections import OrderedDict
 
 import code.file_utils as utils
 from code.density_converter import DensityConverter
+from code.file_watcher import FileWatcher, DEFAULT_DEBOUNCE_DELAY
+from code.build_manifest import BuildManifest, BuildTarget, plan_build
+from code.inkscape_shell import InkscapeShellSession, InkscapeShellError
+from code.svg_metadata import SvgMetadata, SvgMetadataCache
+from code.render_cache import RenderCache, DEFAULT_CACHE_DIR, DEFAULT_CACHE_MAX_SIZE
+from code.job_pool import JobPool, JobResult, print_job_failures
+from code.render_dedup import RenderDeduplicator
 
 
-def exec_command(command_args, log_filename):
+# Input files probed and rendered together: with --no-sort, rendering starts once that many files are found
+RENDER_BATCH_FILES_COUNT = 256
+
+
+def exec_command(command_args, log_filename, echo=True):
     with open(log_filename, 'a+') as log_file:
         log_file.seek(0, os.SEEK_END)
-        print(' '.join(command_args))
+        command_line = ' '.join(command_args)
+        if echo:
+            print(command_line)
+        else:
+            log_file.write(command_line + '\n')
+            log_file.flush()
         return subprocess.call(command_args, stdout=log_file, stderr=subprocess.STDOUT)
 
 
+def exec_command_with_data(command_args, input_data, log_filename, echo=True):
+    """ Runs a command with input data piped to its standard input. Returns its standard output, or None if it failed
+    (its error output is written to the log file). """
+    with open(log_filename, 'a+') as log_file:
+        log_file.seek(0, os.SEEK_END)
+        command_line = ' '.join(command_args)
+        if echo:
+            print(command_line)
+        else:
+            log_file.write(command_line + '\n')
+            log_file.flush()
+        process = subprocess.Popen(command_args, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=log_file)
+        output_data = process.communicate(input_data)[0]
+        return output_data if process.returncode == 0 else None
+
+
 def check_command_path(paths_to_check, args=None):
     for path in paths_to_check:
         print('Looking for ' + path + ' ... ', end='')
@@ -36,11 +74,15 @@ def check_command_path(paths_to_check, args=None):
 
 
 class SvgToPngRenderer:
+    LOG_FILENAME = 'renderer.log'
+
     def __init__(self):
         self.command_path = None
         self.about = None
         self.initialized = False
         self.available = False
+        self.echo_commands = True
+        self.downscale = False
 
     def initialize(self):
         pass
@@ -50,7 +92,53 @@ class SvgToPngRenderer:
             self.initialize()
         return self.available
 
-    def render(self, svg_file, png_file, width=None, height=None):
+    def get_version(self):
+        """ Identifies the renderer and its version, for render caching. """
+        return self.__class__.__name__ + '\n' + str(self.about)
+
+    def prepare(self, svg_files):
+        """ Called once with all SVG files to render, before any render. """
+        pass
+
+    def forget(self, svg_files):
+        """ Called with SVG files changed since rendered (see --watch): drops what is kept in memory about them. """
+        pass
+
+    def render(self, svg_file, png_file, width=None, height=None, log_filename=None):
+        """ Renders the SVG file to PNG. Returns the exit status of the render command (0 on success). """
+        pass
+
+    def render_all(self, svg_file, render_targets, log_filename=None):
+        """ Renders the SVG file to several PNG files. render_targets is a list of (png_file, width, height) tuples.
+        Returns the list of exit statuses, one per target.
+
+        Renderers able to render several sizes from a single parse of the document override this method. When
+        'downscale' is set, they may render the largest size only and produce other sizes by resampling it.
+        """
+        return [self.render(svg_file, png_file, width, height, log_filename)
+                for png_file, width, height in render_targets]
+
+    def render_data(self, svg_data, width=None, height=None, log_filename=None):
+        """ Renders a SVG document held in memory. Returns the PNG data, or None if the render failed.
+
+        Renderers able to read documents from memory or standard input, and to write PNG to memory or standard output,
+        override this method. By default, the document is rendered through temporary files.
+        """
+        temporary_dir = tempfile.mkdtemp(prefix='svg_to_png_')
+        try:
+            svg_file = os.path.join(temporary_dir, 'document.svg')
+            png_file = os.path.join(temporary_dir, 'document.png')
+            with open(svg_file, 'wb') as output_file:
+                output_file.write(svg_data)
+            if self.render(svg_file, png_file, width, height, log_filename) or not os.path.isfile(png_file):
+                return None
+            with open(png_file, 'rb') as input_file:
+                return input_file.read()
+        finally:
+            shutil.rmtree(temporary_dir, ignore_errors=True)
+
+    def close(self):
+        """ Releases resources kept between renders. """
         pass
 
     def __repr__(self):
@@ -69,6 +157,14 @@ class SvgToPngImageMagickRenderer(SvgToPngRenderer):
     Or with Mac Ports:
         sudo port install ImageMagick +rsvg
     """
+    LOG_FILENAME = 'imagemagick.log'
+    INFO_PERCENT_ESCAPES = '%w %h %[resolution.x] %[resolution.y]'
+    # Files probed per command, to keep command lines below the system argument size limit
+    PROBE_BATCH_FILES_COUNT = 256
+
+    def __init__(self):
+        SvgToPngRenderer.__init__(self)
+        self.metadata_cache = SvgMetadataCache(self.probe_svg_metadata)
 
     def initialize(self):
         if not self.initialized:
@@ -90,7 +186,55 @@ class SvgToPngImageMagickRenderer(SvgToPngRenderer):
                         \n\tbrew install imagemagick --with-librsvg\n')
             self.initialized = True
 
-    def render(self, svg_file, png_file, width=None, height=None):
+    def prepare(self, svg_files):
+        self.metadata_cache.probe(svg_files)
+
+    def forget(self, svg_files):
+        self.metadata_cache.forget(svg_files)
+
+    def probe_svg_metadata(self, svg_files):
+        """ Reads SVG files size and density with ImageMagick 'percent escapes' and 'info:' output.
+
+        Files are probed with a single command per batch of PROBE_BATCH_FILES_COUNT files. If it fails (one of the
+        files can't be read), files of the batch are probed one by one. Returns a dict of SvgMetadata by file path.
+        """
+        metadata_by_file = {}
+        svg_files = list(svg_files)
+        for index in range(0, len(svg_files), SvgToPngImageMagickRenderer.PROBE_BATCH_FILES_COUNT):
+            metadata_by_file.update(self._probe_svg_metadata_batch(
+                svg_files[index:index + SvgToPngImageMagickRenderer.PROBE_BATCH_FILES_COUNT]))
+        return metadata_by_file
+
+    def _probe_svg_metadata_batch(self, svg_files):
+        metadata_by_file = {}
+        info_command_args = [self.command_path] + svg_files + [
+            '-format', SvgToPngImageMagickRenderer.INFO_PERCENT_ESCAPES + '\\n', 'info:']
+        try:
+            info_lines = subprocess.check_output(info_command_args).splitlines()
+        except (subprocess.CalledProcessError, OSError):
+            info_lines = []
+        if len(info_lines) == len(svg_files):
+            for svg_file, info_line in zip(svg_files, info_lines):
+                metadata_by_file[svg_file] = SvgToPngImageMagickRenderer._parse_info(info_line)
+        else:
+            for svg_file in svg_files:
+                info_command_args = [self.command_path, svg_file, '-format',
+                                     SvgToPngImageMagickRenderer.INFO_PERCENT_ESCAPES, 'info:']
+                try:
+                    info = subprocess.check_output(info_command_args)
+                except (subprocess.CalledProcessError, OSError) as err:
+                    utils.print_warning('Error calling:\n\t' + ' '.join(info_command_args) + '\n' + str(err) + '\n')
+                    continue
+                metadata_by_file[svg_file] = SvgToPngImageMagickRenderer._parse_info(info)
+        return metadata_by_file
+
+    @staticmethod
+    def _parse_info(info):
+        original_width, original_height, original_density_x, original_density_y = info.split()
+        return SvgMetadata(float(original_width), float(original_height), density_x=float(original_density_x),
+                           density_y=float(original_density_y))
+
+    def render(self, svg_file, png_file, width=None, height=None, log_filename=None):
         """ Render (rasterize) SVG files to PNG, using ImageMagick command line.
 
         By default, ImageMagick rasters vector images to their given canvas resolution using default density (72 dpi).
@@ -104,42 +248,89 @@ class SvgToPngImageMagickRenderer(SvgToPngRenderer):
         ensure pixel perfect output, we 1) use a 'density factor' to increase sampling quality, 2) resize the raster image
         to the expected resolution.
 
-        To get the image original size and density, we use ImageMagick 'percent escapes' attributes with 'info:' output.
+        The image original size and density are read once per file and cached (see SvgMetadataCache): from the root
+        <svg> element attributes when possible, else with ImageMagick 'percent escapes' attributes with 'info:' output.
         See: http://www.imagemagick.org/script/escape.php
 
         Interesting thread about selecting ImageMagick SVG renderer:
         http://www.imagemagick.org/discourse-server/viewtopic.php?f=1&t=26837
         """
-        density_factor = 2
-        log_filename = 'imagemagick.log'
+        log_filename = log_filename or self.LOG_FILENAME
         if width or height:
-            info_percent_escapes = '%w %h %[resolution.x] %[resolution.y]'
-            info_command_args = [self.command_path, svg_file, '-format', info_percent_escapes, 'info:']
-            try:
-                info = subprocess.check_output(info_command_args)
-            except subprocess.CalledProcessError, err:
-                utils.print_warning('Error calling:\n\t' + ' '.join(info_command_args) + '\n' + str(err) + '\n')
-                return
-            original_width, original_height, original_density_x, original_density_y = info.split()
-            density = ''
-            geometry = ''
-            if width:
-                density_x = int(math.ceil(width / float(original_width) * float(original_density_x)) * density_factor)
-                density = str(density_x)
-                geometry = str(width)
-            if height:
-                ratio = height / float(original_height)
-                if not width:
-                    density_x = int(math.ceil(ratio * float(original_density_x)) * density_factor)
-                    density = str(density_x)
-                density_y = int(math.ceil(ratio * float(original_density_y)) * density_factor)
-                density += 'x' + str(density_y)
-                geometry += 'x' + str(height)
-            command_args = [self.command_path, '-density', density, '-resize', geometry, '-background', 'none',
-                            svg_file, png_file]
+            metadata = self.metadata_cache.get(svg_file)
+            if metadata is None:
+                utils.print_warning('Could not read size of ' + svg_file + '\n')
+                return 1
+            density = SvgToPngImageMagickRenderer._get_raster_density(metadata, width, height)
+            command_args = [self.command_path, '-density', density, '-resize', get_geometry(width, height),
+                            '-background', 'none', svg_file, png_file]
         else:
             command_args = [self.command_path, '-background', 'none', svg_file, png_file]
-        exec_command(command_args, log_filename)
+        return exec_command(command_args, log_filename, self.echo_commands)
+
+    def render_all(self, svg_file, render_targets, log_filename=None):
+        """ With 'downscale' set, reads and rasters the SVG file once, at the density of the largest target, then
+        writes each target from a resized clone of this raster, all with a single command.
+        See: http://www.imagemagick.org/Usage/files/#write
+        """
+        sized_targets = [render_target for render_target in render_targets if render_target[1] or render_target[2]]
+        if not self.downscale or len(render_targets) < 2 or len(sized_targets) < len(render_targets):
+            return SvgToPngRenderer.render_all(self, svg_file, render_targets, log_filename)
+        log_filename = log_filename or self.LOG_FILENAME
+        metadata = self.metadata_cache.get(svg_file)
+        if metadata is None:
+            utils.print_warning('Could not read size of ' + svg_file + '\n')
+            return [1] * len(render_targets)
+        largest_width, largest_height = max(
+            (get_output_size(metadata.width, metadata.height, width, height) for png_file, width, height in
+             render_targets), key=lambda size: size[0] * size[1])
+        density = SvgToPngImageMagickRenderer._get_raster_density(metadata, largest_width, largest_height)
+        command_args = [self.command_path, '-density', density, '-background', 'none', svg_file]
+        for png_file, width, height in render_targets:
+            command_args.extend(['(', '+clone', '-resize', get_geometry(width, height), '-write', png_file, '+delete',
+                                 ')'])
+        command_args.append('null:')
+        return [exec_command(command_args, log_filename, self.echo_commands)] * len(render_targets)
+
+    def render_data(self, svg_data, width=None, height=None, log_filename=None):
+        """ Pipes the document to 'convert' standard input, and reads the PNG from its standard output.
+        Documents whose size can't be read from their root element are rendered through temporary files, to let
+        ImageMagick probe their size (see probe_svg_metadata). """
+        log_filename = log_filename or self.LOG_FILENAME
+        command_args = [self.command_path]
+        if width or height:
+            metadata = SvgMetadata.from_svg_data(svg_data)
+            if metadata is None:
+                return SvgToPngRenderer.render_data(self, svg_data, width, height, log_filename)
+            density = SvgToPngImageMagickRenderer._get_raster_density(metadata, width, height)
+            command_args.extend(['-density', density, '-resize', get_geometry(width, height)])
+        command_args.extend(['-background', 'none', 'svg:-', 'png:-'])
+        return exec_command_with_data(command_args, svg_data, log_filename, self.echo_commands)
+
+    @staticmethod
+    def _get_raster_density(metadata, width=None, height=None):
+        """ Returns the '-density' argument value to raster the SVG document to the given width and/or height. """
+        density_factor = 2
+        density = ''
+        if width:
+            density_x = int(math.ceil(width / float(metadata.width) * float(metadata.density_x)) * density_factor)
+            density = str(density_x)
+        if height:
+            ratio = height / float(metadata.height)
+            if not width:
+                density_x = int(math.ceil(ratio * float(metadata.density_x)) * density_factor)
+                density = str(density_x)
+            density_y = int(math.ceil(ratio * float(metadata.density_y)) * density_factor)
+            density += 'x' + str(density_y)
+        return density
+
+
+def get_geometry(width=None, height=None):
+    """ Returns an ImageMagick geometry argument value. """
+    geometry = str(width) if width else ''
+    if height:
+        geometry += 'x' + str(height)
+    return geometry
 
 
 class SvgToPngInkscapeRenderer(SvgToPngRenderer):
@@ -147,6 +338,7 @@ class SvgToPngInkscapeRenderer(SvgToPngRenderer):
 
     Constructor looks for Inkscape application in default MacOS, Windows and Linux paths.
     """
+    LOG_FILENAME = 'inkscape.log'
 
     def initialize(self):
         if not self.initialized:
@@ -159,8 +351,8 @@ class SvgToPngInkscapeRenderer(SvgToPngRenderer):
                 self.available = True
             self.initialized = True
 
-    def render(self, svg_file, png_file, width=None, height=None):
-        """ Render (rasterize) SVG files to PNG, using ImageMagick command line.
+    def render(self, svg_file, png_file, width=None, height=None, log_filename=None):
+        """ Render (rasterize) SVG files to PNG, using Inkscape command line.
 
         If no width nor height is provided, Inkscape will export using its default density (90 dpi).
         See: https://inkscape.org/doc/inkscape-man.html
@@ -169,27 +361,420 @@ class SvgToPngInkscapeRenderer(SvgToPngRenderer):
         Note: Inkscape provides many export options and a complete shell to manipulate SVG. You can, for instance, select a
         specific SVG elements to export with its ID or to use it as a mask to raster the rest of the image.
         """
-        log_filename = 'inkscape.log'
+        log_filename = log_filename or self.LOG_FILENAME
         command_args = [self.command_path, '--without-gui', svg_file, '--export-png', png_file]
         if width:
             command_args.extend(['-w', str(width)])
         if height:
             command_args.extend(['-h', str(height)])
-        exec_command(command_args, log_filename)
+        return exec_command(command_args, log_filename, self.echo_commands)
+
+
+class SvgToPngInkscapeShellRenderer(SvgToPngInkscapeRenderer):
+    """ Render (rasterize) SVG files to PNG, streaming export commands to long-lived Inkscape shell sessions.
+
+    Inkscape start-up takes much longer than rendering a small icon. This renderer keeps 'inkscape --shell' sessions
+    running between renders: each render takes an idle session, or starts one, and gives it back once done. A batch
+    only pays Inkscape start-up once per parallel worker, and later batches (see --watch) reuse the same sessions.
+    Sessions are restarted when Inkscape crashes or hangs (see InkscapeShellSession).
+    """
+    SESSION_TIMEOUT = 120
+
+    def __init__(self):
+        SvgToPngInkscapeRenderer.__init__(self)
+        self.sessions = []
+        self.idle_sessions = []
+        self.sessions_lock = threading.Lock()
+
+    def acquire_session(self):
+        with self.sessions_lock:
+            if self.idle_sessions:
+                return self.idle_sessions.pop()
+        session = InkscapeShellSession([self.command_path, '--shell'], SvgToPngInkscapeShellRenderer.SESSION_TIMEOUT)
+        with self.sessions_lock:
+            self.sessions.append(session)
+        return session
+
+    def release_session(self, session):
+        with self.sessions_lock:
+            self.idle_sessions.append(session)
+
+    def render(self, svg_file, png_file, width=None, height=None, log_filename=None):
+        log_filename = log_filename or self.LOG_FILENAME
+        shell_args = [svg_file, '--export-png=' + png_file]
+        if width:
+            shell_args.append('--export-width=' + str(width))
+        if height:
+            shell_args.append('--export-height=' + str(height))
+        command_line = '[shell] ' + ' '.join(shell_args)
+        if self.echo_commands:
+            print(command_line)
+        if os.path.isfile(png_file):
+            os.remove(png_file)
+        with open(log_filename, 'a') as log_file:
+            if not self.echo_commands:
+                log_file.write(command_line + '\n')
+            session = self.acquire_session()
+            try:
+                log_file.write(session.run(shell_args))
+            except InkscapeShellError as err:
+                log_file.write(str(err) + '\n')
+                return 1
+            finally:
+                self.release_session(session)
+        return 0 if os.path.isfile(png_file) else 1
+
+    def close(self):
+        with self.sessions_lock:
+            for session in self.sessions:
+                session.close()
+            self.sessions = []
+            self.idle_sessions = []
+
+
+class SvgToPngRsvgRenderer(SvgToPngRenderer):
+    """ Render (rasterize) SVG files to PNG in-process, with librsvg and cairo Python bindings.
+
+    No command is run: SVG documents are parsed by librsvg and drawn on a cairo image surface, scaled to the requested
+    size. Parsed documents are kept in memory (up to MAX_CACHED_DOCUMENTS, least recently used are released first), so
+    that a single parse serves all densities of a file.
+    Requires PyGObject with librsvg introspection data, and pycairo. On Debian/Ubuntu:
+        sudo apt-get install python-gi python-gi-cairo gir1.2-rsvg-2.0
+    On MacOS:
+        brew install pygobject librsvg py2cairo
+    """
+    LOG_FILENAME = 'rsvg.log'
+    MAX_CACHED_DOCUMENTS = 64
+
+    def __init__(self):
+        SvgToPngRenderer.__init__(self)
+        self.rsvg = None
+        self.cairo = None
+        self.documents = OrderedDict()
+        self.documents_lock = threading.Lock()
+
+    def initialize(self):
+        if not self.initialized:
+            print('Looking for librsvg and cairo Python bindings ... ', end='')
+            try:
+                import gi
+                gi.require_version('Rsvg', '2.0')
+                from gi.repository import Rsvg
+                import cairo
+            except (ImportError, ValueError):
+                print('no')
+            else:
+                print('yes')
+                self.rsvg = Rsvg
+                self.cairo = cairo
+                self.command_path = 'gi.repository.Rsvg (in-process)'
+                self.about = 'librsvg ' + '.'.join(str(getattr(Rsvg, version_part, '?')) for version_part in
+                                                   ['MAJOR_VERSION', 'MINOR_VERSION', 'MICRO_VERSION']) \
+                             + '\ncairo ' + cairo.cairo_version_string()
+                self.available = True
+            self.initialized = True
+
+    def get_document(self, svg_file):
+        """ Returns a tuple (Rsvg.Handle, lock) for the file, parsing it only if not in memory yet.
+        A handle must not be rendered by several threads at once: its lock must be held while rendering. """
+        with self.documents_lock:
+            document = self.documents.pop(svg_file, None)
+            if document is None:
+                document = (self.rsvg.Handle.new_from_file(svg_file), threading.Lock())
+            self.documents[svg_file] = document
+            while len(self.documents) > SvgToPngRsvgRenderer.MAX_CACHED_DOCUMENTS:
+                self.documents.popitem(last=False)
+            return document
+
+    def render(self, svg_file, png_file, width=None, height=None, log_filename=None):
+        """ Render (rasterize) SVG files to PNG, with librsvg.
+
+        If only width or height is provided, the other one is computed to keep the document aspect ratio. If none is
+        provided, the document is rendered to its own size (librsvg default density is 90 dpi).
+        See: https://developer.gnome.org/rsvg/stable/
+        """
+        log_filename = log_filename or self.LOG_FILENAME
+        command_line = '[rsvg] ' + svg_file + ' -> ' + png_file + ' ' + str(width) + 'x' + str(height)
+        with open(log_filename, 'a') as log_file:
+            if self.echo_commands:
+                print(command_line)
+            else:
+                log_file.write(command_line + '\n')
+            try:
+                handle, handle_lock = self.get_document(svg_file)
+                with handle_lock:
+                    surface = self._render_handle(handle, width, height)
+                surface.write_to_png(png_file)
+            except Exception as err:
+                log_file.write('Error rendering ' + svg_file + ': ' + str(err) + '\n')
+                return 1
+        return 0
+
+    def render_data(self, svg_data, width=None, height=None, log_filename=None):
+        """ Parses the document from memory and writes the PNG to memory: no file is read nor written. """
+        log_filename = log_filename or self.LOG_FILENAME
+        command_line = '[rsvg] <data> -> <data> ' + str(width) + 'x' + str(height)
+        with open(log_filename, 'a') as log_file:
+            if self.echo_commands:
+                print(command_line)
+            else:
+                log_file.write(command_line + '\n')
+            try:
+                surface = self._render_handle(self.rsvg.Handle.new_from_data(svg_data), width, height)
+                png_data = io.BytesIO()
+                surface.write_to_png(png_data)
+            except Exception as err:
+                log_file.write('Error rendering document data: ' + str(err) + '\n')
+                return None
+        return png_data.getvalue()
+
+    def _render_handle(self, handle, width=None, height=None):
+        """ Draws a parsed document on a new cairo image surface, scaled to the output size. """
+        dimensions = handle.get_dimensions()
+        output_width, output_height = get_output_size(dimensions.width, dimensions.height, width, height)
+        surface = self.cairo.ImageSurface(self.cairo.FORMAT_ARGB32, output_width, output_height)
+        context = self.cairo.Context(surface)
+        context.scale(output_width / float(dimensions.width), output_height / float(dimensions.height))
+        handle.render_cairo(context)
+        return surface
+
+    def render_all(self, svg_file, render_targets, log_filename=None):
+        """ With 'downscale' set, rasters the largest target only, and draws it scaled down to other targets sizes, with
+        cairo best quality filter. """
+        if not self.downscale or len(render_targets) < 2:
+            return SvgToPngRenderer.render_all(self, svg_file, render_targets, log_filename)
+        log_filename = log_filename or self.LOG_FILENAME
+        return_codes = []
+        with open(log_filename, 'a') as log_file:
+            try:
+                handle, handle_lock = self.get_document(svg_file)
+                with handle_lock:
+                    dimensions = handle.get_dimensions()
+                    output_sizes = [get_output_size(dimensions.width, dimensions.height, width, height)
+                                    for png_file, width, height in render_targets]
+                    largest_width, largest_height = max(output_sizes, key=lambda size: size[0] * size[1])
+                    largest_surface = self.cairo.ImageSurface(self.cairo.FORMAT_ARGB32, largest_width, largest_height)
+                    context = self.cairo.Context(largest_surface)
+                    context.scale(largest_width / float(dimensions.width), largest_height / float(dimensions.height))
+                    handle.render_cairo(context)
+            except Exception as err:
+                log_file.write('Error rendering ' + svg_file + ': ' + str(err) + '\n')
+                return [1] * len(render_targets)
+            for (png_file, width, height), (output_width, output_height) in zip(render_targets, output_sizes):
+                command_line = '[rsvg] ' + svg_file + ' -> ' + png_file + ' ' + str(width) + 'x' + str(height)
+                if (output_width, output_height) != (largest_width, largest_height):
+                    command_line += ' (downscaled)'
+                if self.echo_commands:
+                    print(command_line)
+                else:
+                    log_file.write(command_line + '\n')
+                try:
+                    surface = largest_surface
+                    if (output_width, output_height) != (largest_width, largest_height):
+                        surface = self.cairo.ImageSurface(self.cairo.FORMAT_ARGB32, output_width, output_height)
+                        context = self.cairo.Context(surface)
+                        context.scale(output_width / float(largest_width), output_height / float(largest_height))
+                        context.set_source_surface(largest_surface, 0, 0)
+                        context.get_source().set_filter(self.cairo.FILTER_BEST)
+                        context.paint()
+                    surface.write_to_png(png_file)
+                    return_codes.append(0)
+                except Exception as err:
+                    log_file.write('Error writing ' + png_file + ': ' + str(err) + '\n')
+                    return_codes.append(1)
+        return return_codes
+
+    def forget(self, svg_files):
+        with self.documents_lock:
+            for svg_file in svg_files:
+                self.documents.pop(svg_file, None)
+
+    def close(self):
+        with self.documents_lock:
+            self.documents.clear()
+
+
+def get_output_size(original_width, original_height, width=None, height=None):
+    """ Returns the output size in pixels. A missing dimension is computed to keep the original aspect ratio. """
+    if width and height:
+        return width, height
+    if width:
+        return width, max(1, int(round(width * original_height / float(original_width))))
+    if height:
+        return max(1, int(round(height * original_width / float(original_height)))), height
+    return max(1, int(math.ceil(original_width))), max(1, int(math.ceil(original_height)))
+
+
+class RenderJob:
+    """ A single SVG to PNG raster, scheduled by run_render_jobs. """
+
+    def __init__(self, svg_file, png_file, width=None, height=None, density_config=None):
+        self.svg_file = svg_file
+        self.png_file = png_file
+        self.width = width
+        self.height = height
+        self.density_config = density_config
+        self.log_filename = None
+
+    def __repr__(self):
+        return '[RenderJob]\t' + self.svg_file + ' -> ' + self.png_file + '\t' + str(self.width) + '\t' + str(self.height)
+
+
+def group_render_jobs_by_file(render_jobs):
+    """ Returns lists of render jobs of a same SVG file, in order of the first job of each file. """
+    render_jobs_by_file = OrderedDict()
+    for render_job in render_jobs:
+        render_jobs_by_file.setdefault(render_job.svg_file, []).append(render_job)
+    return list(render_jobs_by_file.values())
+
+
+def run_render_jobs(renderer, render_jobs, jobs_count=1, render_cache=None):
+    """ Renders all jobs, with jobs_count parallel workers. Returns the list of JobResult, in jobs order.
+    Job result values are True for renders fetched from the render cache, if any.
+
+    Jobs of a same SVG file are handled together by a single worker, with a single renderer call, so that renderers can
+    parse each file once for all its output sizes.
+    With a single worker, commands are printed and logged to the renderer shared log file, as they run.
+    With parallel workers, each file writes to its own log file. Logs are then appended to the shared log file in jobs
+    order, and progress is printed in jobs order too, so that output does not depend on scheduling.
+    """
+    file_render_jobs_list = group_render_jobs_by_file(render_jobs)
+    parallel = jobs_count > 1
+    logs_dir = None
+    if parallel:
+        logs_dir = tempfile.mkdtemp(prefix='svg_to_png_logs_')
+        renderer.echo_commands = False
+    job_results = []
+    try:
+        for index, file_render_jobs in enumerate(file_render_jobs_list):
+            log_filename = os.path.join(logs_dir, str(index) + '.log') if parallel else renderer.LOG_FILENAME
+            for render_job in file_render_jobs:
+                render_job.log_filename = log_filename
+        jobs_total = str(len(render_jobs))
+        render_function = lambda file_render_jobs: _render_file(renderer, file_render_jobs, render_cache)
+        for file_job_result in JobPool(jobs_count).imap(render_function, file_render_jobs_list):
+            if file_job_result.succeeded():
+                file_job_results = file_job_result.value
+            else:
+                file_job_results = [JobResult(render_job, error=file_job_result.error,
+                                              error_traceback=file_job_result.error_traceback)
+                                    for render_job in file_job_result.job]
+            for job_result in file_job_results:
+                job_results.append(job_result)
+                if parallel:
+                    status = '' if job_result.succeeded() else '\tFAILED'
+                    print('[' + str(len(job_results)) + '/' + jobs_total + ']\t' + job_result.job.png_file + status)
+        if parallel:
+            with open(renderer.LOG_FILENAME, 'a') as log_file:
+                for file_render_jobs in file_render_jobs_list:
+                    if os.path.isfile(file_render_jobs[0].log_filename):
+                        with open(file_render_jobs[0].log_filename) as job_log_file:
+                            shutil.copyfileobj(job_log_file, log_file)
+    finally:
+        renderer.echo_commands = True
+        if logs_dir:
+            shutil.rmtree(logs_dir, ignore_errors=True)
+    return job_results
+
+
+def _render_file(renderer, file_render_jobs, render_cache=None):
+    """ Renders jobs of a same SVG file that are not found in the render cache, with a single renderer call.
+    Returns the list of JobResult, in jobs order. """
+    job_results = [None] * len(file_render_jobs)
+    jobs_to_render = []
+    for index, render_job in enumerate(file_render_jobs):
+        cache_key = None
+        if render_cache:
+            cache_key = render_cache.get_key(render_job.svg_file, renderer.get_version(), render_job.width,
+                                             render_job.height, render_job.density_config, renderer.downscale)
+            if render_cache.fetch(cache_key, render_job.png_file):
+                job_results[index] = JobResult(render_job, value=True)
+                continue
+        # Output may be a hard link to a cached file or to a duplicate render, which must not be overwritten in place.
+        if os.path.isfile(render_job.png_file):
+            os.remove(render_job.png_file)
+        jobs_to_render.append((index, render_job, cache_key))
+    if jobs_to_render:
+        first_render_job = jobs_to_render[0][1]
+        render_targets = [(render_job.png_file, render_job.width, render_job.height)
+                          for index, render_job, cache_key in jobs_to_render]
+        return_codes = renderer.render_all(first_render_job.svg_file, render_targets, first_render_job.log_filename)
+        for (index, render_job, cache_key), return_code in zip(jobs_to_render, return_codes):
+            if return_code:
+                job_results[index] = JobResult(render_job, error='Render command exited with status '
+                                               + str(return_code) + ' (see ' + renderer.LOG_FILENAME + ')')
+                continue
+            if render_cache:
+                render_cache.store(cache_key, render_job.png_file)
+            job_results[index] = JobResult(render_job, value=False)
+    return job_results
+
+
+def deduplicate_render_jobs(render_jobs, unique_jobs_by_key=None):
+    """ Splits render jobs into unique jobs, and duplicates of them: renders of identical documents (once normalized,
+    see RenderDeduplicator) to a same size. Returns the list of unique jobs, and a list of (duplicate job, unique job)
+    tuples.
+    unique_jobs_by_key holds unique jobs of previous calls, by render key, and is updated with new ones: pass the same
+    dict to deduplicate batches of jobs against previous batches. """
+    if unique_jobs_by_key is None:
+        unique_jobs_by_key = {}
+    svg_data_by_file = {}
+    unique_jobs = []
+    duplicate_jobs = []
+    for render_job in render_jobs:
+        if render_job.svg_file not in svg_data_by_file:
+            with open(render_job.svg_file, 'rb') as svg_file:
+                svg_data_by_file[render_job.svg_file] = svg_file.read()
+        key = RenderDeduplicator.get_key(svg_data_by_file[render_job.svg_file], render_job.width, render_job.height)
+        unique_job = unique_jobs_by_key.get(key)
+        if unique_job is None:
+            unique_jobs_by_key[key] = render_job
+            unique_jobs.append(render_job)
+        else:
+            duplicate_jobs.append((render_job, unique_job))
+    return unique_jobs, duplicate_jobs
+
+
+def link_duplicate_render_jobs(duplicate_jobs, job_results_by_png_file):
+    """ Links (or copies) outputs of unique jobs to their duplicates. job_results_by_png_file are the results of unique
+    jobs, by output file. Returns the list of results of duplicate jobs: a duplicate fails if its unique job failed. """
+    duplicate_job_results = []
+    for duplicate_job, unique_job in duplicate_jobs:
+        unique_job_result = job_results_by_png_file[unique_job.png_file]
+        if not unique_job_result.succeeded():
+            duplicate_job_results.append(JobResult(duplicate_job, error='Duplicate of ' + unique_job.png_file
+                                                   + ', which failed'))
+            continue
+        try:
+            utils.link_or_copy(unique_job.png_file, duplicate_job.png_file)
+        except (IOError, OSError) as err:
+            duplicate_job_results.append(JobResult(duplicate_job, error='Could not link ' + unique_job.png_file + ': '
+                                                   + str(err)))
+            continue
+        duplicate_job_results.append(JobResult(duplicate_job, value=unique_job_result.value))
+    return duplicate_job_results
+
+
+RENDERER_CLASSES = {
+    'inkscape': SvgToPngInkscapeRenderer,
+    'inkscape-shell': SvgToPngInkscapeShellRenderer,
+    'imagemagick': SvgToPngImageMagickRenderer,
+    'rsvg': SvgToPngRsvgRenderer,
+}
+# Renderers looked for when none is specified, by order of preference.
+DEFAULT_RENDERER_NAMES = ['inkscape', 'imagemagick', 'rsvg']
 
 
 def get_renderer(renderer_name=None):
     selected_renderer = None
-    #TODO: move renderers to a map
     if renderer_name:
-        if renderer_name == 'inkscape':
-            selected_renderer = SvgToPngInkscapeRenderer()
-        elif renderer_name == 'imagemagick':
-            selected_renderer = SvgToPngImageMagickRenderer()
-        else:
+        renderer_class = RENDERER_CLASSES.get(renderer_name)
+        if not renderer_class:
             raise Exception('Unknown renderer ' + renderer_name)
+        selected_renderer = renderer_class()
     else:
-        for renderer in [SvgToPngInkscapeRenderer(), SvgToPngImageMagickRenderer()]:
+        for default_renderer_name in DEFAULT_RENDERER_NAMES:
+            renderer = RENDERER_CLASSES[default_renderer_name]()
             if renderer.is_available():
                 selected_renderer = renderer
                 break
@@ -198,6 +783,10 @@ def get_renderer(renderer_name=None):
     return selected_renderer
 
 
+def get_png_filename(svg_file):
+    return os.path.splitext(os.path.basename(svg_file))[0] + '.png'
+
+
 def parse_command_line(argv):
     parser = argparse.ArgumentParser(
         description='Renders SVG files to PNG with specified size, using pixels or Android DIP.')
@@ -205,16 +794,47 @@ def parse_command_line(argv):
         help='Input SVG files or directory')
     parser.add_argument('-o', dest='OUTPUT_DIR', default='',
         help='Ouput directory for PNG files')
+    parser.add_argument('-r', '--recursive', dest='RECURSIVE', action='store_true',
+        help='Also render SVGs of sub-directories of the input directory, to the same sub-directories of the output \
+directories')
+    parser.add_argument('--include', dest='INCLUDE_PATTERNS', action='append', metavar='PATTERN',
+        help='Only render SVGs with a path (relative to the input directory) matching this glob pattern. Can be \
+repeated.')
+    parser.add_argument('--exclude', dest='EXCLUDE_PATTERNS', action='append', metavar='PATTERN',
+        help='Skip SVGs and sub-directories with a path (relative to the input directory) matching this glob pattern. \
+Can be repeated.')
+    parser.add_argument('--no-sort', dest='NO_SORT', action='store_true',
+        help='Render SVGs in the order they are found, as the input directory is walked, instead of sorting them by \
+path first')
     parser.add_argument('--width', dest='WIDTH', type=int,
         help='Output width, in pixels')
     parser.add_argument('--height', dest='HEIGHT', type=int,
         help='Output height, in pixels')
-    parser.add_argument('--renderer', dest='RENDERER', choices=['inkscape', 'imagemagick'],
+    parser.add_argument('--renderer', dest='RENDERER', choices=sorted(RENDERER_CLASSES.keys()),
         help='Force renderer to use')
-    parser.add_argument('--density', dest='DENSITY_LABEL', choices=DensityConverter.get_density_names(),
+    parser.add_argument('--density', dest='DENSITY_LABEL', choices=DensityConverter.get_instance().get_density_names(),
         help='Specifies density to consider as reference and exports PNG to ALL densities specified in config file.')
     parser.add_argument('--config', dest='DENSITIES_CONFIG_FILE', default='densities.json',
         help='Config file describing densities output scales and output paths.')
+    parser.add_argument('--jobs', dest='JOBS', type=int, default=1,
+        help='Number of renders to run in parallel (default: 1)')
+    parser.add_argument('--downscale', dest='DOWNSCALE', action='store_true',
+        help='With --density, renders each file once to the largest density and resamples it to other densities \
+(ImageMagick and rsvg renderers)')
+    parser.add_argument('--force', dest='FORCE', action='store_true',
+        help='Render all files, including renders up to date in the output directory build manifest')
+    parser.add_argument('--watch', dest='WATCH', action='store_true',
+        help='Once all files are rendered, keep watching them, and render changed and added files again, to all \
+sizes, as they are saved')
+    parser.add_argument('--debounce', dest='DEBOUNCE_DELAY', type=float, default=DEFAULT_DEBOUNCE_DELAY,
+        help='With --watch, seconds without further change before changed files are rendered (default: '
+             + str(DEFAULT_DEBOUNCE_DELAY) + ')')
+    parser.add_argument('--no-cache', dest='NO_CACHE', action='store_true',
+        help='Render all files, without using or updating the render cache')
+    parser.add_argument('--cache-dir', dest='CACHE_DIR', default=DEFAULT_CACHE_DIR,
+        help='Render cache directory (default: ' + DEFAULT_CACHE_DIR + ')')
+    parser.add_argument('--cache-size', dest='CACHE_SIZE', type=int, default=DEFAULT_CACHE_MAX_SIZE / (1024 * 1024),
+        help='Render cache maximum size, in megabytes. Least recently used renders are removed above this size.')
     return parser.parse_args(argv)
 
 
@@ -228,6 +848,127 @@ def check_command_line_arguments(args):
         os.makedirs(args.OUTPUT_DIR)
     if not os.path.isfile(args.DENSITIES_CONFIG_FILE):
             raise Exception('Invalid config file "' + args.DENSITIES_CONFIG_FILE + '"')
+    if args.JOBS < 1:
+        raise Exception('Invalid number of jobs ' + str(args.JOBS) + '. Should be at least 1.')
+
+
+def get_render_jobs(svg_files, output_dir, input_file_or_dir, width=None, height=None, density_sizes=None):
+    """ Returns the render jobs of SVG files: one per density size, or a single one without density. Creates their
+    output directories. """
+    render_jobs = []
+    for svg_file in svg_files:
+        if density_sizes is not None:
+            for density_size in density_sizes:
+                density_output_dir = density_size.output_config.get_output_dir(output_dir)
+                density_output_dir = utils.get_mirrored_output_dir(density_output_dir, svg_file, input_file_or_dir)
+                utils.make_directories(density_output_dir)
+                png_filename = density_size.output_config.get_filename(get_png_filename(svg_file))
+                png_file = os.path.join(density_output_dir, png_filename)
+                render_jobs.append(RenderJob(svg_file, png_file, density_size.width, density_size.height,
+                                             density_size.output_config))
+        else:
+            file_output_dir = utils.get_mirrored_output_dir(output_dir, svg_file, input_file_or_dir)
+            utils.make_directories(file_output_dir)
+            png_file = os.path.join(file_output_dir, get_png_filename(svg_file))
+            render_jobs.append(RenderJob(svg_file, png_file, width, height))
+    return render_jobs
+
+
+def get_build_target(render_job, renderer):
+    """ Returns the BuildTarget of a render job, for the build manifest. """
+    recipe = {'renderer': renderer.get_version(), 'width': render_job.width, 'height': render_job.height,
+              'downscale': renderer.downscale, 'density': None}
+    if render_job.density_config is not None:
+        recipe['density'] = render_job.density_config.to_json()
+    return BuildTarget(render_job.png_file, [render_job.svg_file], recipe)
+
+
+def render_svg_files(renderer, render_job_batches, jobs_count=1, render_cache=None, probe_sizes=False, manifest=None,
+                     force=False):
+    """ Renders batches of jobs (lists of RenderJob) once deduplicated against all batches (see
+    deduplicate_render_jobs), and links duplicates. Each batch is rendered before the next one is read, so that
+    batches may be yielded while input files are found. Files are probed first, by batch, if probe_sizes (see
+    SvgToPngRenderer.prepare). Returns the list of JobResult.
+    With a build manifest, only jobs that are not up to date in it are run, unless force (see plan_build), and their
+    results are recorded in it. """
+    job_results = []
+    unique_jobs_by_key = {}
+    unique_job_results_by_png_file = {}
+    jobs_total_count = 0
+    planned_jobs_count = 0
+    unique_jobs_count = 0
+    cached_count = 0
+    duplicates_count = 0
+    for render_jobs in render_job_batches:
+        jobs_total_count += len(render_jobs)
+        build_targets = None
+        if manifest:
+            build_targets = OrderedDict((render_job.png_file, get_build_target(render_job, renderer))
+                                        for render_job in render_jobs)
+            planned_png_files = set(build_target.output_file for build_target in
+                                    plan_build(manifest, build_targets.values(), force))
+            render_jobs = [render_job for render_job in render_jobs if render_job.png_file in planned_png_files]
+        planned_jobs_count += len(render_jobs)
+        unique_render_jobs, duplicate_render_jobs = deduplicate_render_jobs(render_jobs, unique_jobs_by_key)
+        if probe_sizes:
+            renderer.prepare([file_render_jobs[0].svg_file for file_render_jobs in
+                              group_render_jobs_by_file(unique_render_jobs)])
+        batch_job_results = run_render_jobs(renderer, unique_render_jobs, jobs_count, render_cache)
+        unique_jobs_count += len(batch_job_results)
+        cached_count += len([job_result for job_result in batch_job_results if job_result.value])
+        for job_result in batch_job_results:
+            unique_job_results_by_png_file[job_result.job.png_file] = job_result
+        if duplicate_render_jobs:
+            batch_job_results.extend(link_duplicate_render_jobs(duplicate_render_jobs, unique_job_results_by_png_file))
+            duplicates_count += len(duplicate_render_jobs)
+        if manifest:
+            for job_result in batch_job_results:
+                if job_result.succeeded():
+                    manifest.record(build_targets[job_result.job.png_file])
+                else:
+                    manifest.forget(job_result.job.png_file)
+        job_results.extend(batch_job_results)
+    if manifest:
+        print('\n' + str(jobs_total_count - planned_jobs_count) + '/' + str(jobs_total_count)
+              + ' renders up to date (see ' + manifest.manifest_file + ').')
+    if render_cache:
+        print('\n' + str(cached_count) + '/' + str(unique_jobs_count) + ' renders reused from cache.')
+        render_cache.evict()
+    if duplicates_count:
+        print('\n' + str(duplicates_count) + '/' + str(planned_jobs_count) + ' renders linked from identical renders.')
+    if manifest:
+        manifest.save()
+    return job_results
+
+
+def remove_orphaned_renders(manifest, render_jobs):
+    """ Deletes renders of SVG files that disappeared since rendered (see BuildManifest.remove_orphaned_outputs). """
+    removed_png_files = manifest.remove_orphaned_outputs([render_job.png_file for render_job in render_jobs])
+    for png_file in removed_png_files:
+        print('Removed orphaned ' + png_file)
+    if removed_png_files:
+        manifest.save()
+
+
+def watch_svg_files(watcher, renderer, args, density_sizes=None, render_cache=None, manifest=None):
+    """ Renders SVG files again, to all their sizes, each time they change, until interrupted (Ctrl+C). The renderer
+    is kept open between changes. """
+    print('\nWatching ' + args.INPUT_FILE_OR_DIR + ' for changes (Ctrl+C to stop)...')
+    try:
+        for changed_svg_files in watcher.watch():
+            date_time_start = datetime.datetime.now()
+            renderer.forget(changed_svg_files)
+            if render_cache:
+                render_cache.forget(changed_svg_files)
+            render_jobs = get_render_jobs(changed_svg_files, args.OUTPUT_DIR, args.INPUT_FILE_OR_DIR, args.WIDTH,
+                                          args.HEIGHT, density_sizes)
+            job_results = render_svg_files(renderer, [render_jobs], args.JOBS, render_cache,
+                                           bool(args.WIDTH or args.HEIGHT), manifest, args.FORCE)
+            print_job_failures(job_results)
+            utils.print_reporting(date_time_start, datetime.datetime.now(), changed_svg_files)
+            print('Watching ' + args.INPUT_FILE_OR_DIR + ' for changes (Ctrl+C to stop)...')
+    except KeyboardInterrupt:
+        print('\nStopped watching.')
 
 
 def main(argv=None):
@@ -242,26 +983,51 @@ def main(argv=None):
 
     density_converter = DensityConverter(args.DENSITIES_CONFIG_FILE)
 
-    input_svg_files = sorted(utils.get_file_paths(args.INPUT_FILE_OR_DIR, utils.is_svg_file), key=str.lower)
+    get_input_svg_files = lambda: utils.iter_file_paths(args.INPUT_FILE_OR_DIR, utils.is_svg_file, args.RECURSIVE,
+                                                        args.INCLUDE_PATTERNS, args.EXCLUDE_PATTERNS)
+    # Files saved during the first run are rendered again once it is done
+    watcher = FileWatcher(get_input_svg_files, debounce_delay=args.DEBOUNCE_DELAY) if args.WATCH else None
+    density_sizes = None
     if args.DENSITY_LABEL is not None:
         density_sizes = density_converter.get_density_sizes(args.WIDTH, args.HEIGHT, args.DENSITY_LABEL)
         for density_size in density_sizes:
             print(density_size)
-        for density_size in density_sizes:
-            print('\nHandling density "' + density_size.output_config.name + '"\n')
-            output_dir = density_size.output_config.get_output_dir(args.OUTPUT_DIR)
-            if not os.path.isdir(output_dir):
-                os.mkdir(output_dir)
-            for svg_file in input_svg_files:
-                png_filename = density_size.output_config.get_filename(os.path.splitext(svg_file)[0] + '.png')
-                png_file = os.path.join(output_dir, png_filename)
-                renderer.render(svg_file, png_file, density_size.width, density_size.height)
-    else:
-        for svg_file in input_svg_files:
-            png_file = os.path.join(args.OUTPUT_DIR, os.path.splitext(svg_file)[0] + '.png')
-            renderer.render(svg_file, png_file, args.WIDTH, args.HEIGHT)
+            utils.make_directories(density_size.output_config.get_output_dir(args.OUTPUT_DIR))
+    input_svg_files = []
+    render_jobs = []
+
+    def get_render_job_batches():
+        """ Yields render jobs by batches of files. With --no-sort, batches are yielded as files are found, so that
+        rendering starts before the input directory walk finishes. """
+        svg_files = get_input_svg_files()
+        if not args.NO_SORT:
+            svg_files = iter(sorted(svg_files, key=str.lower))
+        while True:
+            svg_files_batch = list(itertools.islice(svg_files, RENDER_BATCH_FILES_COUNT))
+            if not svg_files_batch:
+                return
+            input_svg_files.extend(svg_files_batch)
+            render_jobs_batch = get_render_jobs(svg_files_batch, args.OUTPUT_DIR, args.INPUT_FILE_OR_DIR, args.WIDTH,
+                                                args.HEIGHT, density_sizes)
+            render_jobs.extend(render_jobs_batch)
+            yield render_jobs_batch
 
-    utils.print_reporting(date_time_start, datetime.datetime.now(), input_svg_files)
+    render_cache = None
+    if not args.NO_CACHE:
+        render_cache = RenderCache(args.CACHE_DIR, args.CACHE_SIZE * 1024 * 1024)
+    renderer.downscale = args.DOWNSCALE
+    manifest = BuildManifest(args.OUTPUT_DIR, 'svg_to_png')
+    try:
+        job_results = render_svg_files(renderer, get_render_job_batches(), args.JOBS, render_cache,
+                                       bool(args.WIDTH or args.HEIGHT), manifest, args.FORCE)
+        remove_orphaned_renders(manifest, render_jobs)
+        failures_count = print_job_failures(job_results)
+        utils.print_reporting(date_time_start, datetime.datetime.now(), input_svg_files)
+        if watcher:
+            watch_svg_files(watcher, renderer, args, density_sizes, render_cache, manifest)
+    finally:
+        renderer.close()
+    return 1 if failures_count else 0
 
 
 if __name__ == '__main__':
@@ -0,0 +1,17 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+from __future__ import print_function
+import sys
+
+from code.color_string import write_color_names_module, COLOR_NAMES_CONFIG_FILE, COLOR_NAMES_MODULE_FILE
+
+
+def main():
+    """ Compiles the color names config file into a Python module, loaded faster than the config file is parsed. """
+    write_color_names_module()
+    print(COLOR_NAMES_CONFIG_FILE + ' compiled to ' + COLOR_NAMES_MODULE_FILE)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())